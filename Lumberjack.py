@@ -34,13 +34,16 @@ from .resources import *
 # Import the code for the dialog
 from .Lumberjack_dialog import LumberjackDialog
 import os.path
+import pickle
 
 from .scripts.train_task import TrainTask
 from .scripts.test_task import TestTask
 from .scripts.predict_task import PredictTask
+from .scripts.evaluate_task import EvaluateTask
 from .scripts.classifier import Classifier
+from .scripts.backends import BACKENDS
 from .scripts.features import AlgebraFeature, FilterFeature, FilterGaussFeature, NdviFeature
-from .scripts.features import DayFeature, ImageFeature, PlaceFeature
+from .scripts.features import DayFeature, ImageFeature, MergedFeature, PlaceFeature, TextureFeature
 from .scripts.seasonal_analysis import SeasonalAnalysis
 from .scripts.calculate_features_task import CalculateFeaturesTask
 from .scripts.tree_correction import TreeCorrectionTask
@@ -61,13 +64,18 @@ ALGEBRA_SUFFIX = "_alge.tif"
 FILTER_SUFFIX = "_filt.tif"
 GAUSS_SUFFIX = "_gaus.tif"
 NDVI_SUFFIX =  "_ndvi.tif"
-DAY_SUFFIX = "_day.tif"
-CROP_SUFFIX = "_crop.tif"
+DAY_SUFFIX = "_day.json"
 MERGED_SUFFIX = "_merged.tif"
 SHAPEFILE_SUFFIX = "_roi.shp"
 MASK_SUFFIX = "_mask.tif"
 STACK_SUFFIX = "_stack.tif"
+STACK_VRT_SUFFIX = "_stack.vrt"
+# Stack of the feature plotted by the seasonal analysis, so it never
+# replaces the stack of the classifier
+ANALYSIS_STACK_SUFFIX = "_analysis.vrt"
 PREDICTION_SUFFIX = "_predic.tif"
+MANIFEST_SUFFIX = "_manifest.json"
+PREDICTION_CACHE_DIRECTORY = ".prediction_cache"
 BAND_TOTAL = 7
 
 
@@ -243,19 +251,29 @@ class Lumberjack:
 
 
     def export_classifier(self):
-        filename = QFileDialog.getSaveFileName(self.dlg, "Save output file ","","*.pkl")
+        filename = QFileDialog.getSaveFileName(self.dlg, "Save output file ","","*.ljm")
         file = filename[0]
         if file != "" :
-            self.classifier.export_classifier(file)
+            try:
+                self.classifier.export_classifier(file, self.dlg.checkBox_compress_classifier.isChecked())
+            except OSError as e:
+                self.iface.messageBar().pushMessage("Error", str(e), level=Qgis.Critical, duration=5)
+                return
             self.dlg.plainTextEdit.appendPlainText("Exported classifier:\n{}".format(str(file)))
 
 
     def import_classifier(self):
-        filename = QFileDialog.getOpenFileName(self.dlg, "Select input classifier file","","*.pkl")
+        filename = QFileDialog.getOpenFileName(self.dlg, "Select input classifier file","","*.ljm *.pkl")
         file = filename[0]
         if file != "" :
-            self.classifier = Classifier()
-            self.classifier.import_classifier(file)
+            classifier = Classifier()
+            try:
+                classifier.import_classifier(file)
+            except (pickle.UnpicklingError, EOFError, AttributeError, ImportError, KeyError, OSError, ValueError) as e:
+                self.iface.messageBar().pushMessage(
+                    "Error", "Can't import the classifier {}: {}".format(file, e), level=Qgis.Critical, duration=5)
+                return
+            self.classifier = classifier
             self.dlg.pushButton_feature_importances.setEnabled(True)
             self.dlg.pushButton_testing.setEnabled(True)
             self.dlg.pushButton_prediction.setEnabled(True)
@@ -290,6 +308,7 @@ class Lumberjack:
 
             self.dlg.pushButton_training.clicked.connect(self.train)
             self.dlg.pushButton_testing.clicked.connect(self.test)
+            self.dlg.pushButton_evaluate.clicked.connect(self.evaluate)
             self.dlg.pushButton_prediction.clicked.connect(self.predict)
 
             self.dlg.pushButton_seasonal.clicked.connect(self.select_seasonal_directory)
@@ -336,31 +355,63 @@ class Lumberjack:
             "Success", "Output file {} created".format(file_name), level=Qgis.Success, duration=5)
 
 
-    def create_features_array(self):
+    def create_features_array(self, all_features=False):
+        # Features checked in the dialog. With all_features every feature
+        # is added, so the ones needed can be chosen by their names
         self.features = []
-        self.features.append(ImageFeature(MERGED_SUFFIX))
-        if self.dlg.checkBox_bandsAlgebra.isChecked():
+        self.features.append(MergedFeature(MERGED_SUFFIX))
+        if all_features or self.dlg.checkBox_bandsAlgebra.isChecked():
             self.features.append(AlgebraFeature(ALGEBRA_SUFFIX))
-        if self.dlg.checkBox_medianFilter.isChecked():
+        if all_features or self.dlg.checkBox_medianFilter.isChecked():
             self.features.append(FilterFeature(FILTER_SUFFIX))
             self.features.append(FilterGaussFeature(GAUSS_SUFFIX))
-        if self.dlg.checkBox_ndvi.isChecked():
+        if all_features or self.dlg.checkBox_ndvi.isChecked():
             self.features.append(NdviFeature(NDVI_SUFFIX))
-        if self.dlg.checkBox_imageFeature.isChecked():
-            self.features.append(ImageFeature(IMAGE_FEATURE_SUFFIX))
-        if self.dlg.checkBox_placeFeature.isChecked():
+        if all_features or self.dlg.checkBox_imageFeature.isChecked():
+            if self.dlg.checkBox_native_textures.isChecked():
+                self.features.append(TextureFeature(
+                    IMAGE_FEATURE_SUFFIX,
+                    size = self.dlg.spinBox_texture_size.value(),
+                    distance = self.dlg.spinBox_texture_distance.value(),
+                    categories = self.dlg.spinBox_texture_categories.value(),
+                    rescale = self.dlg.checkBox_texture_rescale.isChecked()))
+            else:
+                self.features.append(ImageFeature(IMAGE_FEATURE_SUFFIX))
+        if all_features or self.dlg.checkBox_placeFeature.isChecked():
             self.features.append(DayFeature(DAY_SUFFIX))
             self.features.append(PlaceFeature(PLACE_FEATURE_SUFFIX))
 
 
+    def create_classifier_features(self):
+        # Features needed by the classifier. Models which know the names of
+        # their features only calculate those, in their order. Otherwise
+        # the features checked in the dialog are used
+        required_names = list(self.classifier.get_feature_names()) or None
+        self.create_features_array(all_features = required_names is not None)
+        return required_names
+
+
+    def create_calculate_features_task(self, directory, required_names=None, list_only=False, stack_suffix=None):
+        return CalculateFeaturesTask(
+            directory = directory,
+            features = self.features,
+            lumberjack_instance = self,
+            virtual_stack = self.dlg.checkBox_virtual_stack.isChecked(),
+            workers = self.dlg.spinBox_workers.value(),
+            incremental = self.dlg.checkBox_incremental.isChecked(),
+            required_names = required_names,
+            list_only = list_only,
+            stack_suffix = stack_suffix)
+
+
     def calculate_features_seasonal_analysis(self):
+        # Lists the features that can be analysed, they are calculated when
+        # one of them is plotted
         self.dlg.hide()
         self.create_features_array()
 
-        self.calculate_features_task = CalculateFeaturesTask(
-            directory = self.dlg.lineEdit_directory_seasonal.text(),
-            features = self.features,
-            lumberjack_instance = self)
+        self.calculate_features_task = self.create_calculate_features_task(
+            self.dlg.lineEdit_directory_seasonal.text(), list_only = True)
         QgsApplication.taskManager().addTask(self.calculate_features_task)
 
         self.dlg.pushButton_boxplot.setEnabled(True)
@@ -368,16 +419,33 @@ class Lumberjack:
 
     def plot_seasonal_analysis(self):
         self.dlg.hide()
+        self.create_features_array()
+        # Bands without description share the same name, so the position
+        # among the features with the same name is kept too
+        index = self.dlg.comboBox_features.currentIndex()
+        feature_name = self.dlg.comboBox_features.currentText()
+        occurrence = [self.dlg.comboBox_features.itemText(i) for i in range(index)].count(feature_name)
+
         self.seasonal_analysis = SeasonalAnalysis(
             directory = self.dlg.lineEdit_directory_seasonal.text(),
-            feature = self.dlg.comboBox_features.currentIndex() + 1,
-            lumberjack_instance = self)
+            feature_name = feature_name,
+            lumberjack_instance = self,
+            occurrence = occurrence)
+        # Only the chosen feature is calculated, in a stack of its own
+        self.calculate_features_task = self.create_calculate_features_task(
+            self.dlg.lineEdit_directory_seasonal.text(),
+            required_names = [feature_name] * (occurrence + 1),
+            stack_suffix = ANALYSIS_STACK_SUFFIX)
+        self.seasonal_analysis.addSubTask(self.calculate_features_task, [], QgsTask.ParentDependsOnSubTask)
         QgsApplication.taskManager().addTask(self.seasonal_analysis)
 
 
-    def notify_calculate_features(self, start_time, r, feature_names, directory, time):
-        self.dlg.comboBox_features.clear()
-        self.dlg.comboBox_features.addItems(feature_names)
+    def notify_calculate_features(self, start_time, r, feature_names, directory, time, update_features=True):
+        # Features calculated for a consumer (only the ones it needs) don't
+        # replace the list of features to analyse
+        if update_features:
+            self.dlg.comboBox_features.clear()
+            self.dlg.comboBox_features.addItems(feature_names)
         self.dlg.lineEdit_directory_seasonal.setText(directory)
         self.dlg.plainTextEdit.appendPlainText("======== {} ========".format(str(start_time)))
         self.dlg.plainTextEdit.appendPlainText("Finished features in {} seconds".format(str(time)))
@@ -394,14 +462,16 @@ class Lumberjack:
 
 
     def train(self):
+        classifier = Classifier()
+        try:
+            classifier.set_parameters(**self.get_classifier_parameters())
+        except ValueError as e:
+            self.iface.messageBar().pushMessage("Error", str(e), level=Qgis.Critical, duration=5)
+            return
         self.dlg.hide()
-        self.classifier = Classifier()
+        self.classifier = classifier
         self.create_features_array()
-
-        self.calculate_features_task = CalculateFeaturesTask(
-            directory = self.dlg.lineEdit_trainingDirectory.text(),
-            features = self.features,
-            lumberjack_instance = self)
+        fused = self.dlg.checkBox_fused_training.isChecked()
 
         self.testing_ratio = self.dlg.checkBox_testing_ratio.isChecked()
 
@@ -410,9 +480,20 @@ class Lumberjack:
             classifier = self.classifier,
             testing_ratio = self.testing_ratio,
             features = self.features,
-            lumberjack_instance = self)
-
-        self.train_task.addSubTask(self.calculate_features_task, [], QgsTask.ParentDependsOnSubTask)
+            lumberjack_instance = self,
+            spill_samples = self.dlg.checkBox_spill_samples.isChecked(),
+            fused = fused,
+            sample_cache = self.dlg.checkBox_sample_cache.isChecked(),
+            max_per_class = self.dlg.spinBox_samples_per_class.value(),
+            max_per_place = self.dlg.spinBox_samples_per_place.value(),
+            max_per_scene = self.dlg.spinBox_samples_per_scene.value())
+
+        # When the features are calculated only around the samples, the
+        # scenes are not featurized
+        if not fused:
+            self.calculate_features_task = self.create_calculate_features_task(
+                self.dlg.lineEdit_trainingDirectory.text())
+            self.train_task.addSubTask(self.calculate_features_task, [], QgsTask.ParentDependsOnSubTask)
         QgsApplication.taskManager().addTask(self.train_task)
 
         self.dlg.pushButton_feature_importances.setEnabled(True)
@@ -421,25 +502,55 @@ class Lumberjack:
         self.dlg.pushButton_export.setEnabled(True)
 
 
+    def get_classifier_parameters(self):
+        # Zero in the spin boxes means the default of the model
+        max_depth = self.dlg.spinBox_max_depth.value()
+        n_jobs = self.dlg.spinBox_n_jobs.value()
+        max_samples = self.dlg.spinBox_max_samples.value()
+        max_features = self.dlg.comboBox_max_features.currentText()
+        return {
+            "backend": BACKENDS[self.dlg.comboBox_backend.currentIndex()].NAME,
+            "n_estimators": self.dlg.spinBox_n_estimators.value(),
+            "max_depth": max_depth if max_depth > 0 else None,
+            "min_samples_leaf": self.dlg.spinBox_min_samples_leaf.value(),
+            "max_features": max_features if max_features != "all" else None,
+            "n_jobs": n_jobs if n_jobs > 0 else -1,
+            "bootstrap": self.dlg.checkBox_bootstrap.isChecked(),
+            "max_samples": max_samples / 100 if max_samples > 0 else None,
+            "growth_step": self.dlg.spinBox_growth_step.value()}
+
+
+    def get_exit_margin(self):
+        # A margin of 0% gives the same result as evaluating every tree
+        if not self.dlg.checkBox_early_exit.isChecked():
+            return None
+        return self.dlg.spinBox_exit_margin.value() / 100
+
+
     def test(self):
         self.dlg.hide()
-        self.create_features_array()
+        required_names = self.create_classifier_features()
+        self.classifier.exit_margin = self.get_exit_margin()
 
         self.testing_ratio = self.dlg.checkBox_testing_ratio.isChecked()
+        fused = self.dlg.checkBox_fused_training.isChecked()
 
-        if (self.testing_ratio):
-            self.calculate_features_task = CalculateFeaturesTask(
-                directory = self.dlg.lineEdit_testingDirectory.text(),
-                features = self.features,
-                lumberjack_instance = self)
+        if (self.testing_ratio and not fused):
+            self.calculate_features_task = self.create_calculate_features_task(
+                self.dlg.lineEdit_testingDirectory.text(), required_names)
 
         self.test_task = TestTask(
             directory = self.dlg.lineEdit_testingDirectory.text(),
             classifier = self.classifier,
             testing_ratio = self.testing_ratio,
-            lumberjack_instance = self)
+            lumberjack_instance = self,
+            spill_samples = self.dlg.checkBox_spill_samples.isChecked(),
+            features = self.features,
+            fused = fused,
+            required_names = required_names,
+            sample_cache = self.dlg.checkBox_sample_cache.isChecked())
 
-        if (self.testing_ratio):
+        if (self.testing_ratio and not fused):
             self.test_task.addSubTask(self.calculate_features_task, [], QgsTask.ParentDependsOnSubTask)
         QgsApplication.taskManager().addTask(self.test_task)
 
@@ -447,28 +558,44 @@ class Lumberjack:
 
     def predict(self):
         self.dlg.hide()
-        self.create_features_array()
-
-        self.calculate_features_task = CalculateFeaturesTask(
-            directory = self.dlg.lineEdit_predictionDirectoy.text(),
-            features = self.features,
-            lumberjack_instance = self)
+        required_names = self.create_classifier_features()
+        fused = self.dlg.checkBox_fused_prediction.isChecked()
+        self.classifier.exit_margin = self.get_exit_margin()
 
         self.predict_task = PredictTask(
             directory = self.dlg.lineEdit_predictionDirectoy.text(),
             classifier = self.classifier,
-            lumberjack_instance = self)
-
-        self.predict_task.addSubTask(self.calculate_features_task, [], QgsTask.ParentDependsOnSubTask)
+            lumberjack_instance = self,
+            tile_size = self.dlg.spinBox_prediction_tile.value(),
+            prediction_workers = self.dlg.spinBox_prediction_workers.value(),
+            scene_workers = self.dlg.spinBox_prediction_scenes.value(),
+            cache_size = self.dlg.spinBox_prediction_cache.value() * 1024 * 1024,
+            features = self.features,
+            fused = fused,
+            required_names = required_names)
+
+        # When the features are calculated while predicting, no feature
+        # files are written
+        if not fused:
+            self.calculate_features_task = self.create_calculate_features_task(
+                self.dlg.lineEdit_predictionDirectoy.text(), required_names)
+            self.predict_task.addSubTask(self.calculate_features_task, [], QgsTask.ParentDependsOnSubTask)
         QgsApplication.taskManager().addTask(self.predict_task)
 
 
-    def notify_training(self, start_time, classes, total_samples, time):
+    def notify_training(
+            self, start_time, classes, total_samples, time, training_log=None, distribution=None):
         self.dlg.plainTextEdit.appendPlainText("======== {} ========".format(str(start_time)))
         self.dlg.plainTextEdit.appendPlainText("Classes when training:")
         for i in classes:
             self.dlg.plainTextEdit.appendPlainText("- " + str(i))
         self.dlg.plainTextEdit.appendPlainText("Total samples: {}".format(str(total_samples)))
+        if distribution is not None:
+            self.dlg.plainTextEdit.appendPlainText("Samples of each class:")
+            for line in distribution:
+                self.dlg.plainTextEdit.appendPlainText("- " + line)
+        for message in training_log or []:
+            self.dlg.plainTextEdit.appendPlainText(message)
         self.dlg.plainTextEdit.appendPlainText("Finished in {} seconds".format(str(time)))
         self.dlg.plainTextEdit.appendPlainText("")
         self.dlg.open()
@@ -490,8 +617,29 @@ class Lumberjack:
         self.dlg.open()
 
 
-    def notify_prediction(self, start_time, output_files, time):
+    def evaluate(self):
+        self.dlg.hide()
+        self.evaluate_task = EvaluateTask(
+            directory = self.dlg.lineEdit_testingDirectory.text(),
+            lumberjack_instance = self)
+        QgsApplication.taskManager().addTask(self.evaluate_task)
+
+
+    def notify_evaluation(self, start_time, report, time):
+        self.dlg.plainTextEdit.appendPlainText("======== {} ========".format(str(start_time)))
+        self.dlg.plainTextEdit.appendPlainText("Evaluation of the predictions:")
+        for i in report:
+            self.dlg.plainTextEdit.appendPlainText(str(i))
+        self.dlg.plainTextEdit.appendPlainText("Finished in {} seconds".format(str(time)))
+        self.dlg.plainTextEdit.appendPlainText("")
+
+        self.dlg.open()
+
+
+    def notify_prediction(self, start_time, output_files, time, tree_evaluations=None):
         self.dlg.plainTextEdit.appendPlainText("======== {} ========".format(str(start_time)))
+        if tree_evaluations is not None:
+            self.dlg.plainTextEdit.appendPlainText(tree_evaluations)
         self.dlg.plainTextEdit.appendPlainText("Finished prediction in {} seconds".format(str(time)))
         self.iface.messageBar().pushMessage("Success", "Output file/s created", level=Qgis.Success, duration=5)
         if self.dlg.checkBox_addFile.isChecked():
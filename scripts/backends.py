@@ -0,0 +1,203 @@
+from sklearn.ensemble import RandomForestClassifier
+from sklearn.ensemble import ExtraTreesClassifier
+from sklearn.ensemble import HistGradientBoostingClassifier
+from sklearn.inspection import permutation_importance
+import numpy as np
+import copy
+from .compiled_forest import CompiledForest
+
+
+# Samples used to calculate the permutation importances of the models
+# that don't give importances themselves
+IMPORTANCE_SAMPLES = 10000
+IMPORTANCE_REPEATS = 5
+# Boosting takes max_features since scikit-learn 1.4, older versions (as the
+# ones bundled with some QGIS installs) use every feature
+BOOSTING_MAX_FEATURES = "max_features" in HistGradientBoostingClassifier().get_params()
+# Trees evaluated at once by the early exit, before retiring the pixels
+# whose class is decided
+EXIT_TREE_BATCH = 10
+# Added to the early exit test so the rounding of the sums of votes never
+# changes its result
+EXIT_TOLERANCE = 1e-9
+
+
+class ForestBackend:
+    # Forest of trees from scikit-learn. With growth_step > 0 the forest is
+    # grown in stages of trees, with bootstrap and out-of-bag accuracy, until
+    # it stops improving
+    NAME = None
+    ESTIMATOR = None
+    EARLY_EXIT = True
+
+    def check_parameters(self, parameters):
+        if (parameters["max_samples"] is not None and not parameters["bootstrap"]
+                and parameters["growth_step"] == 0):
+            raise ValueError("max_samples can only be used with bootstrap")
+
+
+    def create(self, parameters, **overrides):
+        forest_parameters = {
+            name: parameters[name]
+            for name in ["n_estimators", "max_depth", "min_samples_leaf", "max_features", "n_jobs", "bootstrap"]}
+        if parameters["bootstrap"]:
+            forest_parameters["max_samples"] = parameters["max_samples"]
+        forest_parameters.update(overrides)
+        return self.ESTIMATOR(**forest_parameters)
+
+
+    def fit(self, parameters, X, y, log):
+        if parameters["growth_step"] > 0:
+            return self.grow(parameters, X, y, log)
+        return self.create(parameters).fit(X, y)
+
+
+    def grow(self, parameters, X, y, log):
+        # Adds growth_step trees at a time, and stops when the out-of-bag
+        # accuracy doesn't improve anymore
+        n_estimators = parameters["n_estimators"]
+        step = parameters["growth_step"]
+        model = self.create(
+            parameters, n_estimators=min(step, n_estimators), warm_start=True, oob_score=True,
+            bootstrap=True, max_samples=parameters["max_samples"])
+        previous_score = None
+        while True:
+            model.fit(X, y)
+            score = model.oob_score_
+            log("Trees: {}, out-of-bag accuracy: {:.4f}".format(model.n_estimators, score))
+            if model.n_estimators >= n_estimators:
+                break
+            if (previous_score is not None) and (score - previous_score < parameters["growth_tolerance"]):
+                log("Accuracy stopped improving, using {} trees".format(model.n_estimators))
+                break
+            previous_score = score
+            model.n_estimators = min(model.n_estimators + step, n_estimators)
+        return model
+
+
+    def feature_importances(self, model, parameters, X, y):
+        return model.feature_importances_
+
+
+    def predict_early_exit(self, model, X, margin):
+        # Adds the probabilities of the classes given by the trees, a batch
+        # at a time, and only for the pixels still undecided. Each tree adds
+        # at most 1 to a class, so once the two most voted classes of a
+        # pixel differ by more than the trees left, its class can't change
+        # anymore. margin is the share of the votes of the trees left that
+        # may be given up: 0 gives the same classes as every tree, higher
+        # margins stop sooner. Returns the classes and how many pairs of
+        # pixel and tree were evaluated
+        trees = len(model.estimators_)
+        sums = np.zeros((X.shape[0], len(model.classes_)), dtype=np.float64)
+        active = np.arange(X.shape[0])
+        evaluated = 0
+        # A forest with the trees of the batch, so they are evaluated by
+        # the threads of scikit-learn as the whole forest would be
+        batch_forest = copy.copy(model)
+        for start in range(0, trees, EXIT_TREE_BATCH):
+            batch_forest.estimators_ = model.estimators_[start:start+EXIT_TREE_BATCH]
+            batch_forest.n_estimators = len(batch_forest.estimators_)
+            X_active = X if active.size == X.shape[0] else X[active]
+            sums[active] += batch_forest.predict_proba(X_active) * batch_forest.n_estimators
+            evaluated += active.size * batch_forest.n_estimators
+
+            remaining = trees - start - batch_forest.n_estimators
+            if remaining == 0 or len(model.classes_) < 2:
+                continue
+            top = np.partition(sums[active], -2, axis=1)
+            decided = top[:, -1] - top[:, -2] > (1 - margin) * remaining + EXIT_TOLERANCE * trees
+            active = active[~decided]
+            if active.size == 0:
+                break
+        return model.classes_.take(np.argmax(sums, axis=1)), evaluated
+
+
+    def compile(self, model):
+        return CompiledForest.from_forest(model)
+
+
+class RandomForestBackend(ForestBackend):
+    NAME = "random_forest"
+    ESTIMATOR = RandomForestClassifier
+
+
+class ExtraTreesBackend(ForestBackend):
+    # Splits are chosen at random instead of searching the best one, so it
+    # trains faster than a random forest
+    NAME = "extra_trees"
+    ESTIMATOR = ExtraTreesClassifier
+
+
+class HistGradientBoostingBackend:
+    # Gradient boosting over binned features. n_estimators is the amount of
+    # boosting iterations (one tree per class each), and with growth_step > 0
+    # it stops early when the accuracy of the validation samples improves
+    # less than growth_tolerance over growth_step iterations. It uses all
+    # the cores (OpenMP), so n_jobs only applies to the importances
+    NAME = "hist_gradient_boosting"
+    # Each tree corrects the previous ones, so the class is never decided
+    # before the last one
+    EARLY_EXIT = False
+
+    def check_parameters(self, parameters):
+        pass
+
+
+    def create(self, parameters, **overrides):
+        # Boosting takes the fraction of features of each split, so with
+        # sqrt or log2 it is given when fitting, knowing the features
+        model_parameters = {
+            "max_iter": parameters["n_estimators"],
+            "max_depth": parameters["max_depth"],
+            "min_samples_leaf": parameters["min_samples_leaf"],
+            "early_stopping": parameters["growth_step"] > 0}
+        if parameters["growth_step"] > 0:
+            model_parameters["n_iter_no_change"] = parameters["growth_step"]
+            model_parameters["tol"] = parameters["growth_tolerance"]
+            model_parameters["scoring"] = "accuracy"
+        model_parameters.update(overrides)
+        return HistGradientBoostingClassifier(**model_parameters)
+
+
+    def fit(self, parameters, X, y, log):
+        overrides = {}
+        if parameters["max_features"] in ["sqrt", "log2"]:
+            if BOOSTING_MAX_FEATURES:
+                features = X.shape[1]
+                count = np.sqrt(features) if parameters["max_features"] == "sqrt" else np.log2(features)
+                overrides["max_features"] = max(1, int(count)) / features
+            else:
+                log("Gradient boosting needs scikit-learn 1.4 or newer for max_features, every feature is used")
+        model = self.create(parameters, **overrides).fit(X, y)
+        if parameters["growth_step"] > 0:
+            log("Iterations: {}, validation accuracy: {:.4f}".format(
+                model.n_iter_, model.validation_score_[-1]))
+        return model
+
+
+    def feature_importances(self, model, parameters, X, y):
+        # Boosted trees don't give importances, so they are measured by how
+        # much the accuracy drops shuffling each feature, on some of the
+        # training samples
+        if X.shape[0] > IMPORTANCE_SAMPLES:
+            chosen = np.sort(np.random.default_rng(0).choice(X.shape[0], IMPORTANCE_SAMPLES, replace=False))
+            X, y = X[chosen], y[chosen]
+        result = permutation_importance(
+            model, X, y, n_repeats=IMPORTANCE_REPEATS, random_state=0, n_jobs=parameters["n_jobs"])
+        return result.importances_mean
+
+
+    def compile(self, model):
+        # Only forests can be compiled
+        return None
+
+
+BACKENDS = [RandomForestBackend, ExtraTreesBackend, HistGradientBoostingBackend]
+
+
+def get_backend(name):
+    for backend in BACKENDS:
+        if backend.NAME == name:
+            return backend()
+    raise ValueError("Unknown classifier: {}".format(name))
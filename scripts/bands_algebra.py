@@ -2,22 +2,18 @@ from argparse import ArgumentParser
 from osgeo import gdal
 import numpy as np
 import time
+try:
+    from .output_profile import create_tiff
+except ImportError:
+    # Run as a script from the command line
+    from output_profile import create_tiff
 
 
-def obtain_features(dataset, file_output):
-    rasterCount = dataset.RasterCount
-
-    # Read bands into data array
-    data=[]
-    for band in range(rasterCount):
-        band += 1
-        srcband = dataset.GetRasterBand(band)
-        if srcband is None:
-            continue
-        data.append(srcband.ReadAsArray().astype(np.float))
-
-    srcband.FlushCache()
-    srcband = None
+def calculate_features(data):
+    # data is a (bands, rows, columns) array. Returns the mean, the standard
+    # deviation and the slope and intercept of the line fitted to the values
+    # of the bands of each pixel
+    rasterCount = data.shape[0]
 
     # Calculate meand and std using numpy
     mean = np.mean(data, axis=0)
@@ -26,7 +22,6 @@ def obtain_features(dataset, file_output):
     # Obtain data dimension (the image dimension) and gives a new shape
     dim = np.shape(data)
     data = np.reshape(data,(rasterCount,dim[1]*dim[2]))
-    print('Image dimension:', dim)
 
     # Calculates slope and intersection of the fitted line
     x = np.arange(1,rasterCount+1)
@@ -36,11 +31,32 @@ def obtain_features(dataset, file_output):
     m, c = np.linalg.lstsq(A,data, rcond=None)[0]
     m = np.reshape(m,(dim[1],dim[2]))
     c = np.reshape(c,(dim[1],dim[2]))
+    return mean, std, m, c
+
+
+def obtain_features(dataset, file_output):
+    rasterCount = dataset.RasterCount
+
+    # Read bands into data array
+    data=[]
+    for band in range(rasterCount):
+        band += 1
+        srcband = dataset.GetRasterBand(band)
+        if srcband is None:
+            continue
+        data.append(srcband.ReadAsArray().astype(np.float64))
+
+    srcband.FlushCache()
+    srcband = None
+
+    data = np.array(data)
+    dim = np.shape(data)
+    print('Image dimension:', dim)
+    mean, std, m, c = calculate_features(data)
     data = None
 
     # Write the four arrays into the new image
-    driver = gdal.GetDriverByName('GTiff')
-    outRaster = driver.Create(file_output, dim[2], dim[1], 4, gdal.GDT_Float32)
+    outRaster = create_tiff(file_output, dim[2], dim[1], 4, gdal.GDT_Float32, "feature")
     outRaster.SetGeoTransform(dataset.GetGeoTransform())#Edito la georeferencia
     outRaster.SetProjection(dataset.GetProjection())
     # For each array, a band is written
@@ -0,0 +1,74 @@
+from osgeo import gdal_array
+import numpy as np
+
+
+# Rasters are processed in full width strips. The height of a strip follows
+# the block height of the band being read, but it is never smaller than
+# MIN_STRIP_LINES (striped GeoTIFFs usually have one line per block) nor
+# bigger than MAX_STRIP_LINES (files written as a single strip)
+MIN_STRIP_LINES = 64
+MAX_STRIP_LINES = 1024
+
+
+def strip_height(band):
+    block_ysize = band.GetBlockSize()[1]
+    if block_ysize >= MAX_STRIP_LINES:
+        return MAX_STRIP_LINES
+    # Round up to a whole number of blocks
+    blocks = max(1, -(-MIN_STRIP_LINES // block_ysize))
+    return block_ysize * blocks
+
+
+def strip_windows(ysize, lines):
+    # Yields the offset and height of each strip
+    for yoff in range(0, ysize, lines):
+        yield yoff, min(lines, ysize - yoff)
+
+
+def block_windows(xsize, ysize, block_xsize, block_ysize):
+    # Yields the offset and size of each block, row by row
+    for yoff in range(0, ysize, block_ysize):
+        for xoff in range(0, xsize, block_xsize):
+            yield xoff, yoff, min(block_xsize, xsize - xoff), min(block_ysize, ysize - yoff)
+
+
+def roi_windows(roi, block_size):
+    # Yields the windows of a block grid that have labelled pixels (roi > 0),
+    # each one shrunk to the bounding box of those pixels. Reading only these
+    # windows makes the cost of extracting samples depend on the amount of
+    # labelled pixels and not on the size of the image
+    for xoff, yoff, xsize, ysize in block_windows(roi.shape[1], roi.shape[0], block_size, block_size):
+        mask = roi[yoff:yoff+ysize, xoff:xoff+xsize] > 0
+        if not mask.any():
+            continue
+        rows = np.flatnonzero(mask.any(axis=1))
+        columns = np.flatnonzero(mask.any(axis=0))
+        yield (
+            xoff + columns[0], yoff + rows[0],
+            columns[-1] - columns[0] + 1, rows[-1] - rows[0] + 1)
+
+
+def get_buffer(buffers, dtype, ysize, xsize, max_ysize, max_xsize):
+    # Buffers are kept in a dictionary given by the caller so they are
+    # allocated once, with the biggest window size, and reused for every
+    # window and every band of the same type. Smaller windows (at the edges
+    # of the raster) use the beginning of the buffer so they stay contiguous
+    key = (np.dtype(dtype).str, max_ysize, max_xsize)
+    if key not in buffers:
+        buffers[key] = np.empty(max_ysize * max_xsize, dtype=dtype)
+    return buffers[key][:ysize * xsize].reshape(ysize, xsize)
+
+
+def copy_window(band, outband, xoff, yoff, xsize, ysize, buffers, max_ysize, max_xsize):
+    dtype = gdal_array.GDALTypeCodeToNumericTypeCode(band.DataType)
+    buffer = get_buffer(buffers, dtype, ysize, xsize, max_ysize, max_xsize)
+    data = band.ReadAsArray(xoff, yoff, xsize, ysize, buf_obj=buffer)
+    outband.WriteArray(data, xoff, yoff)
+
+
+def copy_band(band, outband, buffers):
+    # Copies a band strip by strip. Peak memory is given by the strip size,
+    # not by the size of the raster
+    lines = strip_height(band)
+    for yoff, ysize in strip_windows(band.YSize, lines):
+        copy_window(band, outband, 0, yoff, band.XSize, ysize, buffers, lines, band.XSize)
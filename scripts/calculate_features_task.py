@@ -4,16 +4,126 @@ import numpy as np
 import time
 import datetime
 from .preprocess_task import *
+from .feature_stack import write_stack_metadata
+from .features import match_names
 from .. import Lumberjack
 
 
 class CalculateFeaturesTask(PreProcessTask):
-    def __init__(self, directory, features, lumberjack_instance):
+    def __init__(self, directory, features, lumberjack_instance, virtual_stack=False, workers=1,
+                 incremental=False, required_names=None, list_only=False, stack_suffix=None):
         super().__init__("Calculate Features Task", QgsTask.CanCancel)
         self.directory = directory
         self.features = features
+        self.virtual_stack = virtual_stack
+        self.workers = workers
+        self.incremental = incremental
+        # The stack has only these features, in this order (e.g. the ones
+        # a classifier was trained with). Every feature when None
+        self.required_names = required_names
+        # Only the names of the features are listed, nothing is calculated
+        self.list_only = list_only
+        # The stack is written as a VRT with this suffix instead of as the
+        # stack of the image (e.g. for the seasonal analysis)
+        self.stack_suffix = stack_suffix
         self.lumberjack_instance = lumberjack_instance
         self.feature_names = []
+        self.total_features = 0
+
+
+    def build_stack(self, image):
+        file_name_stack = os.path.join(
+            image.path, "{}{}".format(image.base_name, Lumberjack.STACK_SUFFIX))
+        file_name_vrt = os.path.join(
+            image.path, "{}{}".format(image.base_name, Lumberjack.STACK_VRT_SUFFIX))
+
+        # Every feature of the image, as a (file, band) pair, or the value
+        # of scalar features, which have no file
+        sources = []
+        names = []
+        for feature in self.features:
+            if feature.is_scalar:
+                sources.extend([(None, value) for value in feature.get_scalar_values(image)])
+            else:
+                sources.extend(self.get_band_sources([feature.get_file_name(image)]))
+            names.extend(feature.feature_names)
+        if len(names) != len(sources):
+            raise ValueError("Found {} features in {} but {} names".format(len(sources), image.path, len(names)))
+
+        # The stack follows the order of the required names
+        if self.required_names is not None:
+            order = match_names(names, self.required_names)
+            sources = [sources[i] for i in order]
+            names = [names[i] for i in order]
+        self.total_features = len(names)
+        if not self.feature_names:
+            self.feature_names = names
+
+        # Scalar features are not stored as bands, only their position in
+        # the feature vector and their value
+        band_sources = []
+        band_names = []
+        scalar_features = []
+        for position, ((file_name, value), name) in enumerate(zip(sources, names)):
+            if file_name is None:
+                scalar_features.append((position, value))
+            else:
+                band_sources.append((file_name, value))
+                band_names.append(name)
+        files = []
+        for file_name, band_number in band_sources:
+            if file_name not in files:
+                files.append(file_name)
+
+        virtual = self.virtual_stack
+        reference_file = None
+        if self.stack_suffix is not None:
+            virtual = True
+            output_file = os.path.join(image.path, "{}{}".format(image.base_name, self.stack_suffix))
+            # The analysed feature may be a scalar one (e.g. the day), the
+            # stack takes the size of the merged image then
+            reference_file = os.path.join(image.path, "{}{}".format(image.base_name, Lumberjack.MERGED_SUFFIX))
+            if reference_file not in files:
+                files.append(reference_file)
+        else:
+            # Only one kind of stack is kept so readers never pick up a
+            # stale one
+            if virtual:
+                output_file, other_file = file_name_vrt, file_name_stack
+            else:
+                output_file, other_file = file_name_stack, file_name_vrt
+            if os.path.exists(other_file):
+                os.remove(other_file)
+
+        manifest = None
+        parameters = {
+            "virtual": virtual, "scalar_features": scalar_features, "names": names,
+            "bands": [[os.path.basename(file_name), band_number] for file_name, band_number in band_sources]}
+        if self.incremental:
+            manifest = Manifest(get_manifest_file_name(image))
+            if manifest.is_up_to_date(output_file, files, parameters, STACK_VERSION):
+                print("Up to date: " + output_file)
+                return
+
+        if virtual:
+            self.build_virtual_stack(band_sources, output_file, gdal.GDT_Float32, band_names, reference_file)
+        else:
+            self.merge_images(band_sources, output_file, gdal.GDT_Float32, band_names)
+        write_stack_metadata(output_file, scalar_features, names)
+
+        if manifest is not None:
+            manifest.update(output_file, files, parameters, STACK_VERSION)
+            manifest.save()
+
+
+    def list_feature_names(self, places):
+        # Names of the features of the first image, without calculating them
+        for place in places:
+            for image in place.images:
+                for feature in self.features:
+                    self.feature_names.extend(feature.list_names(image))
+                self.total_features = len(self.feature_names)
+                return
 
 
     def run(self):
@@ -25,23 +135,19 @@ class CalculateFeaturesTask(PreProcessTask):
             self.start_time = time.time()
 
             places = self.obtain_places(self.directory)
-            self.pre_process_images(places)
-
-            for place in places:
-                for image in place.images:
-                    file_name_stack = os.path.join(
-                        image.path, "{}{}".format(
-                            image.base_name, Lumberjack.STACK_SUFFIX))
-                    
-                    files = []
-                    for feature in self.features:
-                        files.append(feature.get_file_name(image))
-
-                    self.total_features = self.calculate_total_features(files)
-                    self.merge_images(files, file_name_stack, self.total_features, gdal.GDT_Float32)
-            
-            for feature in self.features:
-                self.feature_names.extend(feature.feature_names)
+            self.select_required_features(places)
+
+            if self.list_only:
+                self.list_feature_names(places)
+            else:
+                if not self.pre_process_images(places):
+                    return False
+
+                for place in places:
+                    for image in place.images:
+                        if self.isCanceled():
+                            return False
+                        self.build_stack(image)
 
             self.elapsed_time = time.time() - self.start_time
             print("Finished in {} seconds".format(str(self.elapsed_time)))
@@ -70,7 +176,8 @@ class CalculateFeaturesTask(PreProcessTask):
                 Lumberjack.MESSAGE_CATEGORY, Qgis.Success)
             self.lumberjack_instance.notify_calculate_features(
                 self.start_time_str, self.total_features,
-                self.feature_names, self.directory, self.elapsed_time)
+                self.feature_names, self.directory, self.elapsed_time,
+                update_features = self.required_names is None)
         else:
             if self.exception is None:
                 QgsMessageLog.logMessage(
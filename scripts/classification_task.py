@@ -1,44 +1,134 @@
 from .preprocess_task import *
+from .output_profile import create_tiff, BLOCK_SIZE
+from .feature_stack import FeatureStack
+from .fused_features import FusedFeatures, fused_fingerprint
+from .sample_cache import SampleCache, roi_files, roi_hash
+from .manifest import Manifest, file_signature
+from .features import resolve_feature_names
+from . import blocks
+
+
+# Version of the code that rasterizes the ROI, to find outdated rasters
+ROI_VERSION = 1
 
 
 class ClassificationTask(PreProcessTask):
     def __init__(self, description, task):
         super().__init__(description, task)
+        # When fused, the features are calculated only around the samples
+        # instead of reading the stacks
+        self.fused = False
+        # Samples of previous runs are reused when nothing they depend on
+        # changed
+        self.sample_cache = False
+        # When set, the samples pass through it before being added
+        self.sampler = None
+
+
+    def get_sample_key(self, place, image, place_roi_hash):
+        # Everything the samples of an image depend on
+        if self.fused:
+            source = fused_fingerprint(self.features, image, self.get_band_files(image))
+        else:
+            source = FeatureStack(self.get_stack_file_name(image)).fingerprint()
+        return {
+            "roi": place_roi_hash,
+            "extension": file_signature(place.extension_file_path),
+            "fused": self.fused,
+            "source": source,
+            "features": [
+                [type(feature).__name__, feature.VERSION, feature.get_parameters()]
+                for feature in self.features],
+            "required_names": self.required_names}
+
+
+    def extract_samples(self, image, roi, windows, extension):
+        if self.fused:
+            stack = FusedFeatures(
+                self.features, image, self.crop_bands(image, extension), self.required_names)
+        else:
+            stack = FeatureStack(self.get_stack_file_name(image))
+
+        # Create X and y that's going have all the features and labels to be
+        # easily used later with the classifier. Scalar features are only
+        # broadcast over the selected samples
+        return stack.read_samples(roi, windows, BLOCK_SIZE)
 
 
     def filter_samples(self, places):
         for place in places:
             roi_dataset = gdal.Open(place.vector_file_path[:-4]+".tif", gdal.GA_ReadOnly)
             roi = roi_dataset.GetRasterBand(1).ReadAsArray().astype(np.uint8)
-            y = roi[roi > 0]
+            windows = None
+            extension = None
+            if self.fused:
+                extension = self.calculate_extension(place.extension_file_path)
+            if self.sample_cache:
+                place_roi_hash = roi_hash(place.vector_file_path)
 
             for image in place.images:
-                file_name_stack = os.path.join(image.path, "{}{}".format(image.base_name, Lumberjack.STACK_SUFFIX))
+                samples = None
+                if self.sample_cache:
+                    cache = SampleCache(image)
+                    key = cache.create_key(self.get_sample_key(place, image, place_roi_hash))
+                    samples = cache.load(key)
+
+                if samples is None:
+                    if windows is None:
+                        # Only the windows with labelled pixels are read
+                        windows = list(blocks.roi_windows(roi, BLOCK_SIZE))
+                        print("Reading {} windows with samples".format(len(windows)))
+                    X, y = self.extract_samples(image, roi, windows, extension)
+                    if self.sample_cache:
+                        cache.save(key, X, y)
+                else:
+                    X, y = samples
+                    if self.fused:
+                        # The features were not prepared, but their names
+                        # are needed by the classifier
+                        resolve_feature_names(self.features, image)
+
+                print("X size: {}".format(X.shape))
+                print("y size: {}".format(y.shape))
 
-                dataset = gdal.Open(file_name_stack, gdal.GA_ReadOnly)
+                self.collect_samples(X, y)
+                self.finish_image()
+            self.finish_place()
+        if self.sampler is not None:
+            self.sampler.finish()
 
-                features_array = np.zeros(
-                    (roi_dataset.RasterYSize, roi_dataset.RasterXSize, dataset.RasterCount),
-                    dtype=np.float32)
-                print("Shape array features: {}".format(features_array.shape))
 
-                for band_number in range(dataset.RasterCount):
-                    band = dataset.GetRasterBand(band_number + 1)
-                    features_array[:, :, band_number] = band.ReadAsArray()
+    def collect_samples(self, X, y):
+        if self.sampler is None:
+            self.add_samples(X, y)
+        else:
+            self.sampler.add(X, y)
 
-                # Create X and y that's going have all the features and
-                # labels to be easily used later with the classifier
-                X = features_array[roi > 0, :]
 
-                print("X size: {}".format(X.shape))
-                print("y size: {}".format(y.shape))
+    def finish_image(self):
+        if self.sampler is not None:
+            self.sampler.finish_scene()
+
 
-                self.add_samples(X, y)
+    def finish_place(self):
+        if self.sampler is not None:
+            self.sampler.finish_place()
 
 
     def rasterize_vector_files(self, places):
         for place in places:
             rasterized_vector_file = place.vector_file_path[:-4] + ".tif"
+            # The raster is only created again when the shapefile or the
+            # extension changed
+            manifest = None
+            inputs = roi_files(place.vector_file_path) + [place.extension_file_path]
+            if self.sample_cache:
+                manifest = Manifest(os.path.join(
+                    place.directory_path,
+                    "{}{}".format(os.path.basename(place.directory_path), Lumberjack.MANIFEST_SUFFIX)))
+                if manifest.is_up_to_date(rasterized_vector_file, inputs, {}, ROI_VERSION):
+                    print("Up to date: " + rasterized_vector_file)
+                    continue
             print("Creating ROI: " + rasterized_vector_file)
 
             # Create a new file changing the extension of the shapefile for a
@@ -47,9 +137,9 @@ class ClassificationTask(PreProcessTask):
             tiff_dataset = gdal.Open(place.extension_file_path, gdal.GA_ReadOnly)
             if os.path.exists(rasterized_vector_file):
                 os.remove(rasterized_vector_file)
-            out_raster_ds = gdal.GetDriverByName('GTiff').Create(
+            out_raster_ds = create_tiff(
                 rasterized_vector_file, tiff_dataset.RasterXSize,
-                tiff_dataset.RasterYSize, 1, gdal.GDT_Byte)
+                tiff_dataset.RasterYSize, 1, gdal.GDT_Byte, "mask")
 
             # Set the ROI image's projection and extent to the ones
             # taken from the input extent file
@@ -72,20 +162,27 @@ class ClassificationTask(PreProcessTask):
             out_raster_ds = None
             if status != 0:
                 print("Error creating rasterized tiff")
+            elif manifest is not None:
+                manifest.update(rasterized_vector_file, inputs, {}, ROI_VERSION)
+                manifest.save()
 
 
     def check_classes(self, places):
         self.classes = []
         self.total_samples = 0
+        # Pixels of each class in the ROI and amount of scenes of each place
+        self.places_counts = []
         for place in places:
             rasterized_vector_file = place.vector_file_path[:-4] + ".tif"
             roi_ds = gdal.Open(rasterized_vector_file, gdal.GA_ReadOnly)
             roi = roi_ds.GetRasterBand(1).ReadAsArray().astype(np.uint8)
 
-            classes = np.unique(roi)
+            classes, counts = np.unique(roi, return_counts=True)
             # Iterate over all class labels in the ROI image
-            for c in classes:
-                self.classes.append('Class {c} contains {n} pixels'.format(c=c, n=(roi == c).sum()))
+            for c, n in zip(classes, counts):
+                self.classes.append('Class {c} contains {n} pixels'.format(c=c, n=n))
+            self.places_counts.append(
+                ({int(c): int(n) for c, n in zip(classes, counts) if c > 0}, len(place.images)))
 
             # Find how many non-zero entries there are
             n_samples = (roi > 0).sum()
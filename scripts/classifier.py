@@ -1,6 +1,4 @@
 from argparse import ArgumentParser
-from sklearn.ensemble import RandomForestClassifier
-from sklearn.model_selection import train_test_split
 from sklearn.metrics import accuracy_score
 from sklearn.metrics import confusion_matrix
 from sklearn.metrics import precision_score
@@ -11,74 +9,169 @@ from osgeo import gdal_array
 from osgeo import ogr
 import numpy as np
 import pickle
+import threading
+import hashlib
+import json
+import os
+import collections
+import concurrent.futures
+from .output_profile import create_tiff
+from .feature_stack import FeatureStack
+from .sample_store import SampleStore
+from .backends import get_backend
+from .compiled_forest import CompiledForest, COMPILED_FOREST_VERSION
+from .model_file import ModelFile, write_model_file, is_model_file, pickle_model, copy_array
+from . import blocks
+
+
+# Images are predicted in square tiles of this size, so the memory used
+# depends on the tile and not on the size of the image
+PREDICTION_TILE_SIZE = 1024
+
+# Parameters of the model. backend is the kind of model (see backends.py).
+# growth_step > 0 grows a forest in stages of that many trees (with
+# bootstrap and out-of-bag accuracy) until it has n_estimators trees or the
+# accuracy improves less than growth_tolerance
+DEFAULT_PARAMETERS = {
+    "backend": "random_forest",
+    "n_estimators": 100,
+    "max_depth": None,
+    "min_samples_leaf": 1,
+    "max_features": "sqrt",
+    "n_jobs": -1,
+    "bootstrap": False,
+    "max_samples": None,
+    "growth_step": 0,
+    "growth_tolerance": 0.001}
 
 
 class Classifier:
     def __init__(self):
-        self.__X_train = None
-        self.__y_train = None
-        self.__X_test = None
-        self.__y_test = None
-        self.__rf = None
+        self.__training_samples = SampleStore()
+        self.__testing_samples = SampleStore()
+        self.__model = None
+        self.__feature_importances = None
+        # Flat arrays of the trees of a forest, only exported for other
+        # tools to read (see compiled_forest.py)
+        self.__forest = None
+        # Model file the classifier was imported from, the large arrays of
+        # the model are mapped from it
+        self.__model_file = None
+        self.__lock = threading.Lock()
+        self.__fingerprint = None
         self.feature_names = []
+        self.parameters = dict(DEFAULT_PARAMETERS)
+        self.backend = get_backend(self.parameters["backend"])
+        self.training_log = []
+        # With a margin, forests stop evaluating the trees of a pixel once
+        # its class is decided (see ForestBackend.predict_early_exit())
+        self.exit_margin = None
+        # Pairs of pixel and tree evaluated and total, with early exit
+        self.tree_evaluations = [0, 0]
 
 
-    def add_samples(self, X, y, X_data, y_labels):
-        if (y_labels is None):
-            X_data = X
-            y_labels = y
-        else:
-            X_data = np.append(X_data, X, axis=0)
-            y_labels = np.append(y_labels, y)
-        return X_data, y_labels
+    def set_parameters(self, **parameters):
+        for name in parameters:
+            if name not in DEFAULT_PARAMETERS:
+                raise ValueError("Unknown parameter of the classifier: {}".format(name))
+        new_parameters = dict(self.parameters, **parameters)
+        backend = get_backend(new_parameters["backend"])
+        backend.check_parameters(new_parameters)
+        self.parameters = new_parameters
+        self.backend = backend
+
+
+    def get_parameters(self):
+        return dict(self.parameters)
+
+
+    def log_training(self, message):
+        print(message)
+        self.training_log.append(message)
+
+
+    def reserve_training_samples(self, total_samples, spill_directory=None):
+        # Knowing the amount of samples beforehand, they are stored without
+        # growing the arrays. With a spill directory they are kept on disk
+        self.__training_samples.close()
+        self.__training_samples = SampleStore(total_samples, spill_directory)
+
+
+    def reserve_testing_samples(self, total_samples, spill_directory=None):
+        self.__testing_samples.close()
+        self.__testing_samples = SampleStore(total_samples, spill_directory)
+
+
+    def release_samples(self):
+        # Spilled samples are deleted with their store
+        self.__training_samples.close()
+        self.__testing_samples.close()
+
+
+    def release_testing_samples(self):
+        self.__testing_samples.close()
 
 
     def add_testing_samples(self,  X, y):
-        self.__X_test, self.__y_test = self.add_samples(X, y, self.__X_test, self.__y_test)
+        self.__testing_samples.add(X, y)
 
 
     def add_training_samples(self, X, y):
-        self.__X_train, self.__y_train = self.add_samples(X, y, self.__X_train, self.__y_train)
+        self.__training_samples.add(X, y)
 
 
     def get_test_size(self):
-        return self.__y_test.shape[0]
+        return len(self.__testing_samples)
 
 
     def fit(self, test_size):
         if (test_size != 0):
-            self.__X_train, self.__X_test, self.__y_train, self.__y_test = (
-                train_test_split(
-                    self.__X_train, self.__y_train, test_size=test_size))
-
-        # Initializes model with n_estimators trees
-        # self.__rf = RandomForestClassifier(n_estimators=500, oob_score=True, n_jobs=-1)
-        self.__rf = RandomForestClassifier(n_estimators=100, bootstrap=False)
+            # Split in place, so spilled training samples are not read into
+            # memory
+            X_train, y_train, X_test, y_test = self.__training_samples.split(test_size)
+            self.__testing_samples.close()
+            self.__testing_samples = SampleStore(y_test.shape[0], self.__training_samples.spill_directory)
+            self.__testing_samples.add(X_test, y_test)
+            X_test = None
+            y_test = None
+        else:
+            X_train, y_train = self.__training_samples.get()
 
+        self.training_log = []
         print("Fitting model to training data...")
-        # Build a forest of trees from the training set (X, y).
-        self.__rf = self.__rf.fit(self.__X_train, self.__y_train)
+        self.__model = self.backend.fit(self.parameters, X_train, y_train, self.log_training)
+        self.__forest = None
+        self.__model_file = None
+        self.__fingerprint = None
+        # Some models need the training samples to measure the importances
+        self.__feature_importances = self.backend.feature_importances(
+            self.__model, self.parameters, X_train, y_train)
+
+        # Training samples are not needed anymore
+        X_train = None
+        y_train = None
+        self.__training_samples.close()
 
 
     def calculate_metrics(self):
         out = []
-        y_pred = self.__rf.predict(self.__X_test)
+        X_test, y_test = self.__testing_samples.get()
+        y_pred = self.predict(X_test)
 
-        c_matrix = confusion_matrix(self.__y_test, y_pred, labels=[1,2])
+        c_matrix = confusion_matrix(y_test, y_pred, labels=[1,2])
 
         out.append("Confusion Matrix: ")
         out.append(c_matrix)
-        out.append("Accuracy:  " + str(accuracy_score(self.__y_test, y_pred)))
-        out.append("Precision: " + str(precision_score(self.__y_test, y_pred)))
-        out.append("Recall:    " + str(recall_score(self.__y_test, y_pred)))
-        out.append("F1 Score:  " + str(f1_score(self.__y_test, y_pred)))
+        out.append("Accuracy:  " + str(accuracy_score(y_test, y_pred)))
+        out.append("Precision: " + str(precision_score(y_test, y_pred)))
+        out.append("Recall:    " + str(recall_score(y_test, y_pred)))
+        out.append("F1 Score:  " + str(f1_score(y_test, y_pred)))
 
-        # out.append(self.__rf.feature_importances_)
         return out
 
 
     def get_feature_importances(self):
-        return self.__rf.feature_importances_
+        return self.__feature_importances
 
 
     def get_feature_names(self):
@@ -89,45 +182,208 @@ class Classifier:
         self.feature_names = feature_names
 
 
-    def predict_an_image(self, input_image, output_image):
-        dataset = gdal.Open(input_image, gdal.GA_ReadOnly)
-        img_to_predict = np.zeros((dataset.RasterYSize, dataset.RasterXSize, dataset.RasterCount), dtype=np.float32)
-        for band_number in range(dataset.RasterCount):
-            band = dataset.GetRasterBand(band_number + 1)
-            # Read in the band's data into the third dimension of our array
-            img_to_predict[:, :, band_number] = band.ReadAsArray()
-
-        new_shape = (img_to_predict.shape[0] * img_to_predict.shape[1], img_to_predict.shape[2])
-        img_as_array = (img_to_predict[:, :, :dataset.RasterCount].reshape(new_shape))
-        print('Reshaped from {old_shape} to {new_shape}'.format(
-            old_shape=img_to_predict.shape, new_shape=img_as_array.shape))
-
-        # Predicts for each pixel
-        print("Predicting image...")
-        class_prediction = self.__rf.predict(img_as_array)
-
-        # Reshape classification map
-        class_prediction = (class_prediction.reshape(img_to_predict[:, :, 0].shape))
-
-        # Create the result tiff
-        print("Creating output image...")
-        memory_driver = gdal.GetDriverByName('GTiff')
-        out_raster_ds = memory_driver.Create(output_image, dataset.RasterXSize, dataset.RasterYSize, 1, gdal.GDT_Byte)
-        out_raster_ds.SetProjection(dataset.GetProjectionRef())
-        out_raster_ds.SetGeoTransform(dataset.GetGeoTransform())
+    def get_model(self):
+        return self.__model
+
+
+    def get_compiled_forest(self):
+        # None for the models that can't be compiled
+        if self.__forest is None:
+            model = self.get_model()
+            with self.__lock:
+                if self.__forest is None:
+                    self.__forest = self.backend.compile(model)
+        return self.__forest
+
+
+    def predict(self, X):
+        model = self.get_model()
+        if self.exit_margin is not None and self.backend.EARLY_EXIT:
+            predictions, evaluated = self.backend.predict_early_exit(model, X, self.exit_margin)
+            with self.__lock:
+                self.tree_evaluations[0] += evaluated
+                self.tree_evaluations[1] += X.shape[0] * len(model.estimators_)
+            return predictions
+        return model.predict(X)
+
+
+    def get_fingerprint(self):
+        # Hash of the model and everything that changes its predictions.
+        # For model files the hashes of the model are already in the header
+        if self.__fingerprint is None:
+            sha = hashlib.sha256()
+            if self.__model_file is not None:
+                for name in self.__model_file.model_names():
+                    sha.update(self.__model_file.entries[name]["sha256"].encode("utf-8"))
+            else:
+                sha.update(pickle.dumps(self.__model, protocol=pickle.HIGHEST_PROTOCOL))
+            sha.update(json.dumps([self.backend.NAME, list(self.feature_names)]).encode("utf-8"))
+            self.__fingerprint = sha.hexdigest()
+        # Early exit with a margin above 0 may change some pixels
+        if self.exit_margin is not None and self.exit_margin > 0:
+            return "{}-{}".format(self.__fingerprint, self.exit_margin)
+        return self.__fingerprint
+
+
+    def reset_tree_evaluations(self):
+        self.tree_evaluations = [0, 0]
+
+
+    def get_tree_evaluations_report(self):
+        evaluated, total = self.tree_evaluations
+        if total == 0:
+            return None
+        return "Trees evaluated: {} of {} ({:.1f}% saved)".format(
+            evaluated, total, 100.0 * (total - evaluated) / total)
+
+
+    def predict_tile(self, source, tile, xsize, ysize):
+        # Assembles the features of a tile, predicts each pixel and gives
+        # back the classification map of the tile
+        features = source.tile_features(tile)
+        class_prediction = self.predict(features)
+        return class_prediction.reshape(ysize, xsize).astype(np.uint8)
+
+
+    def predict_an_image(
+            self, input_image, output_image, tile_size=PREDICTION_TILE_SIZE, workers=1, is_canceled=None):
+        return self.predict_source(FeatureStack(input_image), output_image, tile_size, workers, is_canceled)
+
+
+    def predict_source(
+            self, source, output_image, tile_size=PREDICTION_TILE_SIZE, workers=1, is_canceled=None):
+        # source gives the features of the image, it is either its stack
+        # (FeatureStack) or the features calculated on the fly (FusedFeatures)
+
+        # Create the result tiff, which is written tile by tile
+        out_raster_ds = create_tiff(
+            output_image, source.RasterXSize, source.RasterYSize, 1, gdal.GDT_Byte, "prediction")
+        out_raster_ds.SetProjection(source.get_projection())
+        out_raster_ds.SetGeoTransform(source.get_geo_transform())
         outband = out_raster_ds.GetRasterBand(1)
-        outband.WriteArray(class_prediction)
-        outband.FlushCache()
-        out_raster_ds = None
 
+        print("Predicting image in tiles of {0}x{0}...".format(tile_size))
+        windows = blocks.block_windows(source.RasterXSize, source.RasterYSize, tile_size, tile_size)
+        completed = True
+        # Tiles are read and written by this thread (GDAL datasets can't be
+        # shared between threads). Their features are assembled and
+        # predicted by the workers. Only a few
+        # tiles are kept in flight so the memory stays bounded, and they are
+        # written in the order they were read
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            pending = collections.deque()
+            for xoff, yoff, xsize, ysize in windows:
+                if is_canceled is not None and is_canceled():
+                    completed = False
+                    break
+                tile = source.read_tile(xoff, yoff, xsize, ysize)
+                pending.append(
+                    (xoff, yoff, executor.submit(self.predict_tile, source, tile, xsize, ysize)))
+                tile = None
+                if len(pending) > workers:
+                    xoff, yoff, future = pending.popleft()
+                    outband.WriteArray(future.result(), xoff, yoff)
+            while pending:
+                xoff, yoff, future = pending.popleft()
+                if completed:
+                    outband.WriteArray(future.result(), xoff, yoff)
+                else:
+                    future.cancel()
 
-    def export_classifier(self, pkl_filename):
-        # Creates a new file that stores the classifier
-        with open(pkl_filename, 'wb') as file:
-            pickle.dump((self.__rf, self.feature_names), file, protocol=pickle.HIGHEST_PROTOCOL)
-
-
-    def import_classifier(self, pkl_filename):
-        # Loads a saved classifier
+        outband.FlushCache()
+        out_raster_ds = None
+        return completed
+
+
+    def export_classifier(self, file_name, compress=False):
+        # Creates a model file that stores the classifier: the kind of model,
+        # its parameters and feature names in the header, and the pickled
+        # model (with its large arrays apart, see pickle_model()), the
+        # importances and the compiled forest as arrays. The model of an
+        # imported classifier is copied as it is, so its fingerprint stays
+        # the same
+        if self.__model_file is not None:
+            arrays = {
+                name: copy_array(self.__model_file.array(name)) for name in self.__model_file.model_names()}
+        else:
+            arrays = pickle_model(self.__model)
+        if (self.__model_file is not None and os.path.exists(file_name)
+                and os.path.samefile(self.__model_file.file_name, file_name)):
+            self.release_model_file()
+        forest = self.get_compiled_forest()
+        classes = forest.classes if forest is not None else self.__model.classes_
+        header = {
+            "backend": self.backend.NAME,
+            "parameters": self.parameters,
+            "feature_names": list(self.feature_names),
+            "classes": [int(c) for c in classes],
+            "forest_version": COMPILED_FOREST_VERSION}
+        arrays["feature_importances"] = np.asarray(self.__feature_importances, dtype=np.float64)
+        if forest is not None:
+            for name, array in forest.get_arrays().items():
+                arrays["forest." + name] = array
+        write_model_file(file_name, header, arrays, compress)
+
+
+    def release_model_file(self):
+        # Reads into memory whatever is mapped from the model file, so it
+        # can be replaced (Windows doesn't replace mapped files)
+        self.get_fingerprint()
+        self.__model = self.__model_file.load_model(copy=True)
+        self.__feature_importances = np.array(self.__feature_importances)
+        if self.__forest is not None:
+            self.__forest = CompiledForest.from_arrays(
+                {name: np.array(array) for name, array in self.__forest.get_arrays().items()})
+        self.__model_file = None
+
+
+    def import_classifier(self, file_name):
+        self.__forest = None
+        self.__model = None
+        self.__model_file = None
+        self.__fingerprint = None
+        if is_model_file(file_name):
+            self.import_model_file(file_name)
+        else:
+            self.import_pickle(file_name)
+
+
+    def import_model_file(self, file_name):
+        # The arrays are mapped, so the model is rebuilt from its pickle
+        # without reading them. Sessions predicting with the same model
+        # share the pages of the arrays mapped as they are (the trees of
+        # forests are still copied by scikit-learn)
+        model_file = ModelFile(file_name)
+        header = model_file.header
+        self.parameters = dict(DEFAULT_PARAMETERS, **header["parameters"])
+        self.parameters["backend"] = header["backend"]
+        self.backend = get_backend(header["backend"])
+        self.feature_names = header["feature_names"]
+        self.__feature_importances = model_file.array("feature_importances")
+        self.__model = model_file.load_model()
+        self.__model_file = model_file
+        if "forest.roots" in model_file and header["forest_version"] == COMPILED_FOREST_VERSION:
+            self.__forest = CompiledForest.from_arrays({
+                name[len("forest."):]: model_file.array(name)
+                for name in model_file.entries if name.startswith("forest.")})
+
+
+    def import_pickle(self, pkl_filename):
+        # Loads a classifier exported as .pkl. Older files only have a random
+        # forest and its feature names
         with open(pkl_filename, 'rb') as file:
-            self.__rf, self.feature_names = pickle.load(file)
+            saved = pickle.load(file)
+        if isinstance(saved, tuple):
+            model, feature_names = saved
+            saved = {
+                "backend": "random_forest",
+                "parameters": {},
+                "model": model,
+                "feature_importances": model.feature_importances_,
+                "feature_names": feature_names}
+        self.parameters = dict(DEFAULT_PARAMETERS, **saved["parameters"])
+        self.parameters["backend"] = saved["backend"]
+        self.backend = get_backend(saved["backend"])
+        self.__model = saved["model"]
+        self.__feature_importances = saved["feature_importances"]
+        self.feature_names = saved["feature_names"]
@@ -0,0 +1,175 @@
+import numpy as np
+
+
+# Must be increased whenever the saved arrays change
+COMPILED_FOREST_VERSION = 1
+COMPILED_FOREST_ARRAYS = ["feature", "threshold", "child", "missing_left", "roots", "values", "classes"]
+# Pixels traversed at once. Each one walks every tree, so the memory used
+# is about PIXEL_BLOCK * trees * 16 bytes
+PIXEL_BLOCK = 4096
+# Levels walked between removing the pairs of pixel and tree that already
+# reached a leaf
+COMPACT_LEVELS = 6
+# Trees walked at once before adding their votes
+TREE_BATCH = 10
+
+
+def round_down_float32(values):
+    # Largest float32 not greater than each value. Features are float32, so
+    # x > threshold gives the same as x > round_down_float32(threshold)
+    rounded = values.astype(np.float32)
+    above = rounded.astype(np.float64) > values
+    rounded[above] = np.nextafter(rounded[above], np.float32(-np.inf))
+    return rounded
+
+
+def breadth_first_order(children_left, children_right):
+    # Nodes of a tree level by level, with both children of a node next to
+    # each other
+    levels = [np.array([0])]
+    frontier = levels[0]
+    while frontier.size > 0:
+        frontier = frontier[children_left[frontier] >= 0]
+        frontier = np.column_stack((children_left[frontier], children_right[frontier])).ravel()
+        levels.append(frontier)
+    return np.concatenate(levels)
+
+
+class CompiledForest:
+    # The trees of a random forest (or extra trees) in a few flat arrays,
+    # the nodes of every tree one after the other. From the node n a pixel
+    # goes to child[n] if its feature[n] is not greater than threshold[n],
+    # and to child[n] + 1 otherwise. Leaves point to themselves (with an
+    # infinite threshold) and values has the probability of each class at
+    # each node. The arrays are exported with the classifier for other
+    # tools to read. Lumberjack itself predicts with the forest, since
+    # walking the trees with NumPy takes about twice as long as the
+    # compiled code of scikit-learn. predict() is kept to check the arrays
+    def __init__(self, feature, threshold, child, missing_left, roots, values, classes):
+        self.feature = feature
+        self.threshold = threshold
+        self.child = child
+        self.missing_left = missing_left
+        self.roots = roots
+        self.values = values
+        self.classes = classes
+
+
+    @classmethod
+    def from_forest(cls, forest):
+        features = []
+        thresholds = []
+        children = []
+        missing_lefts = []
+        roots = []
+        values = []
+        offset = 0
+        for estimator in forest.estimators_:
+            tree = estimator.tree_
+            order = breadth_first_order(tree.children_left, tree.children_right)
+            position = np.empty(tree.node_count, dtype=np.int64)
+            position[order] = np.arange(tree.node_count)
+
+            left = tree.children_left[order]
+            is_leaf = left < 0
+            child = np.arange(tree.node_count) + offset
+            child[~is_leaf] = position[left[~is_leaf]] + offset
+            feature = tree.feature[order].astype(np.int32)
+            feature[is_leaf] = 0
+            threshold = tree.threshold[order].copy()
+            threshold[is_leaf] = np.inf
+            if hasattr(tree, "missing_go_to_left"):
+                missing_left = tree.missing_go_to_left[order].astype(bool)
+            else:
+                missing_left = np.zeros(tree.node_count, dtype=bool)
+
+            # Probability of each class, as the forest averages them
+            value = tree.value[order, 0, :]
+            totals = value.sum(axis=1, keepdims=True)
+            totals[totals == 0] = 1
+
+            features.append(feature)
+            thresholds.append(threshold)
+            children.append(child)
+            missing_lefts.append(missing_left)
+            roots.append(offset)
+            values.append(value / totals)
+            offset += tree.node_count
+
+        return cls(
+            np.concatenate(features),
+            round_down_float32(np.concatenate(thresholds)),
+            np.concatenate(children).astype(np.int32),
+            np.concatenate(missing_lefts),
+            np.array(roots, dtype=np.int32),
+            np.concatenate(values).astype(np.float32),
+            np.array(forest.classes_))
+
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        return cls(*[arrays[name] for name in COMPILED_FOREST_ARRAYS])
+
+
+    def get_arrays(self):
+        return {name: getattr(self, name) for name in COMPILED_FOREST_ARRAYS}
+
+
+    def apply(self, X, roots=None):
+        # Returns the leaf each pixel reaches in each tree (or in the trees
+        # of the given roots), as a (trees, pixels) array. The pixels walk a
+        # tree together, the features of the block are transposed so they
+        # read neighbouring values
+        if roots is None:
+            roots = self.roots
+        pixels = X.shape[0]
+        flat = np.ascontiguousarray(X.T, dtype=np.float32).ravel()
+        has_missing = np.isnan(flat).any()
+        nodes = np.repeat(roots, pixels)
+        offsets = np.tile(np.arange(pixels, dtype=np.int32), len(roots))
+        leaves = np.empty_like(nodes)
+        active = np.arange(nodes.size)
+
+        while active.size > 0:
+            for level in range(COMPACT_LEVELS):
+                values = np.take(flat, offsets + np.take(self.feature, nodes) * pixels)
+                go_right = values > np.take(self.threshold, nodes)
+                children = np.take(self.child, nodes)
+                if has_missing:
+                    # Leaves (which point to themselves) are left alone,
+                    # whatever the value of their feature
+                    missing = np.isnan(values) & (children != nodes)
+                    go_right[missing] = ~self.missing_left[nodes[missing]]
+                nodes = children + go_right
+            done = np.take(self.child, nodes) == nodes
+            leaves[active[done]] = nodes[done]
+            walking = ~done
+            active = active[walking]
+            nodes = nodes[walking]
+            offsets = offsets[walking]
+        return leaves.reshape(len(roots), pixels)
+
+
+    def vote(self, X):
+        # Sums of the probabilities of each class given by the trees, added
+        # a batch of trees at a time
+        sums = np.zeros((X.shape[0], len(self.classes)), dtype=np.float64)
+        for start in range(0, len(self.roots), TREE_BATCH):
+            leaves = self.apply(X, self.roots[start:start+TREE_BATCH])
+            sums += self.values[leaves].sum(axis=0, dtype=np.float64)
+        return sums
+
+
+    def predict_proba(self, X):
+        probabilities = np.empty((X.shape[0], len(self.classes)), dtype=np.float64)
+        for start in range(0, X.shape[0], PIXEL_BLOCK):
+            probabilities[start:start+PIXEL_BLOCK] = self.vote(X[start:start+PIXEL_BLOCK]) / len(self.roots)
+        return probabilities
+
+
+    def predict(self, X):
+        predictions = np.empty(X.shape[0], dtype=self.classes.dtype)
+        for start in range(0, X.shape[0], PIXEL_BLOCK):
+            sums = self.vote(X[start:start+PIXEL_BLOCK])
+            predictions[start:start+PIXEL_BLOCK] = self.classes[np.argmax(sums, axis=1)]
+        return predictions
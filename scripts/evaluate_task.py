@@ -0,0 +1,101 @@
+from .preprocess_task import *
+from .evaluation import ConfusionMatrix, evaluate_prediction
+import glob
+
+
+class EvaluateTask(PreProcessTask):
+    # Compares the last prediction of each image with the reference mask of
+    # its place, reading both a strip at a time, and reports a confusion
+    # matrix for each scene, each place and all of them
+    def __init__(self, directory, lumberjack_instance):
+        super().__init__("Lumberjack evaluation", QgsTask.CanCancel)
+        self.directory = directory
+        self.li = lumberjack_instance
+        self.report = []
+        self.exception = None
+
+
+    def get_last_prediction(self, image):
+        # Prediction files are named after the time they started, so the
+        # last one sorts last
+        pattern = os.path.join(
+            glob.escape(image.path), glob.escape(image.base_name) + "_*" + Lumberjack.PREDICTION_SUFFIX)
+        files = sorted(glob.glob(pattern))
+        return files[-1] if files else None
+
+
+    def evaluate_image(self, prediction_file, mask_dataset):
+        prediction_dataset = gdal.Open(prediction_file, gdal.GA_ReadOnly)
+        matrix = evaluate_prediction(prediction_dataset, mask_dataset, self.isCanceled)
+        if matrix is None and not self.isCanceled():
+            print("The prediction is not aligned with the mask: " + prediction_file)
+        return matrix
+
+
+    def run(self):
+        try:
+            QgsMessageLog.logMessage('Started task "{}"'.format(
+                self.description()), Lumberjack.MESSAGE_CATEGORY, Qgis.Info)
+            self.start_time_str = str(datetime.datetime.now())
+            print("=" * 30 + self.start_time_str + "=" * 30)
+            self.start_time = time.time()
+
+            self.report = []
+            overall = ConfusionMatrix()
+            for place in self.obtain_places(self.directory):
+                if place.mask == "":
+                    continue
+                mask_dataset = gdal.Open(place.mask, gdal.GA_ReadOnly)
+                place_matrix = ConfusionMatrix()
+                for image in place.images:
+                    prediction_file = self.get_last_prediction(image)
+                    if prediction_file is None:
+                        continue
+                    print("Evaluating " + prediction_file)
+                    matrix = self.evaluate_image(prediction_file, mask_dataset)
+                    if self.isCanceled():
+                        return False
+                    if matrix is None:
+                        continue
+                    self.report.append("Scene {}:".format(os.path.basename(prediction_file)))
+                    self.report.extend(matrix.report())
+                    place_matrix.merge(matrix)
+                self.report.append("Place {}:".format(os.path.basename(place.directory_path)))
+                self.report.extend(place_matrix.report())
+                overall.merge(place_matrix)
+            self.report.append("All places:")
+            self.report.extend(overall.report())
+
+            self.elapsed_time = time.time() - self.start_time
+            print("Finished evaluation in {} seconds".format(str(self.elapsed_time)))
+
+            if self.isCanceled():
+                return False
+            return True
+
+        except Exception as e:
+            self.exception = e
+            return False
+
+
+    def finished(self, result):
+        if result:
+            QgsMessageLog.logMessage(
+                'Task "{name}" completed in {time} seconds\n' \
+                'Testing Directory: {td}'.format(name=self.description(), time=self.elapsed_time, td=self.directory),
+                Lumberjack.MESSAGE_CATEGORY, Qgis.Success)
+
+            self.li.notify_evaluation(self.start_time_str, self.report, self.elapsed_time)
+
+        else:
+            if self.exception is None:
+                QgsMessageLog.logMessage(
+                    'Task "{name}" not successful but without '\
+                    'exception (probably the task was manually '\
+                    'canceled by the user)'.format(name=self.description()),
+                    Lumberjack.MESSAGE_CATEGORY, Qgis.Warning)
+            else:
+                QgsMessageLog.logMessage(
+                    'Task "{name}" Exception: {exception}'.format(name=self.description(), exception=self.exception),
+                    Lumberjack.MESSAGE_CATEGORY, Qgis.Critical)
+                raise self.exception
@@ -0,0 +1,89 @@
+import numpy as np
+from . import blocks
+
+
+# Classes are bytes, so every confusion matrix is CLASSES x CLASSES
+CLASSES = 256
+
+
+class ConfusionMatrix:
+    # Counts of each pair of reference (rows) and predicted (columns)
+    # class. Pixels without reference (0) are not counted
+    def __init__(self):
+        self.counts = np.zeros((CLASSES, CLASSES), dtype=np.int64)
+
+
+    def add(self, reference, prediction):
+        labelled = reference > 0
+        pairs = reference[labelled].astype(np.int64) * CLASSES + prediction[labelled]
+        self.counts += np.bincount(pairs, minlength=CLASSES * CLASSES).reshape(CLASSES, CLASSES)
+
+
+    def merge(self, other):
+        self.counts += other.counts
+
+
+    def report(self):
+        total = self.counts.sum()
+        if total == 0:
+            return ["No pixels with reference"]
+        classes = np.flatnonzero(self.counts.sum(axis=0) + self.counts.sum(axis=1))
+        matrix = self.counts[np.ix_(classes, classes)]
+        correct = np.diag(matrix)
+        out = []
+        out.append("Confusion Matrix (rows reference, columns prediction) of classes {}:".format(
+            ", ".join(str(c) for c in classes)))
+        out.append(matrix)
+        out.append("Pixels:    {}".format(total))
+        out.append("Accuracy:  {}".format(correct.sum() / total))
+        for c, true_positives, predicted, reference in zip(
+                classes, correct, matrix.sum(axis=0), matrix.sum(axis=1)):
+            precision = true_positives / predicted if predicted > 0 else 0.0
+            recall = true_positives / reference if reference > 0 else 0.0
+            f1 = 2 * precision * recall / (precision + recall) if precision + recall > 0 else 0.0
+            out.append("Class {}: precision {:.4f}, recall {:.4f}, F1 {:.4f}".format(c, precision, recall, f1))
+        return out
+
+
+def get_overlap(prediction_dataset, mask_dataset):
+    # Windows (xoff, yoff, xsize, ysize) of the prediction and of the mask
+    # covering the same area, or None if their pixels are not aligned
+    prediction_gt = prediction_dataset.GetGeoTransform()
+    mask_gt = mask_dataset.GetGeoTransform()
+    if not np.allclose(
+            [prediction_gt[1], prediction_gt[5]], [mask_gt[1], mask_gt[5]], rtol=1e-6):
+        return None
+    dx = (prediction_gt[0] - mask_gt[0]) / mask_gt[1]
+    dy = (prediction_gt[3] - mask_gt[3]) / mask_gt[5]
+    if abs(dx - round(dx)) > 1e-3 or abs(dy - round(dy)) > 1e-3:
+        return None
+    dx = int(round(dx))
+    dy = int(round(dy))
+    xoff = max(0, -dx)
+    yoff = max(0, -dy)
+    xend = min(prediction_dataset.RasterXSize, mask_dataset.RasterXSize - dx)
+    yend = min(prediction_dataset.RasterYSize, mask_dataset.RasterYSize - dy)
+    if xend <= xoff or yend <= yoff:
+        return None
+    return (xoff, yoff, xend - xoff, yend - yoff), (xoff + dx, yoff + dy, xend - xoff, yend - yoff)
+
+
+def evaluate_prediction(prediction_dataset, mask_dataset, is_canceled=lambda: False):
+    # Confusion matrix of the prediction against the mask, where they
+    # overlap, read a strip at a time. None if they are not aligned or
+    # it was canceled
+    overlap = get_overlap(prediction_dataset, mask_dataset)
+    if overlap is None:
+        return None
+    (xoff, yoff, xsize, ysize), (mask_xoff, mask_yoff, _, _) = overlap
+
+    prediction_band = prediction_dataset.GetRasterBand(1)
+    mask_band = mask_dataset.GetRasterBand(1)
+    matrix = ConfusionMatrix()
+    for line, lines in blocks.strip_windows(ysize, blocks.strip_height(prediction_band)):
+        if is_canceled():
+            return None
+        prediction = prediction_band.ReadAsArray(xoff, yoff + line, xsize, lines)
+        reference = mask_band.ReadAsArray(mask_xoff, mask_yoff + line, xsize, lines)
+        matrix.add(reference, prediction)
+    return matrix
@@ -0,0 +1,143 @@
+from osgeo import gdal
+from osgeo import gdal_array
+import numpy as np
+import json
+from . import blocks
+from .manifest import file_signature
+
+
+# Scalar features have the same value for every pixel of an image (e.g. the
+# day of the year), so they are not stored as bands of the stack. Their
+# position in the feature vector and their value are kept in the metadata
+# of the stack and only broadcast when samples or pixels are assembled
+SCALAR_FEATURES_KEY = "LUMBERJACK_SCALAR_FEATURES"
+# Names of every feature of the stack, in order (band descriptions can't
+# hold the names of the scalar features)
+FEATURE_NAMES_KEY = "LUMBERJACK_FEATURE_NAMES"
+
+
+def write_stack_metadata(file_name_stack, scalar_features, feature_names):
+    # scalar_features is a list of (position, value) pairs
+    dataset = gdal.Open(file_name_stack, gdal.GA_Update)
+    dataset.SetMetadataItem(SCALAR_FEATURES_KEY, json.dumps(scalar_features))
+    dataset.SetMetadataItem(FEATURE_NAMES_KEY, json.dumps(feature_names))
+    dataset = None
+
+
+class FeatureStack:
+    # Reads the stack of an image, which may be a GeoTIFF or a VRT, and
+    # places its bands and its scalar features in the order of the feature
+    # vector. Stacks written before scalar features existed have no metadata
+    # and are read as they are
+    def __init__(self, file_name_stack):
+        self.dataset = gdal.Open(file_name_stack, gdal.GA_ReadOnly)
+        self.RasterXSize = self.dataset.RasterXSize
+        self.RasterYSize = self.dataset.RasterYSize
+
+        self.scalar_features = []
+        metadata = self.dataset.GetMetadataItem(SCALAR_FEATURES_KEY)
+        if metadata:
+            self.scalar_features = [(int(position), value) for position, value in json.loads(metadata)]
+        self.feature_count = self.dataset.RasterCount + len(self.scalar_features)
+
+        scalar_positions = [position for position, value in self.scalar_features]
+        self.band_positions = [i for i in range(self.feature_count) if i not in scalar_positions]
+
+        self.feature_names = None
+        metadata = self.dataset.GetMetadataItem(FEATURE_NAMES_KEY)
+        if metadata:
+            self.feature_names = json.loads(metadata)
+
+
+    def find_feature(self, name, occurrence=0):
+        # Position of the feature with the given name. Names may be repeated,
+        # occurrence tells which one of them
+        if self.feature_names is None:
+            raise ValueError("The stack has no feature names, calculate the features again")
+        positions = [i for i, feature_name in enumerate(self.feature_names) if feature_name == name]
+        if occurrence >= len(positions):
+            raise ValueError("The stack has no feature named '{}'".format(name))
+        return positions[occurrence]
+
+
+    def fingerprint(self):
+        # Signatures of the stack and, for a VRT, of the files it reads
+        return [file_signature(file_path) for file_path in (self.dataset.GetFileList() or [])]
+
+
+    def get_geo_transform(self):
+        return self.dataset.GetGeoTransform()
+
+
+    def get_projection(self):
+        return self.dataset.GetProjectionRef()
+
+
+    def read_tile(self, xoff, yoff, xsize, ysize):
+        # Same interface as FusedFeatures, so both can be predicted alike
+        return self.read_bands(xoff, yoff, xsize, ysize)
+
+
+    def tile_features(self, tile):
+        # Returns the (pixels, features) array of a window read with
+        # read_tile()
+        return self.add_scalar_features(tile.reshape(tile.shape[0] * tile.shape[1], tile.shape[2]))
+
+
+    def read_bands(self, xoff=0, yoff=0, xsize=None, ysize=None):
+        # Returns a (rows, columns, bands) array with the bands of a window,
+        # without the scalar features
+        if xsize is None:
+            xsize = self.RasterXSize - xoff
+        if ysize is None:
+            ysize = self.RasterYSize - yoff
+        bands = np.zeros((ysize, xsize, self.dataset.RasterCount), dtype=np.float32)
+        for band_number in range(self.dataset.RasterCount):
+            band = self.dataset.GetRasterBand(band_number + 1)
+            bands[:, :, band_number] = band.ReadAsArray(xoff, yoff, xsize, ysize)
+        return bands
+
+
+    def read_samples(self, roi, windows, block_size):
+        # Returns the features (samples, features) and the labels of the
+        # pixels where roi > 0, reading only the given windows of each band.
+        # Windows are at most block_size x block_size
+        masks = [roi[yoff:yoff+ysize, xoff:xoff+xsize] > 0 for xoff, yoff, xsize, ysize in windows]
+        total = sum(int(mask.sum()) for mask in masks)
+        X = np.empty((total, self.dataset.RasterCount), dtype=np.float32)
+        y = np.empty(total, dtype=roi.dtype)
+
+        buffers = {}
+        position = 0
+        for (xoff, yoff, xsize, ysize), mask in zip(windows, masks):
+            samples = int(mask.sum())
+            y[position:position+samples] = roi[yoff:yoff+ysize, xoff:xoff+xsize][mask]
+            for band_number in range(self.dataset.RasterCount):
+                band = self.dataset.GetRasterBand(band_number + 1)
+                dtype = gdal_array.GDALTypeCodeToNumericTypeCode(band.DataType)
+                buffer = blocks.get_buffer(buffers, dtype, ysize, xsize, block_size, block_size)
+                data = band.ReadAsArray(xoff, yoff, xsize, ysize, buf_obj=buffer)
+                X[position:position+samples, band_number] = data[mask]
+            position += samples
+        return self.add_scalar_features(X), y
+
+
+    def add_scalar_features(self, X):
+        # Takes a (samples, bands) array and returns the (samples, features)
+        # array with the scalar features broadcast in their positions
+        if not self.scalar_features:
+            return X
+        features = np.empty((X.shape[0], self.feature_count), dtype=X.dtype)
+        features[:, self.band_positions] = X
+        for position, value in self.scalar_features:
+            features[:, position] = value
+        return features
+
+
+    def read_feature(self, position):
+        # Returns a single feature of the whole image
+        for scalar_position, value in self.scalar_features:
+            if scalar_position == position:
+                return np.full((self.RasterYSize, self.RasterXSize), value, dtype=np.float32)
+        band_number = self.band_positions.index(position) + 1
+        return self.dataset.GetRasterBand(band_number).ReadAsArray()
@@ -2,29 +2,234 @@ import os
 import time
 import datetime
 import math
+import json
+import collections
 import numpy as np
 from osgeo import gdal
 
 from . import bands_algebra
 from . import filters
 from . import ndvi
+from . import textures
 from .. import Lumberjack
 
 
+def core_window(merged, halo):
+    # Removes the halo of a (bands, rows, columns) window
+    if halo == 0:
+        return merged
+    return merged[:, halo:-halo, halo:-halo]
+
+
+def shrink_halo(merged, halo, new_halo):
+    # Keeps only new_halo pixels around the window
+    border = halo - new_halo
+    if border == 0:
+        return merged
+    return merged[:, border:-border, border:-border]
+
+
+def match_names(names, required_names):
+    # Returns, for each required name, the index of the feature with that
+    # name. Names may be repeated (e.g. bands without description), the n-th
+    # time a name is required it is matched with its n-th feature
+    positions = collections.defaultdict(collections.deque)
+    for i, name in enumerate(names):
+        positions[name].append(i)
+    indexes = []
+    missing = []
+    for name in required_names:
+        if positions[name]:
+            indexes.append(positions[name].popleft())
+        else:
+            missing.append(name)
+    if missing:
+        raise ValueError("These features can't be calculated: {}".format(missing))
+    return indexes
+
+
+def select_features(features, required_names, image):
+    # Keeps the features that give any of the required names, and for
+    # features calculated band by band only the bands needed. image is used
+    # to find the names of the features read from files
+    required = set(required_names)
+    selected = []
+    names = []
+    for feature in features:
+        if feature.per_band:
+            bands = [
+                band for band in range(1, Lumberjack.BAND_TOTAL + 1)
+                if required.intersection(feature.band_feature_names(band))]
+            # With every band the feature is the same as when nothing is
+            # required, so it shares its file and its manifest entry
+            feature.bands = None if len(bands) == Lumberjack.BAND_TOTAL else bands
+            feature_names = [name for band in bands for name in feature.band_feature_names(band)]
+        else:
+            feature_names = feature.list_names(image)
+        if required.intersection(feature_names):
+            selected.append(feature)
+            names.extend(feature_names)
+    # Fails if any name is missing
+    match_names(names, required_names)
+    print("Features needed: {}".format(", ".join(type(feature).__name__ for feature in selected)))
+    return selected
+
+
+def resolve_feature_names(features, image):
+    # Sets the names of the features without calculating them
+    for feature in features:
+        if feature.per_band:
+            feature.set_band_names(Lumberjack.BAND_TOTAL)
+        elif not feature.feature_names:
+            feature.feature_names = feature.list_names(image)
+
+
 class Feature:
-    # Parent class which defines a common interface for all features
+    # Parent class which defines a common interface for all features.
+    # VERSION must be increased whenever the way a feature is calculated
+    # changes, so files generated by older code are rebuilt
+    VERSION = 1
+
     def __init__(self):
         self.feature_names = []
+        # Features that only read an existing file do not generate anything
+        self.generates_file = True
+        # Scalar features have a single value per image instead of a raster
+        self.is_scalar = False
+        # Features calculated for each band of the merged image can be
+        # limited to some of them (1 based). None means every band
+        self.per_band = False
+        self.bands = None
+        # Threads the feature may use to calculate its file. None means
+        # every core
+        self.threads = None
 
 
     def get_file_name(self, image):
         raise NotImplementedError("Subclasses must override get_file_name()")
 
 
+    def get_inputs(self, file_in, image):
+        # Files the output depends on
+        return [file_in]
+
+
+    def get_parameters(self):
+        # Values, other than the inputs, the output depends on
+        if self.bands is None:
+            return {}
+        return {"bands": self.bands}
+
+
+    def list_names(self, image):
+        # Names the feature gives for an image, without calculating it
+        if self.per_band:
+            return [
+                name for band in range(1, Lumberjack.BAND_TOTAL + 1)
+                for name in self.band_feature_names(band)]
+        return list(self.feature_names)
+
+
+    def band_feature_names(self, band):
+        # Names of the features of a band, for features calculated per band
+        raise NotImplementedError("Subclasses calculated per band must override band_feature_names()")
+
+
+    def get_bands_suffix(self, suffix):
+        # Files with only some of the bands are named after them, so they
+        # never replace the file with every band
+        if self.bands is None:
+            return suffix
+        root, extension = os.path.splitext(suffix)
+        return "{}_bands{}{}".format(root, "".join("_{}".format(band) for band in self.bands), extension)
+
+
+    def get_bands(self, band_count):
+        if self.bands is None:
+            return list(range(1, band_count + 1))
+        return self.bands
+
+
+    def set_band_names(self, band_count):
+        self.feature_names = [
+            name for band in self.get_bands(band_count) for name in self.band_feature_names(band)]
+
+
     def execute(self, file_in, image):
         raise NotImplementedError("Subclasses must override execute()")
 
 
+    # Features can also be calculated window by window straight from the
+    # cropped bands of an image, without writing any file (see
+    # fused_features.py). The hooks must not change the feature, whatever
+    # an image needs is kept in the state returned by prepare()
+
+    def get_halo(self):
+        # Pixels needed around a window to calculate it
+        return 0
+
+
+    def prepare(self, image, merged_bands):
+        # Called once per image with the GDAL bands of the cropped image.
+        # Sets the feature names and returns the state of the image
+        return None
+
+
+    def read_window(self, state, xoff, yoff, xsize, ysize):
+        # Reads whatever the feature needs, other than the merged bands.
+        # Always called from the same thread
+        return None
+
+
+    def compute_window(self, state, merged, halo, data):
+        # merged is a (bands, rows, columns) array of the merged bands of
+        # the window with halo pixels around it, and data what read_window()
+        # returned. Returns a (features, rows, columns) array. It may be
+        # called from several threads at once
+        raise NotImplementedError("Subclasses must override compute_window()")
+
+
+class MergedFeature(Feature):
+    # The bands of the merged image, which crop_and_merge_images() writes
+    SUFFIX = ""
+
+    def __init__(self, suffix):
+        super().__init__()
+        MergedFeature.SUFFIX = suffix
+        self.feature_names = []
+        self.generates_file = False
+
+
+    def get_file_name(self, image):
+        return os.path.join(image.path, "{}{}".format(image.base_name, MergedFeature.SUFFIX))
+
+
+    def list_names(self, image):
+        # The merged image keeps the descriptions of the bands
+        file_name_band = os.path.join(image.path, "{}{}".format(image.base_name, Lumberjack.BAND_SUFFIX))
+        names = []
+        for i in range(1, Lumberjack.BAND_TOTAL + 1):
+            dataset = gdal.Open(file_name_band.format(i), gdal.GA_ReadOnly)
+            names.append(dataset.GetRasterBand(1).GetDescription())
+        return names
+
+
+    def execute(self, file_in, image):
+        if (not self.feature_names):
+            dataset = gdal.Open(file_in, gdal.GA_ReadOnly)
+            self.feature_names = ([dataset.GetRasterBand(i).GetDescription() for i in range(1, dataset.RasterCount+1)])
+
+
+    def prepare(self, image, merged_bands):
+        if (not self.feature_names):
+            self.feature_names = [band.GetDescription() for band in merged_bands]
+        return None
+
+
+    def compute_window(self, state, merged, halo, data):
+        return core_window(merged, halo).astype(np.float32)
+
+
 class AlgebraFeature(Feature):
     SUFFIX = ""
 
@@ -43,6 +248,11 @@ class AlgebraFeature(Feature):
         bands_algebra.generate_algebra_file(file_in, file_out)
 
 
+    def compute_window(self, state, merged, halo, data):
+        return np.array(bands_algebra.calculate_features(
+            core_window(merged, halo).astype(np.float64)), dtype=np.float32)
+
+
 class FilterFeature(Feature):
     SUFFIX = ""
 
@@ -50,17 +260,37 @@ class FilterFeature(Feature):
         super().__init__()
         FilterFeature.SUFFIX = suffix
         self.feature_names = []
+        self.per_band = True
 
 
     def get_file_name(self, image):
-        return os.path.join(image.path, "{}{}".format(image.base_name, FilterFeature.SUFFIX))
+        return os.path.join(image.path, "{}{}".format(image.base_name, self.get_bands_suffix(FilterFeature.SUFFIX)))
+
+
+    def band_feature_names(self, band):
+        return ["median_band{}".format(band)]
 
 
     def execute(self, file_in, image):
         file_out = self.get_file_name(image)
-        band_count = filters.generate_filter_file(file_input=file_in, file_output_median=file_out)
-        if (not self.feature_names):
-            self.feature_names = (["median_band{}".format(i) for i in range(1, band_count+1)])
+        band_count = filters.generate_filter_file(file_input=file_in, file_output_median=file_out, bands=self.bands)
+        self.set_band_names(band_count)
+
+
+    def get_halo(self):
+        return filters.median_halo(filters.MEDIAN_WINDOW_SIZE)
+
+
+    def prepare(self, image, merged_bands):
+        self.set_band_names(len(merged_bands))
+        return None
+
+
+    def compute_window(self, state, merged, halo, data):
+        filtered = [
+            filters.median_filter_band(merged[band - 1], filters.MEDIAN_WINDOW_SIZE)
+            for band in self.get_bands(merged.shape[0])]
+        return core_window(np.array(filtered), halo).astype(np.float32)
 
 
 class FilterGaussFeature(Feature):
@@ -70,17 +300,37 @@ class FilterGaussFeature(Feature):
         super().__init__()
         FilterGaussFeature.SUFFIX = suffix
         self.feature_names = []
+        self.per_band = True
 
 
     def get_file_name(self, image):
-        return os.path.join(image.path, "{}{}".format(image.base_name, FilterGaussFeature.SUFFIX))
+        return os.path.join(image.path, "{}{}".format(image.base_name, self.get_bands_suffix(FilterGaussFeature.SUFFIX)))
+
+
+    def band_feature_names(self, band):
+        return ["gauss_band{}".format(band)]
 
 
     def execute(self, file_in, image):
         file_out = self.get_file_name(image)
-        band_count = filters.generate_filter_file(file_input=file_in, file_output_gaussian=file_out)
-        if (not self.feature_names):
-            self.feature_names = (["gauss_band{}".format(i) for i in range(1, band_count+1)])
+        band_count = filters.generate_filter_file(file_input=file_in, file_output_gaussian=file_out, bands=self.bands)
+        self.set_band_names(band_count)
+
+
+    def get_halo(self):
+        return filters.gaussian_halo(filters.GAUSSIAN_SIGMA)
+
+
+    def prepare(self, image, merged_bands):
+        self.set_band_names(len(merged_bands))
+        return None
+
+
+    def compute_window(self, state, merged, halo, data):
+        filtered = [
+            filters.gaussian_filter_band(merged[band - 1], filters.GAUSSIAN_SIGMA)
+            for band in self.get_bands(merged.shape[0])]
+        return core_window(np.array(filtered), halo).astype(np.float32)
 
 
 class NdviFeature(Feature):
@@ -101,80 +351,179 @@ class NdviFeature(Feature):
         ndvi.generate_ndvi_file(file_in, file_out)
 
 
+    def compute_window(self, state, merged, halo, data):
+        core = core_window(merged, halo)
+        values = ndvi.ndvi_from_bands(core[ndvi.RED_BAND - 1], core[ndvi.NIR_BAND - 1])
+        return values[np.newaxis].astype(np.float32)
+
+
+class TextureFeature(Feature):
+    # Haralick textures (asm, contrast, variance, idm and entropy) of every
+    # band, calculated in the plugin instead of with the GRASS script
+    SUFFIX = ""
+
+    def __init__(self, suffix, size=3, distance=1, categories=255, rescale=False):
+        super().__init__()
+        TextureFeature.SUFFIX = suffix
+        textures.check_parameters(size, distance, categories)
+        self.size = size
+        self.distance = distance
+        self.categories = categories
+        self.rescale = rescale
+        self.feature_names = []
+        self.per_band = True
+
+
+    def get_file_name(self, image):
+        return os.path.join(image.path, "{}{}".format(image.base_name, self.get_bands_suffix(TextureFeature.SUFFIX)))
+
+
+    def get_parameters(self):
+        parameters = super().get_parameters()
+        parameters.update({
+            "size": self.size, "distance": self.distance,
+            "categories": self.categories, "rescale": self.rescale})
+        return parameters
+
+
+    def band_feature_names(self, band):
+        return ["band.{}_{}".format(band, measure) for measure in textures.MEASURES]
+
+
+    def execute(self, file_in, image):
+        file_out = self.get_file_name(image)
+        band_count = textures.generate_texture_file(
+            file_in, file_out, self.size, self.distance, self.categories, self.rescale, self.threads,
+            bands=self.bands)
+        self.set_band_names(band_count)
+
+
+    def get_halo(self):
+        return self.size // 2
+
+
+    def prepare(self, image, merged_bands):
+        # The categories depend on the whole band, so they are calculated
+        # before the windows
+        self.set_band_names(len(merged_bands))
+        return [
+            textures.quantization_edges(merged_bands[band - 1].ReadAsArray(), self.categories, self.rescale)
+            for band in self.get_bands(len(merged_bands))]
+
+
+    def compute_window(self, state, merged, halo, data):
+        merged = shrink_halo(merged, halo, self.get_halo())
+        lines = merged.shape[1] - 2 * self.get_halo()
+        columns = merged.shape[2] - 2 * self.get_halo()
+        measures = [
+            textures.texture_measures(
+                textures.quantize(merged[band - 1], edges), self.size, self.distance, lines, columns)
+            for band, edges in zip(self.get_bands(merged.shape[0]), state)]
+        return np.concatenate(measures)
+
+
 class DayFeature(Feature):
     SUFFIX = ""
+    VERSION = 2
 
     def __init__(self, suffix):
         super().__init__()
         DayFeature.SUFFIX = suffix
         self.feature_names = ["day_normalized", "day_transform"]
+        self.is_scalar = True
 
 
     def get_file_name(self, image):
         return os.path.join(image.path, "{}{}".format(image.base_name, DayFeature.SUFFIX))
 
 
+    def get_inputs(self, file_in, image):
+        return [image.metadata_file]
+
+
     def execute(self, file_in, image):
+        # The day is the same for every pixel of the image, so only its two
+        # values are stored. They are broadcast when the samples or the
+        # pixels to predict are assembled
         file_out = self.get_file_name(image)
-        date = self.get_date_from_metadata(image.metadata_file)
-        row = int(self.get_row_from_metadata(image.metadata_file))
-        number_of_day = self.transform_day(date, row)
+        with open(file_out, 'w') as f:
+            json.dump(dict(zip(self.feature_names, self.calculate_values(image))), f)
+
+
+    def calculate_values(self, image):
+        metadata = image.get_metadata()
+        number_of_day = self.transform_day(metadata.date, metadata.wrs_row)
         number_of_day_normalized = number_of_day / 366
         number_of_day_transform = math.sin(number_of_day_normalized * math.pi)
+        return [number_of_day_normalized, number_of_day_transform]
+
+
+    def prepare(self, image, merged_bands):
+        return self.calculate_values(image)
 
-        # Create a new file
-        dataset = gdal.Open(file_in, gdal.GA_ReadOnly)
-        driver = gdal.GetDriverByName('GTiff')
-        output_dataset = driver.Create(file_out, dataset.RasterXSize, dataset.RasterYSize, 2, gdal.GDT_Float32)
-        output_dataset.SetProjection(dataset.GetProjectionRef())
-        output_dataset.SetGeoTransform(dataset.GetGeoTransform())
 
-        # Write a band with the day normalized for each pixel
-        band = np.full((dataset.RasterYSize, dataset.RasterXSize), number_of_day_normalized)
-        outband = output_dataset.GetRasterBand(1)
-        outband.SetDescription("day_normalized")
-        outband.WriteArray(band)
+    def compute_window(self, state, merged, halo, data):
+        lines = merged.shape[1] - 2 * halo
+        columns = merged.shape[2] - 2 * halo
+        return np.array([np.full((lines, columns), value, dtype=np.float32) for value in state])
 
-        # Write a band with the day transformed for each pixel
-        band = np.full((dataset.RasterYSize, dataset.RasterXSize), number_of_day_transform)
-        outband = output_dataset.GetRasterBand(2)
-        outband.SetDescription("day_transform")
-        outband.WriteArray(band)
+
+    def get_scalar_values(self, image):
+        with open(self.get_file_name(image), 'r') as f:
+            values = json.load(f)
+        return [values[name] for name in self.feature_names]
 
 
     def transform_day(self, date, row):
-        year, month, day = date.split("-")
-        year = int(year)
-        month = int(month)
-        day = int(day)
-        number_of_day = (datetime.date(year, month, day) - datetime.date(year, 1, 1)).days + 1
+        number_of_day = (date - datetime.date(date.year, 1, 1)).days + 1
         # If the image is from the northern hemisphere
         if (row < 60):
             number_of_day = (number_of_day + 182) % 365
         return number_of_day
 
 
-    def get_date_from_metadata(self, file):
-        with open(file, 'r') as f:
-            for line in f.readlines():
-                if "DATE_ACQUIRED =" in line:
-                    l = line.split("=")
-                    return l[1]
+class FileFeature(Feature):
+    # Features read from files calculated outside of the plugin
+
+    def band_names(self, dataset):
+        return [dataset.GetRasterBand(i).GetDescription() for i in range(1, dataset.RasterCount+1)]
+
+
+    def list_names(self, image):
+        file_name = self.get_file_name(image)
+        if file_name is None:
+            return []
+        return self.band_names(gdal.Open(file_name, gdal.GA_ReadOnly))
+
+
+    def get_inputs(self, file_in, image):
+        return [self.get_file_name(image)]
+
+
+    def prepare(self, image, merged_bands):
+        dataset = gdal.Open(self.get_file_name(image), gdal.GA_ReadOnly)
+        if (not self.feature_names):
+            self.feature_names = self.band_names(dataset)
+        return dataset
+
+
+    def read_window(self, state, xoff, yoff, xsize, ysize):
+        data = state.ReadAsArray(xoff, yoff, xsize, ysize).astype(np.float32)
+        if data.ndim == 2:
+            data = data[np.newaxis]
+        return data
 
 
-    def get_row_from_metadata(self, file):
-        with open(file, 'r') as f:
-            for line in f.readlines():
-                if "WRS_ROW =" in line:
-                    l = line.split("=")
-                    return l[1]
+    def compute_window(self, state, merged, halo, data):
+        return data
 
 
-class ImageFeature(Feature):
+class ImageFeature(FileFeature):
     def __init__(self, suffix):
         super().__init__()
         self.suffix = suffix
         self.feature_names = []
+        self.generates_file = False
 
 
     def get_file_name(self, image):
@@ -187,16 +536,17 @@ class ImageFeature(Feature):
         if (not self.feature_names):
             file_features = self.get_file_name(image)
             dataset = gdal.Open(file_features, gdal.GA_ReadOnly)
-            self.feature_names = ([dataset.GetRasterBand(i).GetDescription() for i in range(1, dataset.RasterCount+1)])
+            self.feature_names = self.band_names(dataset)
 
 
-class PlaceFeature(Feature):
+class PlaceFeature(FileFeature):
     SUFFIX = ""
 
     def __init__(self, suffix):
         super().__init__()
         PlaceFeature.SUFFIX = suffix
         self.feature_names = []
+        self.generates_file = False
 
 
     def get_file_name(self, image):
@@ -210,5 +560,8 @@ class PlaceFeature(Feature):
         if (not self.feature_names):
             file_dem_text = self.get_file_name(image)
             dataset = gdal.Open(file_dem_text, gdal.GA_ReadOnly)
-            self.feature_names = (
-                ["dem-{}".format(dataset.GetRasterBand(i).GetDescription()) for i in range(1, dataset.RasterCount+1)])
+            self.feature_names = self.band_names(dataset)
+
+
+    def band_names(self, dataset):
+        return ["dem-{}".format(name) for name in super().band_names(dataset)]
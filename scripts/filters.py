@@ -1,61 +1,105 @@
+import argparse
 from argparse import ArgumentParser
 from osgeo import gdal
 from osgeo import gdal_array
 from scipy import ndimage
 import numpy as np
 import time
+try:
+    from .output_profile import create_tiff
+except ImportError:
+    # Run as a script from the command line
+    from output_profile import create_tiff
 
 
-def generate_empty_img(dataset):
+# Default parameters of the filters
+MEDIAN_WINDOW_SIZE = 4
+GAUSSIAN_SIGMA = 1
+GAUSSIAN_TRUNCATE = 4.0
+
+
+def median_halo(window_size):
+    # Pixels around a window needed to filter it. Even windows are not
+    # centered, they reach window_size // 2 pixels before the pixel
+    return window_size // 2
+
+
+def gaussian_halo(sigma):
+    # Radius of the kernel, as scipy calculates it
+    return int(GAUSSIAN_TRUNCATE * sigma + 0.5)
+
+
+def median_filter_band(data, window_size):
+    return ndimage.median_filter(data, size = (window_size, window_size))
+
+
+def gaussian_filter_band(data, sigma):
+    # The output has the type of the input, as in the filter files
+    return ndimage.gaussian_filter(data, sigma=sigma, truncate=GAUSSIAN_TRUNCATE)
+
+
+def generate_empty_img(dataset, band_count):
     # Allocates the array using the first band's datatype
     image_datatype = dataset.GetRasterBand(1).DataType
     empty_img = np.zeros(
-        (dataset.RasterYSize, dataset.RasterXSize, dataset.RasterCount),
+        (dataset.RasterYSize, dataset.RasterXSize, band_count),
         dtype=gdal_array.GDALTypeCodeToNumericTypeCode(image_datatype))
     return empty_img
 
 
-def median_filter(dataset, window_size):
-    img_filtered = generate_empty_img(dataset)
-    # Loops all the bands of the image
-    for b in range(dataset.RasterCount):
-        band = dataset.GetRasterBand(b + 1)
+def get_bands(dataset, bands):
+    # Bands (1 based) to filter, every band by default
+    if bands is None:
+        return list(range(1, dataset.RasterCount + 1))
+    return bands
+
+
+def median_filter(dataset, window_size, bands=None):
+    bands = get_bands(dataset, bands)
+    img_filtered = generate_empty_img(dataset, len(bands))
+    # Loops the bands of the image
+    for b, band_number in enumerate(bands):
+        band = dataset.GetRasterBand(band_number)
         # Calculate the filter using the band's data and asign to
         # the third dimension of the numpy array
-        img_filtered[:, :, b] = ndimage.filters.median_filter(band.ReadAsArray(), size = (window_size, window_size))
+        img_filtered[:, :, b] = median_filter_band(band.ReadAsArray(), window_size)
     return img_filtered
 
 
-def gaussian_filter(dataset, sigma):
-    img_filtered = generate_empty_img(dataset)
-    # Loops all the bands of the image
-    for b in range(dataset.RasterCount):
-        band = dataset.GetRasterBand(b + 1)
+def gaussian_filter(dataset, sigma, bands=None):
+    bands = get_bands(dataset, bands)
+    img_filtered = generate_empty_img(dataset, len(bands))
+    # Loops the bands of the image
+    for b, band_number in enumerate(bands):
+        band = dataset.GetRasterBand(band_number)
         # Calculate the filter using the band's data and asign to
         # the third dimension of the numpy array
-        img_filtered[:, :, b] = ndimage.gaussian_filter(band.ReadAsArray(), sigma=sigma)
+        img_filtered[:, :, b] = gaussian_filter_band(band.ReadAsArray(), sigma)
     return img_filtered
 
 
 def output_tiff(dataset, img_filtered, file_output):
     # Generate a new tiff file with the path, size, amount of bands and type
-    out_raster_ds = gdal.GetDriverByName('GTiff').Create(
+    out_raster_ds = create_tiff(
         file_output, dataset.RasterXSize, dataset.RasterYSize,
-        dataset.RasterCount, gdal.GDT_Float32)
+        img_filtered.shape[2], gdal.GDT_Float32, "feature")
     # Set projection taken from the original image and also set GeoTransform,
     # which defines the position of the top left pixel, among
     # with the resolution and orientation. It's taken from the original image.
     out_raster_ds.SetProjection(dataset.GetProjectionRef())
     out_raster_ds.SetGeoTransform(dataset.GetGeoTransform())
     # Write the calculated filters in each band
-    for b in range(dataset.RasterCount):
+    for b in range(img_filtered.shape[2]):
         outband = out_raster_ds.GetRasterBand(b+1)
         outband.WriteArray(img_filtered[:, :, b])
     outband.FlushCache()
     out_raster_ds = None
 
 
-def generate_filter_file(file_input, file_output_median=None, file_output_gaussian=None, window_size=4, sigma=1):
+def generate_filter_file(
+        file_input, file_output_median=None, file_output_gaussian=None,
+        window_size=MEDIAN_WINDOW_SIZE, sigma=GAUSSIAN_SIGMA, bands=None):
+    # bands limits the filters to some of the bands of the input (1 based)
     start_time = time.time()
     print("Performing filters...")
     # Opens the gdal dataset
@@ -63,11 +107,11 @@ def generate_filter_file(file_input, file_output_median=None, file_output_gaussi
     band_count = dataset.RasterCount
 
     if file_output_median != None:
-        median_img = median_filter(dataset, window_size)
+        median_img = median_filter(dataset, window_size, bands)
         output_tiff(dataset, median_img, file_output_median)
 
     if file_output_gaussian != None:
-        gaussian_img = gaussian_filter(dataset, sigma)
+        gaussian_img = gaussian_filter(dataset, sigma, bands)
         output_tiff(dataset, gaussian_img, file_output_gaussian)
 
     elapsed_time = time.time() - start_time
@@ -94,10 +138,11 @@ if __name__== "__main__":
         "-og", "--output_file_gaussian", dest="file_output_gaussian",
         help="Output tiff file to save the image filtered by gaussian method", required=False)
     parser.add_argument(
-        "-w", "--window_size", dest="window_size", type=check_positive, help="Size of the window", required=False)
+        "-w", "--window_size", dest="window_size", type=check_positive, default=MEDIAN_WINDOW_SIZE,
+        help="Size of the window", required=False)
     parser.add_argument(
-        "-s", "--sigma", dest="sigma", type=check_positive,
+        "-s", "--sigma", dest="sigma", type=check_positive, default=GAUSSIAN_SIGMA,
         help="Standard deviation for Gaussian kernel", required=False)
 
     args = parser.parse_args()
-    generate_filter_file(args.file_input, args.file_output_median, args.file_output_gaussian, args.window_size, sigma)
+    generate_filter_file(args.file_input, args.file_output_median, args.file_output_gaussian, args.window_size, args.sigma)
@@ -0,0 +1,113 @@
+import numpy as np
+from .features import match_names
+from .manifest import file_signature
+
+
+def fused_fingerprint(features, image, band_files):
+    # Signatures of every file the features of an image are calculated
+    # from, without preparing them
+    files = list(band_files)
+    for feature in features:
+        files.extend([file_path for file_path in feature.get_inputs(None, image) if file_path])
+    return [file_signature(file_path) for file_path in files]
+
+
+class FusedFeatures:
+    # Calculates the features of an image window by window, straight from
+    # its cropped bands, instead of writing the merged image, a file per
+    # feature and the stack. Gives the same values, in the same order, as
+    # reading the stack of the image. Windows are read with a halo around
+    # them (the biggest one the features need), filled by reflection at the
+    # borders of the image as the filters do. With required_names the
+    # features are given in that order
+    def __init__(self, features, image, cropped_datasets, required_names=None):
+        self.features = features
+        self.datasets = cropped_datasets
+        self.bands = [dataset.GetRasterBand(1) for dataset in cropped_datasets]
+        self.RasterXSize = cropped_datasets[0].RasterXSize
+        self.RasterYSize = cropped_datasets[0].RasterYSize
+        self.halo = max([feature.get_halo() for feature in features] + [0])
+
+        self.states = [feature.prepare(image, self.bands) for feature in features]
+        self.feature_names = []
+        for feature in features:
+            self.feature_names.extend(feature.feature_names)
+        self.calculated_count = len(self.feature_names)
+        self.columns = None
+        if required_names is not None:
+            self.columns = match_names(self.feature_names, required_names)
+            self.feature_names = [self.feature_names[i] for i in self.columns]
+        self.feature_count = len(self.feature_names)
+
+
+    def get_geo_transform(self):
+        return self.datasets[0].GetGeoTransform()
+
+
+    def get_projection(self):
+        return self.datasets[0].GetProjectionRef()
+
+
+    def read_merged(self, xoff, yoff, xsize, ysize):
+        # Returns the (bands, rows, columns) window of the merged bands with
+        # the halo around it
+        halo = self.halo
+        start_x = max(0, xoff - halo)
+        start_y = max(0, yoff - halo)
+        end_x = min(self.RasterXSize, xoff + xsize + halo)
+        end_y = min(self.RasterYSize, yoff + ysize + halo)
+        merged = np.array([
+            band.ReadAsArray(start_x, start_y, end_x - start_x, end_y - start_y)
+            for band in self.bands])
+        padding = (
+            (0, 0),
+            (halo - (yoff - start_y), halo - (end_y - yoff - ysize)),
+            (halo - (xoff - start_x), halo - (end_x - xoff - xsize)))
+        return np.pad(merged, padding, mode='symmetric')
+
+
+    def read_tile(self, xoff, yoff, xsize, ysize):
+        # Reads everything needed to calculate the features of a window. It
+        # uses GDAL, so it must always be called from the same thread
+        data = [
+            feature.read_window(state, xoff, yoff, xsize, ysize)
+            for feature, state in zip(self.features, self.states)]
+        return xsize, ysize, self.read_merged(xoff, yoff, xsize, ysize), data
+
+
+    def tile_features(self, tile):
+        # Returns the (pixels, features) array of a window read with
+        # read_tile(). Only uses NumPy, so windows can be calculated by
+        # several threads
+        xsize, ysize, merged, data = tile
+        X = np.empty((xsize * ysize, self.calculated_count), dtype=np.float32)
+        position = 0
+        for feature, state, feature_data in zip(self.features, self.states, data):
+            values = feature.compute_window(state, merged, self.halo, feature_data)
+            count = values.shape[0]
+            if count != len(feature.feature_names):
+                raise ValueError("{} gave {} features but has {} names".format(
+                    type(feature).__name__, count, len(feature.feature_names)))
+            X[:, position:position+count] = values.reshape(count, xsize * ysize).T
+            position += count
+        if self.columns is not None:
+            X = X[:, self.columns]
+        return X
+
+
+    def read_samples(self, roi, windows, block_size):
+        # Same as FeatureStack.read_samples(), but only the features of the
+        # windows (and their halo) are calculated
+        masks = [roi[yoff:yoff+ysize, xoff:xoff+xsize] > 0 for xoff, yoff, xsize, ysize in windows]
+        total = sum(int(mask.sum()) for mask in masks)
+        X = np.empty((total, self.feature_count), dtype=np.float32)
+        y = np.empty(total, dtype=roi.dtype)
+
+        position = 0
+        for (xoff, yoff, xsize, ysize), mask in zip(windows, masks):
+            samples = int(mask.sum())
+            y[position:position+samples] = roi[yoff:yoff+ysize, xoff:xoff+xsize][mask]
+            features = self.tile_features(self.read_tile(xoff, yoff, xsize, ysize))
+            X[position:position+samples] = features[mask.ravel()]
+            position += samples
+        return X, y
@@ -1,3 +1,6 @@
+from .metadata import read_metadata
+
+
 class Image:
     # This is only a data class like the Place class. A Place can have
     # multiple Images. This creates and structure which makes code more
@@ -6,3 +9,12 @@ class Image:
         self.path = path
         self.base_name = ""
         self.metadata_file = ""
+        self.metadata = None
+
+
+    def get_metadata(self):
+        # The metadata file is parsed once and shared by every feature and
+        # task that needs it
+        if self.metadata is None:
+            self.metadata = read_metadata(self.metadata_file)
+        return self.metadata
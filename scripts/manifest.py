@@ -0,0 +1,76 @@
+import os
+import json
+
+
+def file_signature(file_path):
+    # Identifies the content of a file by its path, size and modification
+    # time, without reading it
+    if (file_path is None) or (not os.path.exists(file_path)):
+        return None
+    stat = os.stat(file_path)
+    return [os.path.normpath(file_path), stat.st_size, stat.st_mtime_ns]
+
+
+class Manifest:
+    # Keeps track of what was used to build each output file of an image:
+    # the input files (with their size and modification time), the
+    # parameters and the version of the code that generated it. An output
+    # is up to date when it exists, was not modified afterwards and all of
+    # those are the same as the last time it was built. It is stored as a
+    # JSON file next to the image
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self.entries = {}
+        if os.path.exists(file_path):
+            try:
+                with open(file_path, 'r') as f:
+                    self.entries = json.load(f)
+            except (OSError, ValueError):
+                # A broken manifest only means everything gets rebuilt
+                self.entries = {}
+
+
+    def file_signature(self, file_path):
+        return file_signature(file_path)
+
+
+    def create_record(self, inputs, parameters, version):
+        record = {
+            "inputs": [self.file_signature(file_path) for file_path in inputs],
+            "parameters": parameters,
+            "version": version}
+        # Round trip so tuples and lists compare equal to what was loaded
+        return json.loads(json.dumps(record))
+
+
+    def is_up_to_date(self, output, inputs, parameters, version):
+        entry = self.entries.get(os.path.basename(output))
+        if (entry is None) or (not os.path.exists(output)):
+            return False
+        if None in [self.file_signature(file_path) for file_path in inputs]:
+            return False
+        return (entry["record"] == self.create_record(inputs, parameters, version) and
+                entry["output"] == self.file_signature(output)[1:])
+
+
+    def update(self, output, inputs, parameters, version, feature_names=None):
+        self.entries[os.path.basename(output)] = {
+            "record": self.create_record(inputs, parameters, version),
+            "output": self.file_signature(output)[1:],
+            "feature_names": list(feature_names or [])}
+
+
+    def get_feature_names(self, output):
+        entry = self.entries.get(os.path.basename(output))
+        if entry is None:
+            return []
+        return entry["feature_names"]
+
+
+    def save(self):
+        # Write to a temporary file first so an interrupted run never leaves
+        # a half written manifest
+        temporary_file = self.file_path + ".tmp"
+        with open(temporary_file, 'w') as f:
+            json.dump(self.entries, f, indent=1)
+        os.replace(temporary_file, self.file_path)
@@ -0,0 +1,62 @@
+import os
+import datetime
+
+
+# Parsed metadata files, kept for the whole QGIS session. Entries are keyed
+# by path and invalidated when the file changes
+_cache = {}
+
+
+class ImageMetadata:
+    # Typed record with the fields of a Landsat _MTL.txt file used by the
+    # plugin. Fields missing from the file are None. Every value is also
+    # available as text in the values dictionary
+    def __init__(self, values):
+        self.values = values
+        self.date = self.get_date("DATE_ACQUIRED")
+        self.scene_center_time = values.get("SCENE_CENTER_TIME")
+        self.spacecraft = values.get("SPACECRAFT_ID")
+        self.wrs_path = self.get_number("WRS_PATH", int)
+        self.wrs_row = self.get_number("WRS_ROW", int)
+        self.cloud_cover = self.get_number("CLOUD_COVER", float)
+        self.cloud_cover_land = self.get_number("CLOUD_COVER_LAND", float)
+        self.sun_azimuth = self.get_number("SUN_AZIMUTH", float)
+        self.sun_elevation = self.get_number("SUN_ELEVATION", float)
+        self.earth_sun_distance = self.get_number("EARTH_SUN_DISTANCE", float)
+
+
+    def get_date(self, key):
+        if key not in self.values:
+            return None
+        return datetime.datetime.strptime(self.values[key], "%Y-%m-%d").date()
+
+
+    def get_number(self, key, number_type):
+        if key not in self.values:
+            return None
+        return number_type(self.values[key])
+
+
+def parse_metadata(file):
+    # Reads every "KEY = value" line of the file once. Groups are not kept,
+    # if a key is repeated the first value is used
+    values = {}
+    with open(file, 'r') as f:
+        for line in f:
+            if "=" not in line:
+                continue
+            key, value = line.split("=", 1)
+            key = key.strip()
+            if (key in ["GROUP", "END_GROUP"]) or (key in values):
+                continue
+            values[key] = value.strip().strip('"')
+    return ImageMetadata(values)
+
+
+def read_metadata(file):
+    stat = os.stat(file)
+    key = os.path.normpath(os.path.abspath(file))
+    signature = (stat.st_size, stat.st_mtime_ns)
+    if (key not in _cache) or (_cache[key][0] != signature):
+        _cache[key] = (signature, parse_metadata(file))
+    return _cache[key][1]
@@ -0,0 +1,216 @@
+import numpy as np
+import hashlib
+import pickle
+import io
+import struct
+import json
+import zlib
+import os
+
+
+# A model file starts with the magic and the length of a JSON header, that
+# describes everything else: the arrays follow it, each one aligned so
+# uncompressed arrays can be memory mapped where they are, without reading
+# them
+MODEL_FILE_MAGIC = b"LUMBERJACK_MODEL"
+# Must be increased whenever the layout of the file changes
+MODEL_FILE_VERSION = 1
+ALIGNMENT = 64
+PREFIX = struct.Struct("<16sIQ")
+# Arrays of the model of at least this many bytes are stored apart from
+# its pickle, as arrays of the model file, so they can be mapped
+MODEL_ARRAY_BYTES = 1024
+
+
+def aligned(position):
+    return (position + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def dtype_description(dtype):
+    # dtype.str loses the fields of structured dtypes (as the nodes of the
+    # trees), so they are described as a dict that np.dtype() reads
+    if dtype.fields is None:
+        return dtype.str
+    return {
+        "names": list(dtype.names),
+        "formats": [dtype_description(dtype.fields[name][0]) for name in dtype.names],
+        "offsets": [dtype.fields[name][1] for name in dtype.names],
+        "itemsize": dtype.itemsize}
+
+
+def copy_array(array):
+    # Copies the bytes of an array as they are. np.array() leaves out the
+    # padding of structured dtypes, which would change the hash
+    return np.frombuffer(bytearray(array.tobytes()), dtype=array.dtype).reshape(array.shape)
+
+
+class ModelPickler(pickle.Pickler):
+    # Pickles a model leaving its large arrays out of the pickle
+    def __init__(self, file):
+        super().__init__(file, protocol=pickle.HIGHEST_PROTOCOL)
+        self.arrays = []
+        self.ids = {}
+
+    def persistent_id(self, obj):
+        if (isinstance(obj, np.ndarray) and not obj.dtype.hasobject
+                and obj.nbytes >= MODEL_ARRAY_BYTES):
+            if id(obj) not in self.ids:
+                self.ids[id(obj)] = len(self.arrays)
+                self.arrays.append(obj)
+            return self.ids[id(obj)]
+        return None
+
+
+class ModelUnpickler(pickle.Unpickler):
+    def __init__(self, file, arrays):
+        super().__init__(file)
+        self.arrays = arrays
+
+    def persistent_load(self, pid):
+        return self.arrays[pid]
+
+
+def pickle_model(model):
+    # Arrays of the model file that store the model: the pickle as
+    # "model" and its large arrays as "model.0", "model.1"...
+    file = io.BytesIO()
+    pickler = ModelPickler(file)
+    pickler.dump(model)
+    arrays = {"model": np.frombuffer(file.getvalue(), dtype=np.uint8)}
+    for i, array in enumerate(pickler.arrays):
+        arrays["model.{}".format(i)] = array
+    return arrays
+
+
+def is_model_file(file_name):
+    with open(file_name, 'rb') as f:
+        return f.read(len(MODEL_FILE_MAGIC)) == MODEL_FILE_MAGIC
+
+
+def write_model_file(file_name, header, arrays, compress=False):
+    # header is anything that can be saved as JSON, arrays a dict of NumPy
+    # arrays. Compressed arrays are smaller but are read into memory
+    buffers = {}
+    entries = {}
+    for name, array in arrays.items():
+        array = np.ascontiguousarray(array)
+        data = array.tobytes()
+        if compress:
+            data = zlib.compress(data)
+        buffers[name] = data
+        entries[name] = {
+            "dtype": dtype_description(array.dtype),
+            "shape": list(array.shape),
+            "compressed": compress,
+            "length": len(data),
+            "sha256": hashlib.sha256(data).hexdigest()}
+
+    # Offsets depend on the length of the header, which holds them, so
+    # they are relative to the end of the header
+    position = 0
+    for name in buffers:
+        position = aligned(position)
+        entries[name]["offset"] = position
+        position += entries[name]["length"]
+    header = dict(header, arrays=entries)
+    header_data = json.dumps(header).encode("utf-8")
+    data_start = aligned(PREFIX.size + len(header_data))
+
+    # Written to a temporary file first, so a model file being mapped by
+    # another session is never modified
+    temporary_file = file_name + ".tmp"
+    with open(temporary_file, 'wb') as f:
+        f.write(PREFIX.pack(MODEL_FILE_MAGIC, MODEL_FILE_VERSION, len(header_data)))
+        f.write(header_data)
+        for name, data in buffers.items():
+            f.seek(data_start + entries[name]["offset"])
+            f.write(data)
+        # Empty arrays at the end are aligned past the last byte written
+        f.truncate(data_start + position)
+    try:
+        os.replace(temporary_file, file_name)
+    except PermissionError:
+        # Windows doesn't replace files that are mapped
+        os.remove(temporary_file)
+        raise PermissionError(
+            "Can't replace {}, it may be open in another session. Export the classifier "
+            "to another file".format(file_name))
+
+
+class ModelFile:
+    # Reads the header of a model file. Arrays are only read when asked
+    # for, and uncompressed ones are memory mapped, so several sessions
+    # predicting with the same model share its pages
+    def __init__(self, file_name):
+        self.file_name = file_name
+        with open(file_name, 'rb') as f:
+            prefix = f.read(PREFIX.size)
+            if len(prefix) < PREFIX.size:
+                raise ValueError("Not a model file: " + file_name)
+            magic, version, header_length = PREFIX.unpack(prefix)
+            if magic != MODEL_FILE_MAGIC:
+                raise ValueError("Not a model file: " + file_name)
+            if version != MODEL_FILE_VERSION:
+                raise ValueError("Unsupported version {} of model file: {}".format(version, file_name))
+            self.header = json.loads(f.read(header_length).decode("utf-8"))
+        self.data_start = aligned(PREFIX.size + header_length)
+        self.entries = self.header["arrays"]
+        # Mapped arrays are not checked against their hash (it would read
+        # all of them), but a truncated file is found here
+        file_size = os.path.getsize(file_name)
+        for name, entry in self.entries.items():
+            if entry["length"] > 0 and self.data_start + entry["offset"] + entry["length"] > file_size:
+                raise ValueError("Model file {} is truncated, array {} is incomplete".format(file_name, name))
+
+
+    def __contains__(self, name):
+        return name in self.entries
+
+
+    def read_data(self, name):
+        # Stored bytes of an array, checked against their hash
+        entry = self.entries[name]
+        with open(self.file_name, 'rb') as f:
+            f.seek(self.data_start + entry["offset"])
+            data = f.read(entry["length"])
+        if hashlib.sha256(data).hexdigest() != entry["sha256"]:
+            raise ValueError("Array {} of {} is corrupted".format(name, self.file_name))
+        return data
+
+
+    def read_bytes(self, name):
+        # Contents of a (small) array as bytes, checked against their hash
+        data = self.read_data(name)
+        if self.entries[name]["compressed"]:
+            data = zlib.decompress(data)
+        return data
+
+
+    def model_names(self):
+        # Names of the arrays that store the model
+        names = ["model"]
+        while "model.{}".format(len(names) - 1) in self.entries:
+            names.append("model.{}".format(len(names) - 1))
+        return names
+
+
+    def load_model(self, copy=False):
+        # Rebuilds the model from its pickle and its arrays, which stay
+        # mapped from the file unless copied. Models saved as a single
+        # pickle have no arrays
+        arrays = [self.array(name) for name in self.model_names()[1:]]
+        if copy:
+            arrays = [copy_array(array) for array in arrays]
+        return ModelUnpickler(io.BytesIO(self.read_bytes("model")), arrays).load()
+
+
+    def array(self, name):
+        entry = self.entries[name]
+        dtype = np.dtype(entry["dtype"])
+        shape = tuple(entry["shape"])
+        if entry["compressed"]:
+            return np.frombuffer(zlib.decompress(self.read_data(name)), dtype=dtype).reshape(shape)
+        if entry["length"] == 0:
+            return np.empty(shape, dtype=dtype)
+        return np.memmap(
+            self.file_name, dtype=dtype, mode='r', offset=self.data_start + entry["offset"], shape=shape)
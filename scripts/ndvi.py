@@ -3,6 +3,21 @@ from osgeo import gdal
 from osgeo import gdal_array
 import numpy as np
 import time
+try:
+    from .output_profile import create_tiff
+except ImportError:
+    # Run as a script from the command line
+    from output_profile import create_tiff
+
+
+# Bands of the merged image (Landsat 8)
+RED_BAND = 4
+NIR_BAND = 5
+
+
+def ndvi_from_bands(red, nir):
+    # NDVI = (NIR - Red) / (NIR + Red)
+    return (nir - red) / (red + nir)
 
 
 def calculate_ndvi(dataset):
@@ -14,23 +29,20 @@ def calculate_ndvi(dataset):
 
     # Read Red band
     b_red = 0
-    band = dataset.GetRasterBand(4)
+    band = dataset.GetRasterBand(RED_BAND)
     image[:, :, b_red] = band.ReadAsArray()
 
     # Read NIR band
     b_nir = 1
-    band = dataset.GetRasterBand(5)
+    band = dataset.GetRasterBand(NIR_BAND)
     image[:, :, b_nir] = band.ReadAsArray()
 
-    # NDVI = (NIR - Red) / (NIR + Red)
-    ndvi = ((image[:, :, b_nir] - image[:, :, b_red]) / (image[:, :, b_red] + image[:, :, b_nir]))
-    return ndvi
+    return ndvi_from_bands(image[:, :, b_red], image[:, :, b_nir])
 
 
 def output_tiff(dataset, ndvi, file_output):
-    memory_driver = gdal.GetDriverByName('GTiff')
-    out_raster_ds = memory_driver.Create(
-        file_output, dataset.RasterXSize, dataset.RasterYSize, 1, gdal.GDT_Float32)
+    out_raster_ds = create_tiff(
+        file_output, dataset.RasterXSize, dataset.RasterYSize, 1, gdal.GDT_Float32, "feature")
     # Set projection taken from the original image and also set GeoTransform,
     # which defines the position of the top left pixel, among
     # with the resolution and orientation. It's taken from the original image.
@@ -0,0 +1,58 @@
+from osgeo import gdal
+
+
+# Creation options of every GeoTIFF written by the plugin, given by the kind
+# of product. All of them are tiled and become BigTIFF when they may not fit
+# in a classic TIFF. Stacks are pixel interleaved because they are read one
+# pixel (all of its features) at a time when sampling and predicting. Files
+# updated in place (the corrected DEM) are not compressed, as rewriting
+# compressed blocks makes the file grow
+PROFILES = {
+    "merged": {"compress": "ZSTD", "interleave": "BAND"},
+    "feature": {"compress": "ZSTD", "interleave": "BAND"},
+    "stack": {"compress": "ZSTD", "interleave": "PIXEL"},
+    "prediction": {"compress": "DEFLATE", "interleave": "BAND"},
+    "mask": {"compress": "DEFLATE", "interleave": "BAND"},
+    "dem": {"compress": None, "interleave": "BAND"},
+}
+BLOCK_SIZE = 256
+
+INTEGER_TYPES = [gdal.GDT_Int16, gdal.GDT_UInt16, gdal.GDT_Int32, gdal.GDT_UInt32]
+FLOAT_TYPES = [gdal.GDT_Float32, gdal.GDT_Float64]
+
+
+def supports_compression(compress):
+    option_list = gdal.GetDriverByName('GTiff').GetMetadataItem('DMD_CREATIONOPTIONLIST') or ""
+    return compress in option_list
+
+
+def get_predictor(data_type):
+    # Horizontal differencing for integers and floating point predictor for
+    # floats. Byte products are class labels, which compress better as is
+    if data_type in FLOAT_TYPES:
+        return 3
+    if data_type in INTEGER_TYPES:
+        return 2
+    return 1
+
+
+def get_creation_options(product, data_type):
+    profile = PROFILES[product]
+    options = [
+        "TILED=YES", "BLOCKXSIZE={}".format(BLOCK_SIZE), "BLOCKYSIZE={}".format(BLOCK_SIZE),
+        "BIGTIFF=IF_SAFER", "INTERLEAVE={}".format(profile["interleave"])]
+
+    compress = profile["compress"]
+    if compress is not None:
+        # ZSTD is not available in older GDAL builds
+        if not supports_compression(compress):
+            compress = "DEFLATE"
+        options.append("COMPRESS={}".format(compress))
+        options.append("PREDICTOR={}".format(get_predictor(data_type)))
+    return options
+
+
+def create_tiff(file_name, xsize, ysize, bands, data_type, product):
+    driver = gdal.GetDriverByName('GTiff')
+    return driver.Create(
+        file_name, xsize, ysize, bands, data_type, options=get_creation_options(product, data_type))
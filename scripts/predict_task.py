@@ -1,16 +1,118 @@
 from .preprocess_task import *
+from .feature_stack import FeatureStack
+from .classifier import PREDICTION_TILE_SIZE
+from .fused_features import FusedFeatures, fused_fingerprint
+from .prediction_cache import PredictionCache
+from .manifest import file_signature
 
 
 class PredictTask(PreProcessTask):
-    def __init__(self, directory, classifier, lumberjack_instance):
+    def __init__(
+            self, directory, classifier, lumberjack_instance,
+            tile_size=PREDICTION_TILE_SIZE, prediction_workers=1, features=None, fused=False,
+            required_names=None, scene_workers=1, cache_size=0):
         super().__init__("Lumberjack prediction", QgsTask.CanCancel)
         self.directory = directory
         self.classifier = classifier
         self.li = lumberjack_instance
+        self.tile_size = tile_size
+        self.prediction_workers = prediction_workers
+        # Scenes predicted at the same time, each one by prediction_workers
+        # threads. The memory used grows with both
+        self.scene_workers = scene_workers
+        # Predictions are reused while they take less than cache_size bytes
+        self.cache = None
+        if cache_size > 0:
+            self.cache = PredictionCache(
+                os.path.join(directory, Lumberjack.PREDICTION_CACHE_DIRECTORY), cache_size)
+        # Output files of the images whose prediction was reused, and the
+        # files that have it
+        self.reused = {}
+        self.features = features
+        self.fused = fused
+        self.required_names = required_names
         self.output_files = []
+        self.tree_evaluations = None
         self.exception = None
 
 
+    def get_fused_features(self, image, extension):
+        # The features are calculated while predicting, from the cropped
+        # bands, so only the prediction is written
+        source = FusedFeatures(
+            self.features, image, self.crop_bands(image, extension), self.required_names)
+        model_names = self.classifier.get_feature_names()
+        if model_names and tuple(source.feature_names) != model_names:
+            raise ValueError(
+                "The features {} don't match the ones of the classifier {}".format(
+                    source.feature_names, list(model_names)))
+        return source
+
+
+    def get_prediction_key(self, image, extension, place):
+        # Everything the prediction of an image depends on
+        if self.fused:
+            source = fused_fingerprint(self.features, image, self.get_band_files(image))
+            features = [
+                [type(feature).__name__, feature.VERSION, feature.get_parameters()]
+                for feature in self.features]
+            extension_signature = file_signature(place.extension_file_path)
+        else:
+            source = FeatureStack(self.get_stack_file_name(image)).fingerprint()
+            features = None
+            extension_signature = None
+        return self.cache.create_key({
+            "model": self.classifier.get_fingerprint(),
+            "fused": self.fused,
+            "source": source,
+            "features": features,
+            "extension": extension_signature,
+            "required_names": self.required_names})
+
+
+    def predict_image(self, image, extension, output_file, place):
+        # Runs in a worker thread, which opens its own datasets. The
+        # classifier (and its model) is shared by every thread
+        if self.cache is not None:
+            key = self.get_prediction_key(image, extension, place)
+            reused_file = self.cache.get(key, output_file)
+            if reused_file is not None:
+                self.reused[output_file] = reused_file
+                return True
+
+        if self.fused:
+            source = self.get_fused_features(image, extension)
+        else:
+            source = FeatureStack(self.get_stack_file_name(image))
+        completed = self.classifier.predict_source(
+            source, output_file, self.tile_size, self.prediction_workers, self.isCanceled)
+        if completed and self.cache is not None:
+            self.cache.put(key, output_file)
+        return completed
+
+
+    def predict_parallel(self, jobs):
+        # Returns False if the task was canceled
+        print("Predicting {} images, {} at a time".format(len(jobs), self.scene_workers))
+        completed = True
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.scene_workers) as executor:
+            futures = [executor.submit(self.predict_image, *job) for job in jobs]
+            try:
+                done = 0
+                for future in concurrent.futures.as_completed(futures):
+                    if not future.result():
+                        completed = False
+                    done += 1
+                    self.setProgress(100 * done / len(jobs))
+                    if self.isCanceled() or not completed:
+                        completed = False
+                        break
+            finally:
+                for future in futures:
+                    future.cancel()
+        return completed
+
+
     def run(self):
         try:
             QgsMessageLog.logMessage('Started task "{}"'.format(
@@ -21,26 +123,46 @@ class PredictTask(PreProcessTask):
             self.start_time = time.time()
 
             places = self.obtain_places(self.directory)
+            self.classifier.reset_tree_evaluations()
+            if self.fused:
+                self.select_required_features(places)
 
-            self.output_files = []
+            # Output files keep the order of the places and images, whatever
+            # the order the scenes finish in
+            jobs = []
             for place in places:
+                extension = None
+                if self.fused:
+                    extension = self.calculate_extension(place.extension_file_path)
                 for image in place.images:
                     # Create the output filename
-                    file_name_stack = os.path.join(image.path, "{}{}".format(image.base_name, Lumberjack.STACK_SUFFIX))
                     time_stamp = self.start_time_str[:19]
                     output_file = os.path.join(
                         image.path, "{}_{}{}".format(
                             image.base_name,
                             time_stamp.replace(" ", "_").replace(":","-"),
                             Lumberjack.PREDICTION_SUFFIX))
-                    # Add the output file to array
-                    self.output_files.append(output_file)
+                    jobs.append((image, extension, output_file, place))
+            self.output_files = [job[2] for job in jobs]
 
-                    # Predict the image with the classifier
-                    self.classifier.predict_an_image(file_name_stack, output_file)
+            # Predict the images with the classifier
+            self.reused = {}
+            if self.cache is not None:
+                # Hashes the model once, before the threads need it
+                self.classifier.get_fingerprint()
+            if not self.predict_parallel(jobs):
+                return False
+            if self.cache is not None:
+                print("Reused {} of {} predictions".format(len(self.reused), len(jobs)))
+                self.cache.evict()
+                # Unchanged predictions of earlier runs are not copied again
+                self.output_files = [self.reused.get(f, f) for f in self.output_files]
 
             self.elapsed_time = time.time() - self.start_time
             print("Finished training in {} seconds".format(str(self.elapsed_time)))
+            self.tree_evaluations = self.classifier.get_tree_evaluations_report()
+            if self.tree_evaluations is not None:
+                print(self.tree_evaluations)
 
             if self.isCanceled():
                 return False
@@ -60,7 +182,8 @@ class PredictTask(PreProcessTask):
 
             # Return all the output files so they can be added (or not)
             # to the QGIS canvas
-            self.li.notify_prediction(self.start_time_str, self.output_files, self.elapsed_time)
+            self.li.notify_prediction(
+                self.start_time_str, self.output_files, self.elapsed_time, self.tree_evaluations)
 
         else:
             if self.exception is None:
@@ -0,0 +1,119 @@
+import os
+import json
+import shutil
+import hashlib
+import threading
+from .manifest import file_signature
+
+
+# Must be increased whenever the way predictions are made changes, so
+# older results are not used
+PREDICTION_CACHE_VERSION = 1
+PREDICTION_CACHE_EXTENSION = ".tif"
+# Next to each prediction, the last output file it was placed in
+PREDICTION_OUTPUT_EXTENSION = ".json"
+
+
+def copy_file(source, destination):
+    # Predictions are always copied, never hard linked. A link would share
+    # the pixels of the cache with the output, and editing or predicting
+    # over the output in place would change the cached prediction too.
+    # The copy is written to a temporary file first so an interrupted run
+    # never leaves a half written file
+    temporary_file = destination + ".tmp"
+    shutil.copyfile(source, temporary_file)
+    os.replace(temporary_file, destination)
+
+
+class PredictionCache:
+    # Keeps the predictions in a directory, named after a key. The key is a
+    # hash of everything a prediction depends on (the classifier and the
+    # files its features are read from), so a prediction is only reused
+    # when predicting again would give the same one. When the predictions
+    # take more than max_bytes, the least recently used ones are removed.
+    # A prediction is only copied to a new output file when the last one it
+    # was placed in was removed or modified
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+
+
+    def create_key(self, parts):
+        parts = dict(parts, version=PREDICTION_CACHE_VERSION)
+        return hashlib.sha256(json.dumps(parts, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+    def get_file_name(self, key):
+        return os.path.join(self.directory, key[:32] + PREDICTION_CACHE_EXTENSION)
+
+
+    def get_output_record_name(self, key):
+        return os.path.join(self.directory, key[:32] + PREDICTION_OUTPUT_EXTENSION)
+
+
+    def get_last_output(self, key):
+        # The last output file of the key, if it is as it was left
+        try:
+            with open(self.get_output_record_name(key), 'r') as f:
+                record = json.load(f)
+            output_file = record["output_file"]
+            signature = record["signature"]
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+        if signature is None or file_signature(output_file) != signature:
+            return None
+        return output_file
+
+
+    def record_output(self, key, output_file):
+        with open(self.get_output_record_name(key), 'w') as f:
+            json.dump({"output_file": output_file, "signature": file_signature(output_file)}, f)
+
+
+    def get(self, key, output_file):
+        # Returns the file with the prediction of the key: the last output
+        # file it was placed in if it is unchanged, otherwise output_file
+        # with a copy of it. Returns None if there is none
+        file_name = self.get_file_name(key)
+        with self.lock:
+            if not os.path.exists(file_name):
+                return None
+            # The modification time tells which predictions were used last
+            os.utime(file_name)
+            last_output = self.get_last_output(key)
+            if last_output is not None:
+                print("Prediction reused from " + last_output)
+                return last_output
+            copy_file(file_name, output_file)
+            self.record_output(key, output_file)
+        print("Prediction reused from " + file_name)
+        return output_file
+
+
+    def put(self, key, output_file):
+        with self.lock:
+            os.makedirs(self.directory, exist_ok=True)
+            copy_file(output_file, self.get_file_name(key))
+            self.record_output(key, output_file)
+
+
+    def evict(self):
+        if not os.path.isdir(self.directory):
+            return
+        with self.lock:
+            entries = []
+            for entry in os.scandir(self.directory):
+                if entry.is_file() and entry.name.endswith(PREDICTION_CACHE_EXTENSION):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+            total = sum(size for _, size, _ in entries)
+            for _, size, file_name in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                os.remove(file_name)
+                output_record = file_name[:-len(PREDICTION_CACHE_EXTENSION)] + PREDICTION_OUTPUT_EXTENSION
+                if os.path.exists(output_record):
+                    os.remove(output_record)
+                total -= size
+                print("Removed cached prediction " + file_name)
@@ -1,17 +1,144 @@
 from qgis.core import (QgsApplication, QgsTask, QgsMessageLog, Qgis)
 import os
-import subprocess
+import copy
 import time
 import datetime
+import concurrent.futures
+from xml.sax.saxutils import escape
 from osgeo import gdal
 from osgeo import ogr
 import numpy as np
 from .image import Image
 from .place import Place
 from .classifier import Classifier
+from .manifest import Manifest
+from . import blocks
+from .output_profile import create_tiff
+from .features import select_features
 from .. import Lumberjack
 
 
+# Versions of the code that generates the merged image and the stack, used
+# to find outdated files when running incrementally
+CROP_MERGE_VERSION = 1
+STACK_VERSION = 3
+
+
+def crop_band(file_name, minx, maxy, maxx, miny):
+    # The crop is done in memory with a virtual dataset, so no subprocess is
+    # spawned and no crop files are written
+    return gdal.Translate(
+        "", file_name, format="VRT", projWin=[minx, maxy, maxx, miny], outputType=gdal.GDT_Int16)
+
+
+def crop_and_merge_images(file_name_band, file_name_merged, minx, maxy, maxx, miny):
+    # Crops every band according to the extension and writes it straight
+    # into the merged image
+    print("File Name Merged: " + file_name_merged)
+    output_dataset = None
+    buffers = {}
+    for i in range(1, Lumberjack.BAND_TOTAL + 1):
+        cropped_dataset = crop_band(file_name_band.format(i), minx, maxy, maxx, miny)
+
+        if output_dataset is None:
+            output_dataset = create_tiff(
+                file_name_merged, cropped_dataset.RasterXSize, cropped_dataset.RasterYSize,
+                Lumberjack.BAND_TOTAL, gdal.GDT_Int16, "merged")
+            output_dataset.SetGeoTransform(cropped_dataset.GetGeoTransform())
+            output_dataset.SetProjection(cropped_dataset.GetProjection())
+
+        band = cropped_dataset.GetRasterBand(1)
+        outband = output_dataset.GetRasterBand(i)
+        outband.SetDescription(band.GetDescription())
+        blocks.copy_band(band, outband, buffers)
+        cropped_dataset = None
+    output_dataset = None
+
+
+def pre_process_image(image, extension, features, incremental=False):
+    # Runs the crop, merge and features chain of a single image. Features
+    # set their names while executing, so the image works on its own copies
+    # and several images can run at once in worker threads. Returns the
+    # feature names found by each feature, which are assigned in directory
+    # order by the task.
+    # When running incrementally, outputs which are up to date according to
+    # the image's manifest are not generated again
+    print("Landsat image directory: {}".format(image.path))
+    minx, maxy, maxx, miny = extension
+
+    file_name_band = os.path.join(image.path, "{}{}".format(image.base_name, Lumberjack.BAND_SUFFIX))
+    file_name_merged = os.path.join(image.path, "{}{}".format(image.base_name, Lumberjack.MERGED_SUFFIX))
+    manifest = None
+    if incremental:
+        manifest = Manifest(get_manifest_file_name(image))
+
+    # Crop all bands according to the extent file and merge them
+    band_files = [file_name_band.format(i) for i in range(1, Lumberjack.BAND_TOTAL + 1)]
+    parameters = {"extension": [minx, maxy, maxx, miny]}
+    if (manifest is not None) and manifest.is_up_to_date(
+            file_name_merged, band_files, parameters, CROP_MERGE_VERSION):
+        print("Up to date: " + file_name_merged)
+    else:
+        crop_and_merge_images(file_name_band, file_name_merged, minx, maxy, maxx, miny)
+        if manifest is not None:
+            manifest.update(file_name_merged, band_files, parameters, CROP_MERGE_VERSION)
+
+    features = [copy_feature(feature) for feature in features]
+    for feature in features:
+        if (manifest is None) or (not feature.generates_file):
+            feature.execute(file_name_merged, image)
+            continue
+
+        file_out = feature.get_file_name(image)
+        inputs = feature.get_inputs(file_name_merged, image)
+        parameters = feature.get_parameters()
+        if manifest.is_up_to_date(file_out, inputs, parameters, feature.VERSION):
+            print("Up to date: " + file_out)
+            if not feature.feature_names:
+                feature.feature_names = manifest.get_feature_names(file_out)
+        else:
+            feature.execute(file_name_merged, image)
+            manifest.update(file_out, inputs, parameters, feature.VERSION, feature.feature_names)
+
+    if manifest is not None:
+        manifest.save()
+    return [list(feature.feature_names) for feature in features]
+
+
+def copy_feature(feature):
+    # Copy of a feature whose names can be set without changing the original
+    feature = copy.copy(feature)
+    feature.feature_names = list(feature.feature_names)
+    return feature
+
+
+def get_manifest_file_name(image):
+    return os.path.join(image.path, "{}{}".format(image.base_name, Lumberjack.MANIFEST_SUFFIX))
+
+
+def create_executor(workers):
+    # Scenes are processed in a pool of threads. GDAL and most of NumPy
+    # release the GIL while working, and forking the threads of QGIS could
+    # deadlock on their locks (besides, fork is not available on Windows)
+    return concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+
+
+def check_band_sources(band_sources, file_name):
+    # The size and georeference of a stack are taken from its first band,
+    # scalar features (as the day) have none to give
+    if not band_sources:
+        raise ValueError(
+            "No raster features to write in {}. Scalar features need at least one raster "
+            "feature".format(file_name))
+
+
+def split_threads(workers):
+    # Threads each image may use when workers images run at once, so the
+    # pools of the features (e.g. the textures) don't oversubscribe the
+    # cores
+    return max(1, (os.cpu_count() or 1) // workers)
+
+
 class PreProcessTask(QgsTask):
 
     def obtain_places(self, root_directory):
@@ -25,7 +152,8 @@ class PreProcessTask(QgsTask):
         root_directory = os.path.normpath(root_directory)
         places = []
         for place_directory in os.scandir(root_directory):
-            if (place_directory.is_dir()):
+            # Hidden directories (as the prediction cache) are not places
+            if (place_directory.is_dir() and not place_directory.name.startswith(".")):
                 place = Place(place_directory.path)
 
                 for img_directory_or_file in os.scandir(place.directory_path):
@@ -62,78 +190,196 @@ class PreProcessTask(QgsTask):
         return minx, maxy, maxx, miny
 
 
-    def crop_images(self, file_name_band, file_name_crop, minx, maxy, maxx, miny):
-        # Crops all images according to the extension.
-        for i in range(1, Lumberjack.BAND_TOTAL + 1):
-            # Crop image to extension
-            command_translate = ("gdal_translate -projwin {} {} {} {} -ot Int16 -of GTiff \"{}\" \"{}\"")
-            subprocess.call(command_translate.format(
-                minx, maxy, maxx, miny, file_name_band.format(i),
-                file_name_crop.format(i)), stdout=open(os.devnull, 'wb'), shell=True)
+    def get_band_files(self, image):
+        file_name_band = os.path.join(image.path, "{}{}".format(image.base_name, Lumberjack.BAND_SUFFIX))
+        return [file_name_band.format(i) for i in range(1, Lumberjack.BAND_TOTAL + 1)]
+
+
+    def crop_bands(self, image, extension):
+        # Cropped bands of an image, as in the merged image
+        minx, maxy, maxx, miny = extension
+        return [crop_band(file_name, minx, maxy, maxx, miny) for file_name in self.get_band_files(image)]
+
+
+    def get_band_sources(self, files):
+        # (file, band) pairs of every band of the files, in order
+        band_sources = []
+        for file_path in files:
+            dataset = gdal.Open(file_path, gdal.GA_ReadOnly)
+            band_sources.extend([(file_path, j+1) for j in range(dataset.RasterCount)])
+        return band_sources
 
 
-    def merge_images(self, files, file_name_merged, bands_amount, data_type):
-        bands_acum = 0
+    def merge_images(self, band_sources, file_name_merged, data_type, band_names=None):
+        # Writes the given (file, band) pairs as the bands of a new file.
+        # Bands are described with band_names, or with the description of
+        # their source
         output_dataset = None
         print("File Name Merged: " + file_name_merged)
+        check_band_sources(band_sources, file_name_merged)
 
-        dataset = gdal.Open(files[0], gdal.GA_ReadOnly)
-        driver = gdal.GetDriverByName('GTiff')
-        output_dataset = driver.Create(
-            file_name_merged, dataset.RasterXSize, dataset.RasterYSize, bands_amount, data_type)
+        dataset = gdal.Open(band_sources[0][0], gdal.GA_ReadOnly)
+        output_dataset = create_tiff(
+            file_name_merged, dataset.RasterXSize, dataset.RasterYSize, len(band_sources), data_type, "stack")
         output_dataset.SetGeoTransform(dataset.GetGeoTransform())
         output_dataset.SetProjection(dataset.GetProjection())
         dataset = None
 
-        for i, file_path in enumerate(files):
-            dataset = gdal.Open(file_path, gdal.GA_ReadOnly)
-            for j in range(dataset.RasterCount):
-                bands_acum += 1
-                band_read = dataset.GetRasterBand(j+1).ReadAsArray()
-                outband = output_dataset.GetRasterBand(bands_acum)
-                outband.SetDescription(dataset.GetRasterBand(j+1).GetDescription())
-                outband.WriteArray(band_read)
+        # Pair every source band with its band of the output
+        datasets = {}
+        band_pairs = []
+        for i, (file_path, band_number) in enumerate(band_sources):
+            if file_path not in datasets:
+                datasets[file_path] = gdal.Open(file_path, gdal.GA_ReadOnly)
+            band = datasets[file_path].GetRasterBand(band_number)
+            outband = output_dataset.GetRasterBand(i + 1)
+            outband.SetDescription(band.GetDescription() if band_names is None else band_names[i])
+            band_pairs.append((band, outband))
+
+        # The stack is pixel interleaved, so every band of a block is written
+        # before moving to the next one. Otherwise each compressed block
+        # would be rewritten once per band. Memory is given by the block
+        # size, not by the size of the images nor the amount of bands
+        buffers = {}
+        block_xsize, block_ysize = output_dataset.GetRasterBand(1).GetBlockSize()
+        windows = blocks.block_windows(
+            output_dataset.RasterXSize, output_dataset.RasterYSize, block_xsize, block_ysize)
+        for xoff, yoff, xsize, ysize in windows:
+            for band, outband in band_pairs:
+                blocks.copy_window(band, outband, xoff, yoff, xsize, ysize, buffers, block_ysize, block_xsize)
+        datasets = None
+        output_dataset = None
 
 
-    def calculate_total_features(self, files):
-        total = 0
-        for file in files:
-            dataset = gdal.Open(file, gdal.GA_ReadOnly)
-            total += dataset.RasterCount
-        return total
+    def build_virtual_stack(self, band_sources, file_name_stack, data_type, band_names=None, reference_file=None):
+        # Creates a GDAL VRT that references the given (file, band) pairs
+        # instead of copying their pixels. Sources are stored relative to the
+        # VRT so the directory can be moved around. The size and georeference
+        # are taken from reference_file when given, so a stack of scalar
+        # features only has them too
+        print("File Name Stack: " + file_name_stack)
+        if reference_file is None:
+            check_band_sources(band_sources, file_name_stack)
+            reference_file = band_sources[0][0]
+
+        dataset = gdal.Open(reference_file, gdal.GA_ReadOnly)
+        driver = gdal.GetDriverByName('VRT')
+        output_dataset = driver.Create(file_name_stack, dataset.RasterXSize, dataset.RasterYSize, 0)
+        output_dataset.SetGeoTransform(dataset.GetGeoTransform())
+        output_dataset.SetProjection(dataset.GetProjection())
+        dataset = None
+
+        source_xml = (
+            '<SimpleSource>'
+            '<SourceFilename relativeToVRT="1">{}</SourceFilename>'
+            '<SourceBand>{}</SourceBand>'
+            '</SimpleSource>')
+        stack_directory = os.path.dirname(file_name_stack)
+        datasets = {}
+        for i, (file_path, band_number) in enumerate(band_sources):
+            if file_path not in datasets:
+                datasets[file_path] = gdal.Open(file_path, gdal.GA_ReadOnly)
+            relative_path = os.path.relpath(file_path, stack_directory)
+            output_dataset.AddBand(data_type)
+            outband = output_dataset.GetRasterBand(output_dataset.RasterCount)
+            if band_names is None:
+                outband.SetDescription(datasets[file_path].GetRasterBand(band_number).GetDescription())
+            else:
+                outband.SetDescription(band_names[i])
+            outband.SetMetadataItem(
+                "source_0", source_xml.format(escape(relative_path), band_number), "new_vrt_sources")
+        datasets = None
+        output_dataset = None
+
+
+    def get_stack_file_name(self, image):
+        # The stack may have been written as a GeoTIFF or as a VRT. Both are
+        # read the same way with GDAL, so the consumers only need the path
+        file_name_vrt = os.path.join(image.path, "{}{}".format(image.base_name, Lumberjack.STACK_VRT_SUFFIX))
+        if os.path.exists(file_name_vrt):
+            return file_name_vrt
+        return os.path.join(image.path, "{}{}".format(image.base_name, Lumberjack.STACK_SUFFIX))
+
+
+    def select_required_features(self, places):
+        # When the names of the features are given, only the features (and
+        # bands) that give them are calculated. The first image is used to
+        # find the names of the features read from files
+        if self.required_names is None:
+            return
+        for place in places:
+            for image in place.images:
+                self.features = select_features(self.features, self.required_names, image)
+                return
 
 
     def pre_process_images(self, places):
+        # image represent each landsat image (a folder with the bands). Each
+        # one is independent from the others, so they can run in parallel
+        jobs = []
         for place in places:
-            minx, maxy, maxx, miny = self.calculate_extension(
-                place.extension_file_path)
+            extension = self.calculate_extension(place.extension_file_path)
             for image in place.images:
-                # image represent each landsat image (a folder with the bands)
-                print("Landsat image directory: {}".format(image.path))
+                jobs.append((image, extension))
+
+        threads = split_threads(max(1, min(self.workers, len(jobs))))
+        for feature in self.features:
+            feature.threads = threads
+
+        if self.workers > 1 and len(jobs) > 1:
+            results = self.pre_process_parallel(jobs)
+        else:
+            results = []
+            for i, (image, extension) in enumerate(jobs):
+                if self.isCanceled():
+                    return False
+                results.append(pre_process_image(image, extension, self.features, self.incremental))
+                self.setProgress(100 * (i + 1) / len(jobs))
+        if results is None:
+            return False
 
-                file_name_band = os.path.join(image.path, "{}{}".format(image.base_name, Lumberjack.BAND_SUFFIX))
-                file_name_crop = "{}{}".format(file_name_band[:-4], Lumberjack.CROP_SUFFIX)
-                file_name_merged = os.path.join(image.path, "{}{}".format(image.base_name, Lumberjack.MERGED_SUFFIX))
+        # Names are taken from the first image in directory order that gives
+        # them, however the images were run
+        for i, feature in enumerate(self.features):
+            for image_feature_names in results:
+                if image_feature_names[i]:
+                    feature.feature_names = image_feature_names[i]
+                    break
+        return True
 
-                # Crop all bands according to the extent file
-                self.crop_images(file_name_band, file_name_crop, minx, maxy, maxx, miny)
 
-                # Merge all bands
-                files_to_merge = []
-                for i in range(1, Lumberjack.BAND_TOTAL + 1):
-                    files_to_merge.append(file_name_crop.format(i))
-                self.merge_images(files_to_merge, file_name_merged, Lumberjack.BAND_TOTAL, gdal.GDT_Int16)
-                for file in files_to_merge:
-                    if os.path.exists(file):
-                        os.remove(file)
+    def pre_process_parallel(self, jobs):
+        # Returns the results in the same order as the jobs, or None if the
+        # task was canceled
+        print("Pre-processing {} images with {} workers".format(len(jobs), self.workers))
+        results = [None] * len(jobs)
+        executor = create_executor(self.workers)
+        try:
+            futures = {}
+            for i, (image, extension) in enumerate(jobs):
+                future = executor.submit(pre_process_image, image, extension, self.features, self.incremental)
+                futures[future] = i
 
-                for feature in self.features:
-                    feature.execute(file_name_merged, image)
+            done = 0
+            for future in concurrent.futures.as_completed(futures):
+                results[futures[future]] = future.result()
+                done += 1
+                self.setProgress(100 * done / len(jobs))
+                if self.isCanceled():
+                    for pending in futures:
+                        pending.cancel()
+                    return None
+        finally:
+            executor.shutdown(wait=True)
+        return results
 
 
     def __init__(self, description, task):
         super().__init__(description, task)
         self.exception = None
+        self.workers = 1
+        self.incremental = False
+        self.required_names = None
 
 
     def run(self):
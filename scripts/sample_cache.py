@@ -0,0 +1,88 @@
+import os
+import glob
+import json
+import zipfile
+import hashlib
+import numpy as np
+
+
+# Must be increased whenever the way samples are extracted changes, so
+# older files are not used
+SAMPLE_CACHE_VERSION = 1
+# Saved next to the image, with the start of the key
+SAMPLES_SUFFIX = "_samples_{}.npz"
+# Files of a shapefile that define the geometries and their classes
+ROI_EXTENSIONS = [".shp", ".shx", ".dbf", ".prj"]
+
+
+def hash_files(file_paths):
+    sha = hashlib.sha256()
+    for file_path in file_paths:
+        sha.update(os.path.basename(file_path).encode("utf-8"))
+        with open(file_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                sha.update(chunk)
+    return sha.hexdigest()
+
+
+def roi_files(vector_file_path):
+    stem = os.path.splitext(vector_file_path)[0]
+    return [stem + extension for extension in ROI_EXTENSIONS if os.path.exists(stem + extension)]
+
+
+def roi_hash(vector_file_path):
+    # Hash of the content of the ROI shapefile, so editing the geometries or
+    # their classes gives a different one
+    return hash_files(roi_files(vector_file_path))
+
+
+class SampleCache:
+    # Samples (X and y) extracted from an image are saved next to it, in a
+    # compressed .npz file named after a key. The key is a hash of everything
+    # the samples depend on (the ROI, the features and the files they were
+    # read from), so a file is only used when it would give the same samples
+    def __init__(self, image):
+        self.image = image
+
+
+    def create_key(self, parts):
+        parts = dict(parts, version=SAMPLE_CACHE_VERSION)
+        return hashlib.sha256(json.dumps(parts, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+    def get_file_name(self, key):
+        return os.path.join(
+            self.image.path, "{}{}".format(self.image.base_name, SAMPLES_SUFFIX.format(key[:24])))
+
+
+    def load(self, key):
+        # Returns X and y, or None if there are no samples with that key
+        file_name = self.get_file_name(key)
+        if not os.path.exists(file_name):
+            return None
+        try:
+            with np.load(file_name) as data:
+                X, y = data["X"], data["y"]
+        except (OSError, ValueError, KeyError, zipfile.BadZipFile):
+            print("Discarding broken samples file: " + file_name)
+            os.remove(file_name)
+            return None
+        print("Samples loaded from " + file_name)
+        return X, y
+
+
+    def save(self, key, X, y):
+        # Only the samples of the last key are kept
+        pattern = os.path.join(
+            glob.escape(self.image.path),
+            glob.escape(self.image.base_name) + SAMPLES_SUFFIX.format("*"))
+        for old_file in glob.glob(pattern):
+            os.remove(old_file)
+
+        # Write to a temporary file first so an interrupted run never leaves
+        # a half written file
+        file_name = self.get_file_name(key)
+        temporary_file = file_name + ".tmp"
+        with open(temporary_file, 'wb') as f:
+            np.savez_compressed(f, X=X, y=y)
+        os.replace(temporary_file, file_name)
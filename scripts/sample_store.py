@@ -0,0 +1,133 @@
+import numpy as np
+import tempfile
+
+
+class SampleStore:
+    # Growable matrix of samples (X) and labels (y). When the amount of
+    # samples is known beforehand the arrays are allocated once, otherwise
+    # the capacity doubles each time it runs out, so appending is never
+    # quadratic. With a spill directory the samples are kept in a memory
+    # mapped temporary file instead of RAM. The file is deleted when the
+    # store is closed or garbage collected (e.g. when its classifier is
+    # replaced)
+    MIN_CAPACITY = 1024
+    # Samples swapped at once when splitting
+    SWAP_BLOCK = 65536
+
+    def __init__(self, capacity=0, spill_directory=None, dtype=np.float32):
+        self.capacity = capacity
+        self.spill_directory = spill_directory
+        self.dtype = dtype
+        self.size = 0
+        self.__X = None
+        self.__y = None
+        self.__file = None
+
+
+    def __len__(self):
+        return self.size
+
+
+    def allocate(self, capacity, feature_count):
+        if self.spill_directory is None:
+            return np.empty((capacity, feature_count), dtype=self.dtype), None
+        # Closing the file deletes it. The pixels stay mapped until the
+        # arrays are released, on Windows the file is deleted then
+        temporary_file = tempfile.NamedTemporaryFile(
+            prefix=".lumberjack_samples_", suffix=".dat", dir=self.spill_directory, delete=True)
+        X = np.memmap(temporary_file, dtype=self.dtype, mode="w+", shape=(capacity, feature_count))
+        return X, temporary_file
+
+
+    def resize(self, capacity, feature_count):
+        X, temporary_file = self.allocate(capacity, feature_count)
+        y = np.empty(capacity, dtype=np.uint8)
+        if self.size > 0:
+            X[:self.size] = self.__X[:self.size]
+            y[:self.size] = self.__y[:self.size]
+        self.remove_file()
+        self.__X = X
+        self.__y = y
+        self.__file = temporary_file
+        self.capacity = capacity
+
+
+    def add(self, X, y):
+        if X.shape[0] != y.shape[0]:
+            raise ValueError("Amount of samples and labels differ: {} and {}".format(X.shape[0], y.shape[0]))
+        if self.__X is not None and X.shape[1] != self.__X.shape[1]:
+            raise ValueError("Expected {} features but got {}".format(self.__X.shape[1], X.shape[1]))
+
+        needed = self.size + X.shape[0]
+        if self.__X is None:
+            self.resize(max(needed, self.capacity, SampleStore.MIN_CAPACITY), X.shape[1])
+        elif needed > self.capacity:
+            self.resize(max(needed, 2 * self.capacity), X.shape[1])
+
+        self.__X[self.size:needed] = X
+        self.__y[self.size:needed] = y
+        self.size = needed
+
+
+    def get(self):
+        # Views of the stored samples, without copying them
+        if self.__X is None:
+            return None, None
+        return self.__X[:self.size], self.__y[:self.size]
+
+
+    def split(self, test_size, random_state=None):
+        # Chooses at random test_size samples (a fraction if it's a float,
+        # as train_test_split does) and moves them to the end of the store,
+        # swapping them with the training samples found there. Only the
+        # samples that change places are copied, so the training samples
+        # stay in the memory mapped file. Returns views of the training and
+        # testing samples
+        if isinstance(test_size, float):
+            test_count = int(np.ceil(test_size * self.size))
+        else:
+            test_count = int(test_size)
+        train_count = self.size - test_count
+        if not 0 < train_count < self.size:
+            raise ValueError("Can't split {} samples with a test size of {}".format(self.size, test_size))
+
+        is_test = np.zeros(self.size, dtype=bool)
+        is_test[np.random.default_rng(random_state).choice(self.size, test_count, replace=False)] = True
+        # There are as many testing samples among the first train_count as
+        # training samples after them
+        heads = np.flatnonzero(is_test[:train_count])
+        tails = train_count + np.flatnonzero(~is_test[train_count:])
+        for start in range(0, heads.size, SampleStore.SWAP_BLOCK):
+            head = heads[start:start+SampleStore.SWAP_BLOCK]
+            tail = tails[start:start+SampleStore.SWAP_BLOCK]
+            for array in [self.__X, self.__y]:
+                values = array[head]
+                array[head] = array[tail]
+                array[tail] = values
+
+        X, y = self.get()
+        return X[:train_count], y[:train_count], X[train_count:], y[train_count:]
+
+
+    def get_file_name(self):
+        # The file the samples are spilled to, if any
+        if self.__file is None:
+            return None
+        return self.__file.name
+
+
+    def remove_file(self):
+        if self.__file is not None:
+            self.__X = None
+            try:
+                self.__file.close()
+            except OSError:
+                print("Could not remove the samples file " + self.__file.name)
+            self.__file = None
+
+
+    def close(self):
+        self.remove_file()
+        self.__X = None
+        self.__y = None
+        self.size = 0
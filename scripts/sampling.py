@@ -0,0 +1,141 @@
+import numpy as np
+import collections
+
+
+# Samples pass through these levels in order: the samples of a scene, of a
+# place (all its scenes) and of the whole training set
+LEVELS = ["scene", "place", "all"]
+
+
+class Reservoir:
+    # Keeps the samples with the smallest random keys (bottom-k sampling).
+    # Every sample gets its key once, so keeping the smallest keys of the
+    # samples kept by several reservoirs gives the same result as keeping
+    # them from all the samples at once, and the samples are a uniform
+    # random choice without ever holding all of them
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.X = None
+        self.y = None
+        self.keys = None
+
+
+    def __len__(self):
+        return 0 if self.keys is None else len(self.keys)
+
+
+    def add(self, X, y, keys):
+        if self.keys is not None:
+            X = np.concatenate([self.X, X])
+            y = np.concatenate([self.y, y])
+            keys = np.concatenate([self.keys, keys])
+        if len(keys) > self.capacity:
+            kept = np.sort(np.argpartition(keys, self.capacity - 1)[:self.capacity])
+            X, y, keys = X[kept], y[kept], keys[kept]
+        self.X, self.y, self.keys = X, y, keys
+
+
+class StratifiedReservoir:
+    # A reservoir for each class, so the cap is applied to every class on
+    # its own
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.reservoirs = {}
+
+
+    def add(self, X, y, keys):
+        for c in np.unique(y):
+            mask = y == c
+            if c not in self.reservoirs:
+                self.reservoirs[c] = Reservoir(self.capacity)
+            self.reservoirs[c].add(X[mask], y[mask], keys[mask])
+
+
+    def take(self):
+        # Returns the samples of every class and empties the reservoir
+        reservoirs = [self.reservoirs[c] for c in sorted(self.reservoirs)]
+        self.reservoirs = {}
+        return [(r.X, r.y, r.keys) for r in reservoirs]
+
+
+class CappedSampler:
+    # Caps the amount of samples of each class taken from each scene, from
+    # each place and from the whole training set (0 leaves a level
+    # uncapped). The samples of a level are only held until the scene or
+    # place finishes, then they are passed on to the next capped level, and
+    # what passes the last one is given to emit(X, y)
+    def __init__(self, emit, max_per_scene=0, max_per_place=0, max_per_class=0, seed=0):
+        self.emit = emit
+        self.caps = {"scene": max_per_scene, "place": max_per_place, "all": max_per_class}
+        self.reservoirs = {
+            level: StratifiedReservoir(cap) for level, cap in self.caps.items() if cap > 0}
+        self.rng = np.random.default_rng(seed)
+        self.before = collections.Counter()
+        self.after = collections.Counter()
+
+
+    def is_enabled(self):
+        return len(self.reservoirs) > 0
+
+
+    def pass_on(self, level_index, X, y, keys):
+        for level in LEVELS[level_index:]:
+            if level in self.reservoirs:
+                self.reservoirs[level].add(X, y, keys)
+                return
+        self.after.update(count_classes(y))
+        self.emit(X, y)
+
+
+    def add(self, X, y):
+        self.before.update(count_classes(y))
+        self.pass_on(0, X, y, self.rng.random(len(y)))
+
+
+    def drain(self, level):
+        if level in self.reservoirs:
+            for X, y, keys in self.reservoirs[level].take():
+                self.pass_on(LEVELS.index(level) + 1, X, y, keys)
+
+
+    def finish_scene(self):
+        self.drain("scene")
+
+
+    def finish_place(self):
+        self.drain("place")
+
+
+    def finish(self):
+        self.drain("all")
+
+
+    def expected_samples(self, places_counts):
+        # Amount of samples left after sampling, from the pixels of each
+        # class in the ROI of each place and its amount of scenes. As the
+        # reservoirs keep exactly min(cap, samples), it is exact
+        totals = collections.Counter()
+        for counts, scenes in places_counts:
+            for c, n in counts.items():
+                if self.caps["scene"] > 0:
+                    n = min(n, self.caps["scene"])
+                n = n * scenes
+                if self.caps["place"] > 0:
+                    n = min(n, self.caps["place"])
+                totals[c] += n
+        if self.caps["all"] > 0:
+            return sum(min(n, self.caps["all"]) for n in totals.values())
+        return sum(totals.values())
+
+
+    def distribution(self):
+        # Lines with the samples of each class before and after sampling
+        return [
+            "Class {c}: {before} samples, {after} after sampling".format(
+                c=c, before=self.before[c], after=self.after[c])
+            for c in sorted(self.before)]
+
+
+def count_classes(y):
+    classes, counts = np.unique(y, return_counts=True)
+    return dict(zip(classes.tolist(), counts.tolist()))
@@ -3,34 +3,26 @@ import numpy as np
 import time
 import datetime
 from .preprocess_task import *
+from .feature_stack import FeatureStack
 from .. import Lumberjack
 
 
 class SeasonalAnalysis(PreProcessTask):
-    def __init__(self, directory, feature, lumberjack_instance):
+    def __init__(self, directory, feature_name, lumberjack_instance, occurrence=0):
         super().__init__("Seasonal Analysis", QgsTask.CanCancel)
         self.directory = directory
-        self.feature_number = feature
+        # Features are found by name, occurrence tells which one when more
+        # than one feature has the same name
+        self.feature_name = feature_name
+        self.occurrence = occurrence
         self.lumberjack_instance = lumberjack_instance
 
 
     def transform_day(self, date):
-        year, month, day = date.split("-")
-        year = int(year)
-        month = int(month)
-        day = int(day)
-        number_of_day = (datetime.date(year, month, day) - datetime.date(year, 1, 1)).days + 1
+        number_of_day = (date - datetime.date(date.year, 1, 1)).days + 1
         return number_of_day
 
 
-    def get_date_from_metadata(self, file):
-        with open(file, 'r') as f:
-            for line in f.readlines():
-                if "DATE_ACQUIRED =" in line:
-                    l = line.split("=")
-                    return l[1]
-
-
     def calculate_threshold(self):
         places = self.obtain_places(self.directory)
 
@@ -43,21 +35,20 @@ class SeasonalAnalysis(PreProcessTask):
 
                 stack_files = []
                 for image in place.images:
+                    # The stack with the analysed feature, see plot_seasonal_analysis()
                     file_name_stack = os.path.join(
-                        image.path, 
-                        "{}{}".format(image.base_name, Lumberjack.STACK_SUFFIX))
-                    stack_files.append([file_name_stack, image.metadata_file])
+                        image.path, "{}{}".format(image.base_name, Lumberjack.ANALYSIS_STACK_SUFFIX))
+                    stack_files.append([file_name_stack, image])
 
                 for i, file in enumerate(stack_files):
-                    features = gdal.Open(file[0], gdal.GA_ReadOnly)
-                    band = features.GetRasterBand(self.feature_number)
+                    features = FeatureStack(file[0])
 
-                    date = self.get_date_from_metadata(file[1])
-                    number_of_day = self.transform_day(date)
+                    number_of_day = self.transform_day(file[1].get_metadata().date)
 
                     print("Working on image of day: {}".format(number_of_day))
                     self.days.append(number_of_day)
-                    self.data.append(band.ReadAsArray()[mask_array < 2])
+                    position = features.find_feature(self.feature_name, self.occurrence)
+                    self.data.append(features.read_feature(position)[mask_array < 2])
 
 
     def run(self):
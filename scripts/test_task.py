@@ -4,12 +4,19 @@ from .train_task import TrainTask
 
 
 class TestTask(ClassificationTask):
-    def __init__(self, directory, classifier, testing_ratio, lumberjack_instance):
+    def __init__(
+            self, directory, classifier, testing_ratio, lumberjack_instance,
+            spill_samples=False, features=None, fused=False, required_names=None, sample_cache=False):
         super().__init__("Lumberjack testing", QgsTask.CanCancel)
         self.directory = directory
         self.classifier = classifier
         self.without_ratio = testing_ratio
         self.li = lumberjack_instance
+        self.spill_samples = spill_samples
+        self.features = features
+        self.fused = fused
+        self.sample_cache = sample_cache
+        self.required_names = required_names
         self.classes = None
         self.exception = None
 
@@ -30,8 +37,12 @@ class TestTask(ClassificationTask):
                 places = self.obtain_places(self.directory)
 
                 self.rasterize_vector_files(places)
+                if self.fused:
+                    self.select_required_features(places)
 
                 self.check_classes(places)
+                self.classifier.reserve_testing_samples(
+                    self.total_samples, self.directory if self.spill_samples else None)
                 self.filter_samples(places)
 
             else:
@@ -41,6 +52,10 @@ class TestTask(ClassificationTask):
             # Calculates the metrics with the classifer already trained and
             # a testing set
             self.metrics = self.classifier.calculate_metrics()
+            if self.without_ratio:
+                # Samples read for this test are not used again, the ones
+                # split from the training samples are kept to test again
+                self.classifier.release_testing_samples()
 
             self.elapsed_time = time.time() - self.start_time
             print("Finished testing in {} seconds".format(str(self.elapsed_time)))
@@ -50,6 +65,8 @@ class TestTask(ClassificationTask):
             return True
 
         except Exception as e:
+            if self.without_ratio:
+                self.classifier.release_testing_samples()
             self.exception = e
             return False
 
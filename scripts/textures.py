@@ -0,0 +1,278 @@
+from argparse import ArgumentParser
+from osgeo import gdal
+import concurrent.futures
+import collections
+import numpy as np
+import time
+import os
+try:
+    from .output_profile import create_tiff
+except ImportError:
+    # Run as a script from the command line
+    from output_profile import create_tiff
+
+
+# Haralick measures calculated for each band, with the same names that
+# r.texture gives to its outputs
+MEASURES = ["ASM", "Contr", "Var", "IDM", "Entr"]
+# Offsets (rows, columns) of the four directions: 0, 45, 90 and 135 degrees
+DIRECTIONS = [(0, 1), (-1, 1), (-1, 0), (-1, -1)]
+TILE_LINES = 256
+# Counts of co-occurrence kept at once while calculating a tile, which
+# limits how many windows slide at the same time
+COOCCURRENCE_COUNTS = 2 ** 24
+
+
+def quantization_edges(data, categories, rescale):
+    # Limits of the categories. Recoding (the default) uses quantiles, so
+    # every category has about the same amount of pixels. Rescaling splits
+    # the range of values in equal parts
+    values = data.ravel()
+    if rescale:
+        return np.linspace(values.min(), values.max(), categories + 1)
+    return np.quantile(values, np.linspace(0, 1, categories + 1))
+
+
+def quantize(data, edges):
+    # Categories go from 1 to the amount of categories
+    return (np.searchsorted(edges[1:-1], data, side='right') + 1).astype(np.uint8)
+
+
+def box_sum(values, rows, columns):
+    # Sum of the values of every rows x columns window, from the cumulative
+    # sums of the image
+    sums = np.zeros((values.shape[0] + 1, values.shape[1] + 1), dtype=values.dtype)
+    np.cumsum(np.cumsum(values, axis=0), axis=1, out=sums[1:, 1:])
+    return sums[rows:, columns:] - sums[:-rows, columns:] - sums[rows:, :-columns] + sums[:-rows, :-columns]
+
+
+def cooccurrence_sums(first, second, rows, columns, lines, out_columns):
+    # For every window, the sum of c^2 and of c * log10(c) over the counts c
+    # of its symmetric co-occurrence matrix. first and second are the values
+    # of the pair anchored at each position, and the window of the pixel
+    # (y, x) holds the pairs anchored at [y, y+rows) x [x, x+columns).
+    # The counts of a window are kept while sliding it along the columns:
+    # the pairs of the column that enters are added and the ones of the
+    # column that leaves are removed, updating both sums with the change of
+    # a single count each time. Every line, and segments of the columns,
+    # slide at once
+    pairs = rows * columns
+    low = np.minimum(first, second)
+    high = np.maximum(first, second)
+    # Pairs are numbered by the codes present, so the counts only hold them
+    codes = low * 256 + high
+    present = np.zeros(256 * 256, dtype=bool)
+    present[codes] = True
+    cells = (np.cumsum(present, dtype=np.int32) - 1)[codes]
+    codes = np.flatnonzero(present)
+    # An unordered pair (a, b) seen n times is two entries of n in the
+    # matrix, or a single one of 2n when a == b
+    diagonal = (codes // 256) == (codes % 256)
+    n = np.arange(pairs + 1, dtype=np.float64)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        squares = np.concatenate((2 * n ** 2, 4 * n ** 2))
+        logs = np.nan_to_num(np.concatenate((2 * n * np.log10(n), 2 * n * np.log10(2 * n))))
+    # Change of the sums when a count goes from n to n + 1
+    square_steps = np.diff(squares).astype(np.int64)
+    log_steps = np.diff(logs)
+
+    # As many segments as the counts allow, padding the anchors so all of
+    # them have the same length
+    segments = max(1, min(out_columns, COOCCURRENCE_COUNTS // (lines * len(codes))))
+    length = -(-out_columns // segments)
+    padding = segments * length + columns - 1 - cells.shape[1]
+    cells = np.pad(cells, ((0, 0), (0, padding)))
+    # anchors[c, s, y] is the anchor of the line y at the column c of the
+    # segment s
+    positions = np.arange(length + columns - 1)[:, np.newaxis] + np.arange(segments) * length
+    anchors = cells.T[positions]
+    kinds = (diagonal[anchors] * (pairs + 1)).astype(np.int32)
+
+    windows = segments * lines
+    base = np.arange(windows).reshape(segments, lines) * len(codes)
+    counts = np.zeros(windows * len(codes), dtype=np.min_scalar_type(pairs))
+    square_sums = np.empty((length, segments, lines), dtype=np.int64)
+    log_sums = np.empty((length, segments, lines), dtype=np.float64)
+    square_sum = np.zeros((segments, lines), dtype=np.int64)
+    log_sum = np.zeros((segments, lines), dtype=np.float64)
+
+    def add(column):
+        for k in range(rows):
+            index = base + anchors[column, :, k:k+lines]
+            count = counts[index]
+            steps = kinds[column, :, k:k+lines] + count
+            square_sum[:] += square_steps[steps]
+            log_sum[:] += log_steps[steps]
+            counts[index] = count + 1
+
+    def remove(column):
+        for k in range(rows):
+            index = base + anchors[column, :, k:k+lines]
+            count = counts[index] - 1
+            steps = kinds[column, :, k:k+lines] + count
+            square_sum[:] -= square_steps[steps]
+            log_sum[:] -= log_steps[steps]
+            counts[index] = count
+
+    for column in range(columns):
+        add(column)
+    square_sums[0] = square_sum
+    log_sums[0] = log_sum
+    for x in range(1, length):
+        remove(x - 1)
+        add(x + columns - 1)
+        square_sums[x] = square_sum
+        log_sums[x] = log_sum
+
+    # Back to (lines, columns), without the padding
+    square_sums = square_sums.transpose(2, 1, 0).reshape(lines, segments * length)[:, :out_columns]
+    log_sums = log_sums.transpose(2, 1, 0).reshape(lines, segments * length)[:, :out_columns]
+    return square_sums, log_sums
+
+
+def direction_measures(padded, size, offset, lines, columns):
+    # Calculates the measures for one direction at every pixel at once.
+    # padded holds the quantized image with a border of size // 2 pixels, so
+    # the window of the pixel (y, x) is padded[y:y+size, x:x+size].
+    # Each pair of the window is anchored at its first pixel. The measures
+    # that add a value per pair are box sums over the anchors, the ones
+    # that depend on the counts of the co-occurrence matrix are updated as
+    # the window slides
+    dy, dx = offset
+    rows = size - abs(dy)
+    anchor_columns = size - abs(dx)
+    top = max(0, -dy)
+    left = max(0, -dx)
+    height = lines + rows - 1
+    width = columns + anchor_columns - 1
+    first = padded[top:top+height, left:left+width].astype(np.int64)
+    second = padded[top+dy:top+dy+height, left+dx:left+dx+width].astype(np.int64)
+    pairs = rows * anchor_columns
+    # The matrix is symmetric, each pair is counted in both directions
+    total = 2 * pairs
+
+    difference = (first - second) ** 2
+    contrast = box_sum(difference, rows, anchor_columns)
+    idm = box_sum(1.0 / (1.0 + difference), rows, anchor_columns)
+    sum_values = box_sum(first + second, rows, anchor_columns)
+    sum_squares = box_sum(first ** 2 + second ** 2, rows, anchor_columns)
+    square_counts, log_counts = cooccurrence_sums(first, second, rows, anchor_columns, lines, columns)
+
+    mean = sum_values / total
+    return [
+        square_counts / total ** 2,
+        contrast / pairs,
+        sum_squares / total - mean ** 2,
+        idm / pairs,
+        np.log10(total) - log_counts / total]
+
+
+def texture_measures(padded, size, distance, lines, columns):
+    # Measures are the average of the four directions
+    measures = np.zeros((len(MEASURES), lines, columns), dtype=np.float64)
+    for dy, dx in DIRECTIONS:
+        direction = direction_measures(padded, size, (dy * distance, dx * distance), lines, columns)
+        for m in range(len(MEASURES)):
+            measures[m] += direction[m]
+    return (measures / len(DIRECTIONS)).astype(np.float32)
+
+
+def texture_tile(quantized, size, distance, yoff, lines):
+    # Calculates the measures of the lines [yoff, yoff + lines) of a band,
+    # padding by reflection at the borders of the image
+    half = size // 2
+    start = max(0, yoff - half)
+    end = min(quantized.shape[0], yoff + lines + half)
+    tile = quantized[start:end]
+    padded = np.pad(
+        tile, ((half - (yoff - start), half - (end - yoff - lines)), (half, half)), mode='symmetric')
+    return texture_measures(padded, size, distance, lines, quantized.shape[1])
+
+
+def check_parameters(size, distance, categories):
+    if (size % 2 == 0) or (size < 3):
+        raise ValueError("Size of moving windows must be odd and >= 3")
+    if (distance < 1) or (distance >= size):
+        raise ValueError("The distance must be smaller than the size of the moving window")
+    if (categories < 2) or (categories > 255):
+        raise ValueError("The amount of categories must be between 2 and 255")
+
+
+def generate_texture_file(
+        file_input, file_output, size=3, distance=1, categories=255, rescale=False, workers=None,
+        bands=None):
+    # Calculates asm, contrast, variance, idm and entropy for each band of a
+    # TIFF file, or only for the given bands (1 based). Tiles of every band
+    # are calculated in parallel, by workers threads (every core if None)
+    check_parameters(size, distance, categories)
+    start_time = time.time()
+    print("Calculating textures...")
+    dataset = gdal.Open(file_input, gdal.GA_ReadOnly)
+    if bands is None:
+        bands = list(range(1, dataset.RasterCount + 1))
+
+    # Quantized bands are small (one byte per pixel), so all of them are
+    # kept to feed the workers
+    quantized_bands = []
+    for band_number in bands:
+        data = dataset.GetRasterBand(band_number).ReadAsArray()
+        quantized_bands.append(quantize(data, quantization_edges(data, categories, rescale)))
+        data = None
+
+    out_raster_ds = create_tiff(
+        file_output, dataset.RasterXSize, dataset.RasterYSize,
+        len(bands) * len(MEASURES), gdal.GDT_Float32, "feature")
+    out_raster_ds.SetProjection(dataset.GetProjectionRef())
+    out_raster_ds.SetGeoTransform(dataset.GetGeoTransform())
+    for b, band_number in enumerate(bands):
+        for m, measure in enumerate(MEASURES):
+            outband = out_raster_ds.GetRasterBand(b * len(MEASURES) + m + 1)
+            outband.SetDescription("band.{}_{}".format(band_number, measure))
+
+    if workers is None:
+        workers = os.cpu_count() or 1
+    # Only this thread writes to the output. A few tiles are kept in flight
+    # so the memory doesn't grow with the size of the image, and they are
+    # written in the order they were submitted
+    def write(b, yoff, future):
+        measures = future.result()
+        for m in range(len(MEASURES)):
+            outband = out_raster_ds.GetRasterBand(b * len(MEASURES) + m + 1)
+            outband.WriteArray(measures[m], 0, yoff)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = collections.deque()
+        for b, quantized in enumerate(quantized_bands):
+            for yoff in range(0, dataset.RasterYSize, TILE_LINES):
+                lines = min(TILE_LINES, dataset.RasterYSize - yoff)
+                pending.append((b, yoff, executor.submit(texture_tile, quantized, size, distance, yoff, lines)))
+                if len(pending) > workers:
+                    write(*pending.popleft())
+        while pending:
+            write(*pending.popleft())
+    out_raster_ds = None
+
+    elapsed_time = time.time() - start_time
+    print("Finished calculating textures in " + str(elapsed_time) + " seconds")
+    return dataset.RasterCount
+
+
+if __name__== "__main__":
+    parser = ArgumentParser()
+    parser.add_argument(
+        "-i", "--input_file", dest="file_input", help="Input tiff file to calculate textures", required=True)
+    parser.add_argument(
+        "-o", "--output_file", dest="file_output", help="Output tiff file to save the textures", required=True)
+    parser.add_argument(
+        "-s", "--size", dest="size", type=int, default=3, help="The size of moving window (odd and >= 3)")
+    parser.add_argument(
+        "-d", "--distance", dest="distance", type=int, default=1, help="The distance between two samples (>= 1)")
+    parser.add_argument(
+        "-c", "--categories", dest="categories", type=int, default=255,
+        help="Number of categories to rescale/recode the image")
+    parser.add_argument(
+        "-r", "--rescale", dest="rescale", action="store_true", help="Rescales instead of recoding the image")
+
+    args = parser.parse_args()
+    generate_texture_file(
+        args.file_input, args.file_output, args.size, args.distance, args.categories, args.rescale)
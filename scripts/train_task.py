@@ -1,15 +1,28 @@
 from .preprocess_task import *
 from .classification_task import *
+from .sampling import CappedSampler
 
 
 class TrainTask(ClassificationTask):
-    def __init__(self, directory, classifier, testing_ratio, features, lumberjack_instance):
+    def __init__(
+            self, directory, classifier, testing_ratio, features, lumberjack_instance,
+            spill_samples=False, fused=False, sample_cache=False, max_per_class=0, max_per_place=0,
+            max_per_scene=0):
         super().__init__("Lumberjack training", QgsTask.CanCancel)
         self.directory = directory
         self.classifier = classifier
         self.without_ratio = testing_ratio
         self.features = features
         self.li = lumberjack_instance
+        self.spill_samples = spill_samples
+        self.fused = fused
+        self.sample_cache = sample_cache
+        # Caps of the samples of each class, 0 takes all of them
+        sampler = CappedSampler(
+            self.add_samples, max_per_scene=max_per_scene, max_per_place=max_per_place,
+            max_per_class=max_per_class)
+        if sampler.is_enabled():
+            self.sampler = sampler
         self.classes = None
         self.exception = None
 
@@ -31,6 +44,12 @@ class TrainTask(ClassificationTask):
             self.rasterize_vector_files(places)
 
             self.check_classes(places)
+            samples = self.total_samples
+            if self.sampler is not None:
+                samples = self.sampler.expected_samples(self.places_counts)
+                print("Sampling {} of {} samples".format(samples, self.total_samples))
+            self.classifier.reserve_training_samples(
+                samples, self.directory if self.spill_samples else None)
 
             # Add samples to train
             self.filter_samples(places)
@@ -54,6 +73,8 @@ class TrainTask(ClassificationTask):
             return True
 
         except Exception as e:
+            # The samples of a failed training are not used again
+            self.classifier.release_samples()
             self.exception = e
             return False
 
@@ -65,7 +86,10 @@ class TrainTask(ClassificationTask):
                 'Training Directory: {td}'.format(name=self.description(), time=self.elapsed_time, td=self.directory),
                 Lumberjack.MESSAGE_CATEGORY, Qgis.Success)
 
-            self.li.notify_training(self.start_time_str, self.classes, self.total_samples, self.elapsed_time)
+            self.li.notify_training(
+                self.start_time_str, self.classes, self.total_samples, self.elapsed_time,
+                self.classifier.training_log,
+                self.sampler.distribution() if self.sampler is not None else None)
 
         else:
             if self.exception is None:
@@ -5,6 +5,7 @@ import scipy.ndimage as ndimage
 import datetime
 import time
 
+from .output_profile import create_tiff
 from .. import Lumberjack
 
 
@@ -36,9 +37,8 @@ class TreeCorrectionTask(QgsTask):
             dem_raster_band = dataset_dem.GetRasterBand(1)
 
             # Create a copy of the DEM
-            memory_driver = gdal.GetDriverByName('GTiff')
-            output_dataset = memory_driver.Create(
-                self.output_file, dataset_dem.RasterXSize, dataset_dem.RasterYSize, 1, gdal.GDT_Int16)
+            output_dataset = create_tiff(
+                self.output_file, dataset_dem.RasterXSize, dataset_dem.RasterYSize, 1, gdal.GDT_Int16, "dem")
             output_dataset.SetProjection(dataset_dem.GetProjectionRef())
             output_dataset.SetGeoTransform(dataset_dem.GetGeoTransform())
             outband = output_dataset.GetRasterBand(1)
@@ -59,10 +59,9 @@ class TreeCorrectionTask(QgsTask):
                 array_mask = np.invert(array_mask)
 
             # Create mask File
-            memory_driver = gdal.GetDriverByName('GTiff')
-            output_dataset = memory_driver.Create(
-                self.tree_mask[:-4] + "_no_data.tif", 
-                dataset_mask.RasterXSize, dataset_mask.RasterYSize, 1, gdal.GDT_Byte)
+            output_dataset = create_tiff(
+                self.tree_mask[:-4] + "_no_data.tif",
+                dataset_mask.RasterXSize, dataset_mask.RasterYSize, 1, gdal.GDT_Byte, "mask")
             output_dataset.SetProjection(dataset_mask.GetProjectionRef())
             output_dataset.SetGeoTransform(dataset_mask.GetGeoTransform())
             outband = output_dataset.GetRasterBand(1)
@@ -0,0 +1,116 @@
+# coding=utf-8
+"""Backends test.
+
+.. note:: This program is free software; you can redistribute it and/or modify
+     it under the terms of the GNU General Public License as published by
+     the Free Software Foundation; either version 2 of the License, or
+     (at your option) any later version.
+
+"""
+
+__author__ = 'bruscantinic@gmail.com'
+__date__ = '2019-07-01'
+__copyright__ = 'Copyright 2019, UNICEN'
+
+import unittest
+
+import numpy as np
+
+from sklearn.ensemble import HistGradientBoostingClassifier
+from sklearn.ensemble import RandomForestClassifier
+
+from scripts import backends
+
+
+def old_hist_gradient_boosting(**parameters):
+    """Gradient boosting of scikit-learn before max_features existed."""
+    if "max_features" in parameters:
+        raise TypeError("__init__() got an unexpected keyword argument 'max_features'")
+    return HistGradientBoostingClassifier(**parameters)
+
+
+class HistGradientBoostingBackendTest(unittest.TestCase):
+    """Test gradient boosting is created for the installed scikit-learn."""
+
+    def setUp(self):
+        """Runs before each test."""
+        rng = np.random.default_rng(0)
+        self.X = rng.random((200, 16)).astype(np.float32)
+        self.y = (self.X[:, 0] > 0.5).astype(np.uint8) + 1
+        self.parameters = {
+            "backend": "hist_gradient_boosting", "n_estimators": 5, "max_depth": None,
+            "min_samples_leaf": 1, "max_features": "sqrt", "n_jobs": 1, "bootstrap": False,
+            "max_samples": None, "growth_step": 0, "growth_tolerance": 0.001}
+        self.log = []
+
+    def fit(self):
+        return backends.get_backend("hist_gradient_boosting").fit(
+            self.parameters, self.X, self.y, self.log.append)
+
+    def test_max_features(self):
+        """sqrt takes the fraction of the square root of the features."""
+        if not backends.BOOSTING_MAX_FEATURES:
+            self.skipTest("scikit-learn older than 1.4")
+        self.assertEqual(self.fit().max_features, 4 / 16)
+        self.assertEqual(self.log, [])
+
+    def test_without_max_features(self):
+        """Versions without max_features use every feature instead of failing."""
+        supported = backends.BOOSTING_MAX_FEATURES
+        backends.BOOSTING_MAX_FEATURES = False
+        backends.HistGradientBoostingClassifier = old_hist_gradient_boosting
+        try:
+            model = self.fit()
+        finally:
+            backends.BOOSTING_MAX_FEATURES = supported
+            backends.HistGradientBoostingClassifier = HistGradientBoostingClassifier
+        self.assertEqual(model.n_iter_, 5)
+        self.assertEqual(len(self.log), 1)
+
+
+class EarlyExitTest(unittest.TestCase):
+    """Test forests stop evaluating trees once the class of a pixel is decided."""
+
+    def setUp(self):
+        """Runs before each test."""
+        rng = np.random.default_rng(1)
+        X = rng.random((2000, 6)).astype(np.float32)
+        # Most pixels are clearly of a class, the ones near the borders are not
+        y = np.digitize(X[:, 0] + 0.2 * rng.random(2000), [0.4, 0.8]).astype(np.uint8) + 1
+        self.forest = RandomForestClassifier(n_estimators=45, random_state=0).fit(X, y)
+        self.X = rng.random((5000, 6)).astype(np.float32)
+        self.backend = backends.get_backend("random_forest")
+
+    def test_exact(self):
+        """With margin 0 the classes are the same as with every tree, evaluating fewer."""
+        predictions, evaluated = self.backend.predict_early_exit(self.forest, self.X, 0.0)
+        np.testing.assert_array_equal(predictions, self.forest.predict(self.X))
+        self.assertLess(evaluated, 0.8 * self.X.shape[0] * 45)
+
+    def test_margin(self):
+        """Higher margins evaluate fewer trees, changing only a few pixels."""
+        exact, exact_evaluated = self.backend.predict_early_exit(self.forest, self.X, 0.0)
+        predictions, evaluated = self.backend.predict_early_exit(self.forest, self.X, 0.5)
+        self.assertLess(evaluated, exact_evaluated)
+        self.assertLess(np.mean(predictions != exact), 0.02)
+
+    def test_batches(self):
+        """The last batch may have fewer trees, and every pixel may be decided early."""
+        X = np.zeros((10, 6), dtype=np.float32)
+        predictions, evaluated = self.backend.predict_early_exit(self.forest, X, 0.0)
+        np.testing.assert_array_equal(predictions, self.forest.predict(X))
+        self.assertLessEqual(evaluated, 10 * 45)
+
+    def test_model_untouched(self):
+        """The trees of the forest are the same after predicting."""
+        self.backend.predict_early_exit(self.forest, self.X, 0.0)
+        self.assertEqual(len(self.forest.estimators_), 45)
+        self.assertEqual(self.forest.n_estimators, 45)
+
+
+if __name__ == "__main__":
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(HistGradientBoostingBackendTest))
+    suite.addTest(unittest.makeSuite(EarlyExitTest))
+    runner = unittest.TextTestRunner(verbosity=2)
+    runner.run(suite)
@@ -0,0 +1,84 @@
+# coding=utf-8
+"""Compiled forest test.
+
+.. note:: This program is free software; you can redistribute it and/or modify
+     it under the terms of the GNU General Public License as published by
+     the Free Software Foundation; either version 2 of the License, or
+     (at your option) any later version.
+
+"""
+
+__author__ = 'bruscantinic@gmail.com'
+__date__ = '2019-07-01'
+__copyright__ = 'Copyright 2019, UNICEN'
+
+import unittest
+
+import numpy as np
+from sklearn.ensemble import RandomForestClassifier, ExtraTreesClassifier
+
+from scripts.compiled_forest import CompiledForest
+
+
+def make_samples(rng, samples, missing=0.0):
+    """Two classes (1 and 2) of float32 samples, with a fraction of NaNs."""
+    X = rng.normal(size=(samples, 6)).astype(np.float32)
+    y = (X[:, 0] + X[:, 1] * X[:, 2] + rng.normal(size=samples) * 0.5 > 0).astype(np.uint8) + 1
+    if missing > 0:
+        X[rng.random(X.shape) < missing] = np.nan
+        # Every pixel of the first feature, which leaves also point to
+        X[rng.random(samples) < missing, 0] = np.nan
+    return X, y
+
+
+class CompiledForestTest(unittest.TestCase):
+    """Test the compiled forest predicts as the forest it comes from."""
+
+    def check_same_predictions(self, estimator, missing):
+        rng = np.random.default_rng(0)
+        X, y = make_samples(rng, 3000, missing)
+        forest = estimator(n_estimators=15, random_state=0).fit(X, y)
+        compiled = CompiledForest.from_forest(forest)
+
+        X_test, _ = make_samples(rng, 5000, missing)
+        np.testing.assert_array_equal(compiled.predict(X_test), forest.predict(X_test))
+        np.testing.assert_allclose(compiled.predict_proba(X_test), forest.predict_proba(X_test), atol=1e-6)
+
+    def test_random_forest(self):
+        """A random forest without missing values."""
+        self.check_same_predictions(RandomForestClassifier, 0.0)
+
+    def test_random_forest_missing(self):
+        """A random forest with missing values."""
+        self.check_same_predictions(RandomForestClassifier, 0.2)
+
+    def test_extra_trees(self):
+        """Extra trees without missing values."""
+        self.check_same_predictions(ExtraTreesClassifier, 0.0)
+
+    def test_extra_trees_missing(self):
+        """Extra trees with missing values."""
+        self.check_same_predictions(ExtraTreesClassifier, 0.2)
+
+    def test_missing_only_at_prediction(self):
+        """Missing values the forest never saw while training."""
+        rng = np.random.default_rng(1)
+        X, y = make_samples(rng, 2000)
+        forest = RandomForestClassifier(n_estimators=10, random_state=0).fit(X, y)
+        X_test, _ = make_samples(rng, 3000, 0.3)
+        predictions = CompiledForest.from_forest(forest).predict(X_test)
+        np.testing.assert_array_equal(predictions, forest.predict(X_test))
+
+    def test_arrays_round_trip(self):
+        """A forest rebuilt from its arrays predicts the same."""
+        rng = np.random.default_rng(3)
+        X, y = make_samples(rng, 1000, 0.1)
+        compiled = CompiledForest.from_forest(RandomForestClassifier(n_estimators=5, random_state=0).fit(X, y))
+        copy = CompiledForest.from_arrays(compiled.get_arrays())
+        np.testing.assert_array_equal(copy.predict(X), compiled.predict(X))
+
+
+if __name__ == "__main__":
+    suite = unittest.makeSuite(CompiledForestTest)
+    runner = unittest.TextTestRunner(verbosity=2)
+    runner.run(suite)
@@ -0,0 +1,124 @@
+# coding=utf-8
+"""Evaluation test.
+
+.. note:: This program is free software; you can redistribute it and/or modify
+     it under the terms of the GNU General Public License as published by
+     the Free Software Foundation; either version 2 of the License, or
+     (at your option) any later version.
+
+"""
+
+__author__ = 'bruscantinic@gmail.com'
+__date__ = '2019-07-01'
+__copyright__ = 'Copyright 2019, UNICEN'
+
+import unittest
+
+import numpy as np
+from osgeo import gdal
+
+from scripts.evaluation import ConfusionMatrix, get_overlap, evaluate_prediction
+
+
+def create_dataset(array, x, y, pixel_size=30.0):
+    """Single band byte dataset in memory, with its top left corner at x, y."""
+    dataset = gdal.GetDriverByName("MEM").Create("", array.shape[1], array.shape[0], 1, gdal.GDT_Byte)
+    dataset.SetGeoTransform((x, pixel_size, 0.0, y, 0.0, -pixel_size))
+    dataset.GetRasterBand(1).WriteArray(array)
+    return dataset
+
+
+class ConfusionMatrixTest(unittest.TestCase):
+    """Test the confusion matrix counts the labelled pixels."""
+
+    def test_counts(self):
+        """Pixels without reference are not counted."""
+        matrix = ConfusionMatrix()
+        matrix.add(np.array([[0, 1, 1], [2, 2, 2]], dtype=np.uint8), np.array([[2, 1, 2], [2, 2, 1]], dtype=np.uint8))
+        self.assertEqual(matrix.counts.sum(), 5)
+        np.testing.assert_array_equal(matrix.counts[1:3, 1:3], [[1, 1], [1, 2]])
+
+    def test_merge(self):
+        """Merged matrices add their counts."""
+        first = ConfusionMatrix()
+        first.add(np.array([1, 2]), np.array([1, 1]))
+        second = ConfusionMatrix()
+        second.add(np.array([2, 2]), np.array([2, 2]))
+        first.merge(second)
+        np.testing.assert_array_equal(first.counts[1:3, 1:3], [[1, 0], [1, 2]])
+
+    def test_report(self):
+        """The report has the accuracy and the scores of each class."""
+        matrix = ConfusionMatrix()
+        matrix.add(np.array([1, 1, 2, 2]), np.array([1, 2, 2, 2]))
+        # The matrix itself is in the report as an array
+        report = [line for line in matrix.report() if isinstance(line, str)]
+        self.assertIn("Accuracy:  0.75", report)
+        self.assertIn("Class 1: precision 1.0000, recall 0.5000, F1 0.6667", report)
+        self.assertIn("Class 2: precision 0.6667, recall 1.0000, F1 0.8000", report)
+
+    def test_empty_report(self):
+        """A matrix without pixels says so."""
+        self.assertEqual(ConfusionMatrix().report(), ["No pixels with reference"])
+
+
+class EvaluatePredictionTest(unittest.TestCase):
+    """Test predictions are compared with the mask where they overlap."""
+
+    def setUp(self):
+        """Runs before each test."""
+        rng = np.random.default_rng(0)
+        # Taller than a strip, so the pixels are read in several of them
+        self.mask = rng.integers(0, 3, (300, 80)).astype(np.uint8)
+        self.prediction = rng.integers(1, 3, (250, 60)).astype(np.uint8)
+
+    def expected_counts(self, reference, prediction):
+        matrix = ConfusionMatrix()
+        matrix.add(reference, prediction)
+        return matrix.counts
+
+    def test_inside(self):
+        """A prediction inside the mask is compared with the pixels under it."""
+        mask_dataset = create_dataset(self.mask, 1000.0, 20000.0)
+        # 10 columns right and 20 lines down of the corner of the mask
+        prediction_dataset = create_dataset(self.prediction, 1300.0, 19400.0)
+        self.assertEqual(
+            get_overlap(prediction_dataset, mask_dataset), ((0, 0, 60, 250), (10, 20, 60, 250)))
+        matrix = evaluate_prediction(prediction_dataset, mask_dataset)
+        np.testing.assert_array_equal(
+            matrix.counts, self.expected_counts(self.mask[20:270, 10:70], self.prediction))
+
+    def test_partial_overlap(self):
+        """Only the pixels of the prediction over the mask are compared."""
+        mask_dataset = create_dataset(self.mask, 1000.0, 20000.0)
+        # 30 columns left and 100 lines down of the corner of the mask
+        prediction_dataset = create_dataset(self.prediction, 100.0, 17000.0)
+        self.assertEqual(
+            get_overlap(prediction_dataset, mask_dataset), ((30, 0, 30, 200), (0, 100, 30, 200)))
+        matrix = evaluate_prediction(prediction_dataset, mask_dataset)
+        np.testing.assert_array_equal(
+            matrix.counts, self.expected_counts(self.mask[100:300, 0:30], self.prediction[0:200, 30:60]))
+
+    def test_not_aligned(self):
+        """Predictions not aligned with the pixels of the mask, or away from it, are not compared."""
+        mask_dataset = create_dataset(self.mask, 1000.0, 20000.0)
+        shifted = create_dataset(self.prediction, 1015.0, 20000.0)
+        self.assertIsNone(evaluate_prediction(shifted, mask_dataset))
+        other_resolution = create_dataset(self.prediction, 1000.0, 20000.0, 10.0)
+        self.assertIsNone(evaluate_prediction(other_resolution, mask_dataset))
+        away = create_dataset(self.prediction, 100000.0, 20000.0)
+        self.assertIsNone(evaluate_prediction(away, mask_dataset))
+
+    def test_canceled(self):
+        """A canceled evaluation has no matrix."""
+        mask_dataset = create_dataset(self.mask, 1000.0, 20000.0)
+        prediction_dataset = create_dataset(self.prediction, 1000.0, 20000.0)
+        self.assertIsNone(evaluate_prediction(prediction_dataset, mask_dataset, lambda: True))
+
+
+if __name__ == "__main__":
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(ConfusionMatrixTest))
+    suite.addTest(unittest.makeSuite(EvaluatePredictionTest))
+    runner = unittest.TextTestRunner(verbosity=2)
+    runner.run(suite)
@@ -0,0 +1,103 @@
+# coding=utf-8
+"""Manifest test.
+
+.. note:: This program is free software; you can redistribute it and/or modify
+     it under the terms of the GNU General Public License as published by
+     the Free Software Foundation; either version 2 of the License, or
+     (at your option) any later version.
+
+"""
+
+__author__ = 'bruscantinic@gmail.com'
+__date__ = '2019-07-01'
+__copyright__ = 'Copyright 2019, UNICEN'
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from scripts.manifest import Manifest
+
+
+class ManifestTest(unittest.TestCase):
+    """Test an output is up to date only while nothing it was built from changed."""
+
+    def setUp(self):
+        """Runs before each test."""
+        self.directory = tempfile.mkdtemp()
+        self.manifest_file = os.path.join(self.directory, "manifest.json")
+        self.input_file = os.path.join(self.directory, "merged.tif")
+        self.output_file = os.path.join(self.directory, "ndvi.tif")
+        self.write(self.input_file, b"bands")
+        self.write(self.output_file, b"ndvi")
+        self.parameters = {"size": 3}
+
+    def tearDown(self):
+        """Runs after each test."""
+        shutil.rmtree(self.directory)
+
+    def write(self, file_name, content, mtime=None):
+        with open(file_name, 'wb') as f:
+            f.write(content)
+        if mtime is not None:
+            os.utime(file_name, (mtime, mtime))
+
+    def build(self, manifest=None):
+        manifest = manifest or Manifest(self.manifest_file)
+        manifest.update(self.output_file, [self.input_file], self.parameters, 1, ["ndvi"])
+        manifest.save()
+        return manifest
+
+    def is_up_to_date(self, inputs=None, parameters=None, version=1):
+        return Manifest(self.manifest_file).is_up_to_date(
+            self.output_file, inputs or [self.input_file], parameters or self.parameters, version)
+
+    def test_up_to_date(self):
+        """An output is up to date after being built, also for a new manifest."""
+        self.assertFalse(self.is_up_to_date())
+        self.build()
+        self.assertTrue(self.is_up_to_date())
+        self.assertEqual(Manifest(self.manifest_file).get_feature_names(self.output_file), ["ndvi"])
+
+    def test_input_changed(self):
+        """Modifying an input makes the output stale."""
+        self.build()
+        self.write(self.input_file, b"other", mtime=1)
+        self.assertFalse(self.is_up_to_date())
+
+    def test_input_missing(self):
+        """A missing input makes the output stale."""
+        self.build()
+        os.remove(self.input_file)
+        self.assertFalse(self.is_up_to_date())
+
+    def test_output_changed(self):
+        """Modifying or removing the output makes it stale."""
+        self.build()
+        self.write(self.output_file, b"edited", mtime=1)
+        self.assertFalse(self.is_up_to_date())
+        os.remove(self.output_file)
+        self.assertFalse(self.is_up_to_date())
+
+    def test_parameters_and_version(self):
+        """Other parameters, other inputs or another code version make the output stale."""
+        self.build()
+        self.assertFalse(self.is_up_to_date(parameters={"size": 5}))
+        self.assertFalse(self.is_up_to_date(version=2))
+        self.assertFalse(self.is_up_to_date(inputs=[self.input_file, self.manifest_file]))
+        self.assertTrue(self.is_up_to_date(parameters={"size": 3}))
+
+    def test_broken_manifest(self):
+        """A broken manifest reports every output as stale."""
+        self.build()
+        self.write(self.manifest_file, b"{not json")
+        self.assertFalse(self.is_up_to_date())
+        self.build()
+        self.assertTrue(self.is_up_to_date())
+
+
+if __name__ == "__main__":
+    suite = unittest.makeSuite(ManifestTest)
+    runner = unittest.TextTestRunner(verbosity=2)
+    runner.run(suite)
@@ -0,0 +1,123 @@
+# coding=utf-8
+"""Image metadata test.
+
+.. note:: This program is free software; you can redistribute it and/or modify
+     it under the terms of the GNU General Public License as published by
+     the Free Software Foundation; either version 2 of the License, or
+     (at your option) any later version.
+
+"""
+
+__author__ = 'bruscantinic@gmail.com'
+__date__ = '2019-07-01'
+__copyright__ = 'Copyright 2019, UNICEN'
+
+import datetime
+import os
+import shutil
+import tempfile
+import unittest
+
+from scripts import metadata
+
+MTL = """GROUP = L1_METADATA_FILE
+  GROUP = METADATA_FILE_INFO
+    ORIGIN = "Image courtesy of the U.S. Geological Survey"
+    FILE_DATE = 2019-03-02T12:34:56Z
+  END_GROUP = METADATA_FILE_INFO
+  GROUP = PRODUCT_METADATA
+    SPACECRAFT_ID = "LANDSAT_8"
+    WRS_PATH = 225
+    WRS_ROW = 86
+    DATE_ACQUIRED = 2019-02-27
+    SCENE_CENTER_TIME = "13:47:31.6260800Z"
+  END_GROUP = PRODUCT_METADATA
+  GROUP = IMAGE_ATTRIBUTES
+    CLOUD_COVER = 1.25
+    CLOUD_COVER_LAND = 0.50
+    SUN_AZIMUTH = 71.58231963
+    SUN_ELEVATION = 51.30107814
+    EARTH_SUN_DISTANCE = 0.9896063
+  END_GROUP = IMAGE_ATTRIBUTES
+  GROUP = LEVEL1_PROCESSING_RECORD
+    DATE_ACQUIRED = 2000-01-01
+  END_GROUP = LEVEL1_PROCESSING_RECORD
+END_GROUP = L1_METADATA_FILE
+END
+"""
+
+
+class MetadataTest(unittest.TestCase):
+    """Test the fields of the _MTL.txt files are read and kept for the session."""
+
+    def setUp(self):
+        """Runs before each test."""
+        self.directory = tempfile.mkdtemp()
+        self.file_name = os.path.join(self.directory, "LC08_L1TP_225086_20190227_MTL.txt")
+        self.write(MTL)
+        metadata._cache.clear()
+
+    def tearDown(self):
+        """Runs after each test."""
+        metadata._cache.clear()
+        shutil.rmtree(self.directory)
+
+    def write(self, content):
+        with open(self.file_name, 'w') as f:
+            f.write(content)
+
+    def test_fields(self):
+        """The fields are read with their types."""
+        image_metadata = metadata.read_metadata(self.file_name)
+        self.assertEqual(image_metadata.date, datetime.date(2019, 2, 27))
+        self.assertEqual(image_metadata.scene_center_time, "13:47:31.6260800Z")
+        self.assertEqual(image_metadata.spacecraft, "LANDSAT_8")
+        self.assertEqual((image_metadata.wrs_path, image_metadata.wrs_row), (225, 86))
+        self.assertEqual(image_metadata.cloud_cover, 1.25)
+        self.assertEqual(image_metadata.cloud_cover_land, 0.5)
+        self.assertAlmostEqual(image_metadata.sun_azimuth, 71.58231963)
+        self.assertAlmostEqual(image_metadata.sun_elevation, 51.30107814)
+        self.assertAlmostEqual(image_metadata.earth_sun_distance, 0.9896063)
+
+    def test_values(self):
+        """Every value is kept as text, the first one of repeated keys."""
+        values = metadata.read_metadata(self.file_name).values
+        self.assertEqual(values["ORIGIN"], "Image courtesy of the U.S. Geological Survey")
+        self.assertEqual(values["FILE_DATE"], "2019-03-02T12:34:56Z")
+        self.assertEqual(values["DATE_ACQUIRED"], "2019-02-27")
+        self.assertNotIn("GROUP", values)
+        self.assertNotIn("END_GROUP", values)
+        self.assertNotIn("END", values)
+
+    def test_missing_fields(self):
+        """Fields missing from the file are None."""
+        self.write('GROUP = L1_METADATA_FILE\n  SPACECRAFT_ID = "LANDSAT_7"\nEND_GROUP = L1_METADATA_FILE\nEND\n')
+        image_metadata = metadata.read_metadata(self.file_name)
+        self.assertEqual(image_metadata.spacecraft, "LANDSAT_7")
+        self.assertIsNone(image_metadata.date)
+        self.assertIsNone(image_metadata.wrs_path)
+        self.assertIsNone(image_metadata.cloud_cover)
+
+    def test_cached(self):
+        """A file is parsed once while it doesn't change, whatever the path used."""
+        first = metadata.read_metadata(self.file_name)
+        other_path = os.path.join(self.directory, ".", os.path.basename(self.file_name))
+        self.assertIs(metadata.read_metadata(other_path), first)
+        self.assertEqual(len(metadata._cache), 1)
+
+    def test_changed_file(self):
+        """A file that changed is parsed again."""
+        first = metadata.read_metadata(self.file_name)
+        self.write(MTL.replace("CLOUD_COVER = 1.25", "CLOUD_COVER = 12.5"))
+        stat = os.stat(self.file_name)
+        # Same size, so only the modification time tells it changed
+        os.utime(self.file_name, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+        second = metadata.read_metadata(self.file_name)
+        self.assertIsNot(second, first)
+        self.assertEqual(second.cloud_cover, 12.5)
+
+
+if __name__ == "__main__":
+    suite = unittest.makeSuite(MetadataTest)
+    runner = unittest.TextTestRunner(verbosity=2)
+    runner.run(suite)
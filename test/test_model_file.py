@@ -0,0 +1,168 @@
+# coding=utf-8
+"""Model file test.
+
+.. note:: This program is free software; you can redistribute it and/or modify
+     it under the terms of the GNU General Public License as published by
+     the Free Software Foundation; either version 2 of the License, or
+     (at your option) any later version.
+
+"""
+
+__author__ = 'bruscantinic@gmail.com'
+__date__ = '2019-07-01'
+__copyright__ = 'Copyright 2019, UNICEN'
+
+import os
+import pickle
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+from sklearn.ensemble import HistGradientBoostingClassifier, RandomForestClassifier
+
+from scripts.model_file import ModelFile, write_model_file, is_model_file, pickle_model, copy_array, ALIGNMENT
+
+
+class ModelFileTest(unittest.TestCase):
+    """Test model files are written and read back."""
+
+    def setUp(self):
+        """Runs before each test."""
+        self.directory = tempfile.mkdtemp()
+        self.file_name = os.path.join(self.directory, "classifier.ljm")
+        rng = np.random.default_rng(0)
+        self.header = {"backend": "random_forest", "feature_names": ["ndvi", "mean"]}
+        self.arrays = {
+            "model": np.frombuffer(b"pickled model", dtype=np.uint8),
+            "feature": rng.integers(0, 30, 1001).astype(np.int32),
+            "threshold": rng.random(1001).astype(np.float32),
+            "values": rng.random((1001, 2)),
+            "empty": np.empty((0, 3), dtype=np.float32)}
+
+    def tearDown(self):
+        """Runs after each test."""
+        shutil.rmtree(self.directory)
+
+    def check_round_trip(self, compress):
+        write_model_file(self.file_name, self.header, self.arrays, compress)
+        self.assertTrue(is_model_file(self.file_name))
+        model_file = ModelFile(self.file_name)
+        self.assertEqual(model_file.header["backend"], "random_forest")
+        self.assertEqual(model_file.header["feature_names"], ["ndvi", "mean"])
+        for name, array in self.arrays.items():
+            self.assertIn(name, model_file)
+            read = model_file.array(name)
+            self.assertEqual(read.dtype, array.dtype)
+            np.testing.assert_array_equal(read, array)
+        return model_file
+
+    def test_round_trip(self):
+        """Uncompressed arrays are mapped where they are, aligned."""
+        model_file = self.check_round_trip(False)
+        self.assertIsInstance(model_file.array("values"), np.memmap)
+        for entry in model_file.entries.values():
+            self.assertEqual((model_file.data_start + entry["offset"]) % ALIGNMENT, 0)
+
+    def test_round_trip_compressed(self):
+        """Compressed arrays are read into memory."""
+        model_file = self.check_round_trip(True)
+        self.assertNotIsInstance(model_file.array("values"), np.memmap)
+        self.assertLess(model_file.entries["feature"]["length"], self.arrays["feature"].nbytes)
+
+    def test_not_a_model_file(self):
+        """Other files are told apart by their magic."""
+        other_file = os.path.join(self.directory, "classifier.pkl")
+        with open(other_file, 'wb') as f:
+            f.write(b"\x80\x04 a pickle")
+        self.assertFalse(is_model_file(other_file))
+        with self.assertRaises(ValueError):
+            ModelFile(other_file)
+
+    def test_corrupted_compressed(self):
+        """Compressed arrays are checked against their hash."""
+        write_model_file(self.file_name, self.header, self.arrays, True)
+        model_file = ModelFile(self.file_name)
+        entry = model_file.entries["threshold"]
+        with open(self.file_name, 'r+b') as f:
+            f.seek(model_file.data_start + entry["offset"] + entry["length"] // 2)
+            f.write(b"\x00\x01\x02\x03")
+        with self.assertRaises(ValueError):
+            ModelFile(self.file_name).array("threshold")
+
+    def test_truncated(self):
+        """A truncated file is found when it's opened."""
+        write_model_file(self.file_name, self.header, self.arrays, False)
+        with open(self.file_name, 'r+b') as f:
+            f.truncate(os.path.getsize(self.file_name) - 100)
+        with self.assertRaises(ValueError):
+            ModelFile(self.file_name)
+
+    def test_replace_mapped(self):
+        """A file can be written again while its arrays are mapped."""
+        write_model_file(self.file_name, self.header, self.arrays, False)
+        values = ModelFile(self.file_name).array("values")
+        arrays = dict(self.arrays, values=np.asarray(values) * 2)
+        write_model_file(self.file_name, self.header, arrays, False)
+        np.testing.assert_array_equal(ModelFile(self.file_name).array("values"), self.arrays["values"] * 2)
+        self.assertFalse(os.path.exists(self.file_name + ".tmp"))
+
+
+    def check_model(self, model, compress=False):
+        rng = np.random.default_rng(1)
+        X = rng.random((500, 4)).astype(np.float32)
+        # Noisy classes, so the trees are deep
+        y = (X[:, 0] + rng.random(500) > 1).astype(np.uint8) + 1
+        model.fit(X, y)
+        arrays = pickle_model(model)
+        write_model_file(self.file_name, self.header, arrays, compress)
+        model_file = ModelFile(self.file_name)
+        self.assertEqual(model_file.model_names(), sorted(arrays, key=len))
+        loaded = model_file.load_model()
+        np.testing.assert_array_equal(loaded.predict_proba(X), model.predict_proba(X))
+        return arrays, loaded
+
+    def test_forest(self):
+        """The nodes of the trees are stored as arrays, not in the pickle."""
+        arrays, _ = self.check_model(RandomForestClassifier(n_estimators=5, random_state=0))
+        self.assertGreater(len(arrays), 5)
+        self.assertLess(arrays["model"].nbytes, sum(array.nbytes for array in arrays.values()) / 2)
+
+    def test_gradient_boosting(self):
+        """The nodes of the predictors stay mapped from the file."""
+        _, loaded = self.check_model(HistGradientBoostingClassifier(max_iter=5, max_leaf_nodes=None, min_samples_leaf=2))
+        self.assertIsInstance(loaded._predictors[0][0].nodes, np.memmap)
+
+    def test_model_compressed(self):
+        """Compressed models are rebuilt from arrays read into memory."""
+        _, loaded = self.check_model(HistGradientBoostingClassifier(max_iter=5, max_leaf_nodes=None, min_samples_leaf=2), True)
+        self.assertNotIsInstance(loaded._predictors[0][0].nodes, np.memmap)
+
+    def test_model_copy(self):
+        """Copied models don't map the file."""
+        self.check_model(HistGradientBoostingClassifier(max_iter=5, max_leaf_nodes=None, min_samples_leaf=2))
+        loaded = ModelFile(self.file_name).load_model(copy=True)
+        self.assertNotIsInstance(loaded._predictors[0][0].nodes, np.memmap)
+
+    def test_single_pickle(self):
+        """Models saved as a single pickle are still read."""
+        arrays = {"model": np.frombuffer(pickle.dumps({"trees": np.arange(1000)}), dtype=np.uint8)}
+        write_model_file(self.file_name, self.header, arrays)
+        np.testing.assert_array_equal(ModelFile(self.file_name).load_model()["trees"], np.arange(1000))
+
+    def test_structured_dtype(self):
+        """Arrays with fields keep them."""
+        dtype = np.dtype([("feature", np.int64), ("threshold", np.float64), ("left", np.uint8)], align=True)
+        array = np.zeros(100, dtype=dtype)
+        array["threshold"] = np.arange(100)
+        write_model_file(self.file_name, self.header, {"nodes": array})
+        read = ModelFile(self.file_name).array("nodes")
+        self.assertEqual(read.dtype, dtype)
+        np.testing.assert_array_equal(read["threshold"], np.arange(100))
+        self.assertEqual(copy_array(read).tobytes(), read.tobytes())
+
+
+if __name__ == "__main__":
+    suite = unittest.makeSuite(ModelFileTest)
+    runner = unittest.TextTestRunner(verbosity=2)
+    runner.run(suite)
@@ -0,0 +1,106 @@
+# coding=utf-8
+"""Prediction cache test.
+
+.. note:: This program is free software; you can redistribute it and/or modify
+     it under the terms of the GNU General Public License as published by
+     the Free Software Foundation; either version 2 of the License, or
+     (at your option) any later version.
+
+"""
+
+__author__ = 'bruscantinic@gmail.com'
+__date__ = '2019-07-01'
+__copyright__ = 'Copyright 2019, UNICEN'
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from scripts.prediction_cache import PredictionCache
+
+
+class PredictionCacheTest(unittest.TestCase):
+    """Test predictions are reused without sharing their files."""
+
+    def setUp(self):
+        """Runs before each test."""
+        self.directory = tempfile.mkdtemp()
+        self.cache = PredictionCache(os.path.join(self.directory, "cache"), 100)
+        self.output_file = os.path.join(self.directory, "prediction.tif")
+
+    def tearDown(self):
+        """Runs after each test."""
+        shutil.rmtree(self.directory)
+
+    def write(self, file_name, content):
+        with open(file_name, 'wb') as f:
+            f.write(content)
+
+    def read(self, file_name):
+        with open(file_name, 'rb') as f:
+            return f.read()
+
+    def test_round_trip(self):
+        """A prediction put with a key is got back with it."""
+        key = self.cache.create_key({"classifier": "a"})
+        self.assertIsNone(self.cache.get(key, self.output_file))
+        self.write(self.output_file, b"first")
+        self.cache.put(key, self.output_file)
+        os.remove(self.output_file)
+        self.assertEqual(self.cache.get(key, self.output_file), self.output_file)
+        self.assertEqual(self.read(self.output_file), b"first")
+
+    def test_output_not_shared(self):
+        """Writing over the output in place leaves the cached prediction as it was."""
+        key = self.cache.create_key({"classifier": "a"})
+        self.write(self.output_file, b"first")
+        self.cache.put(key, self.output_file)
+        with open(self.output_file, 'r+b') as f:
+            f.write(b"other")
+        self.assertEqual(self.read(self.cache.get_file_name(key)), b"first")
+
+        self.assertEqual(self.cache.get(key, self.output_file), self.output_file)
+        with open(self.output_file, 'r+b') as f:
+            f.write(b"again")
+        self.assertEqual(self.read(self.cache.get_file_name(key)), b"first")
+
+    def test_last_output_reused(self):
+        """An unchanged output of an earlier run is reused instead of copied."""
+        key = self.cache.create_key({"classifier": "a"})
+        self.write(self.output_file, b"first")
+        self.cache.put(key, self.output_file)
+        other_output_file = os.path.join(self.directory, "other.tif")
+        self.assertEqual(self.cache.get(key, other_output_file), self.output_file)
+        self.assertFalse(os.path.exists(other_output_file))
+
+    def test_last_output_modified(self):
+        """A modified output is not reused, the prediction is copied to the new one."""
+        key = self.cache.create_key({"classifier": "a"})
+        self.write(self.output_file, b"first")
+        self.cache.put(key, self.output_file)
+        self.write(self.output_file, b"edited")
+        other_output_file = os.path.join(self.directory, "other.tif")
+        self.assertEqual(self.cache.get(key, other_output_file), other_output_file)
+        self.assertEqual(self.read(other_output_file), b"first")
+        # The copy is the one reused from now on
+        self.assertEqual(self.cache.get(key, self.output_file), other_output_file)
+
+    def test_evict_least_recently_used(self):
+        """Eviction removes the predictions used longest ago first."""
+        keys = [self.cache.create_key({"classifier": name}) for name in "abc"]
+        for i, key in enumerate(keys):
+            self.write(self.output_file, b"x" * 40)
+            self.cache.put(key, self.output_file)
+            os.utime(self.cache.get_file_name(key), (i, i))
+        self.cache.evict()
+        self.assertEqual(
+            [os.path.exists(self.cache.get_file_name(key)) for key in keys], [False, True, True])
+        self.assertEqual(
+            [os.path.exists(self.cache.get_output_record_name(key)) for key in keys], [False, True, True])
+
+
+if __name__ == "__main__":
+    suite = unittest.makeSuite(PredictionCacheTest)
+    runner = unittest.TextTestRunner(verbosity=2)
+    runner.run(suite)
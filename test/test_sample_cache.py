@@ -0,0 +1,100 @@
+# coding=utf-8
+"""Sample cache test.
+
+.. note:: This program is free software; you can redistribute it and/or modify
+     it under the terms of the GNU General Public License as published by
+     the Free Software Foundation; either version 2 of the License, or
+     (at your option) any later version.
+
+"""
+
+__author__ = 'bruscantinic@gmail.com'
+__date__ = '2019-07-01'
+__copyright__ = 'Copyright 2019, UNICEN'
+
+import os
+import glob
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from scripts.image import Image
+from scripts.sample_cache import SampleCache, roi_hash, roi_files
+
+
+class SampleCacheTest(unittest.TestCase):
+    """Test the samples of an image are saved and reused by key."""
+
+    def setUp(self):
+        """Runs before each test."""
+        self.directory = tempfile.mkdtemp()
+        self.image = Image(self.directory)
+        self.image.base_name = "LC08_TEST"
+        self.cache = SampleCache(self.image)
+
+    def tearDown(self):
+        """Runs after each test."""
+        shutil.rmtree(self.directory)
+
+    def samples_files(self):
+        return glob.glob(os.path.join(self.directory, "LC08_TEST_samples_*.npz"))
+
+    def test_key(self):
+        """The key depends on the parts, not on their order."""
+        key = self.cache.create_key({"roi": "a", "features": ["ndvi"]})
+        self.assertEqual(key, self.cache.create_key({"features": ["ndvi"], "roi": "a"}))
+        self.assertNotEqual(key, self.cache.create_key({"roi": "b", "features": ["ndvi"]}))
+
+    def test_round_trip(self):
+        """Saved samples are loaded back with their key only."""
+        X = np.arange(12, dtype=np.float32).reshape(4, 3)
+        y = np.array([1, 2, 1, 2], dtype=np.uint8)
+        key = self.cache.create_key({"roi": "a"})
+        self.assertIsNone(self.cache.load(key))
+
+        self.cache.save(key, X, y)
+        loaded_X, loaded_y = self.cache.load(key)
+        np.testing.assert_array_equal(loaded_X, X)
+        np.testing.assert_array_equal(loaded_y, y)
+        self.assertIsNone(self.cache.load(self.cache.create_key({"roi": "b"})))
+
+    def test_only_last_key_kept(self):
+        """Saving with a new key removes the samples of the old one."""
+        X = np.zeros((2, 3), dtype=np.float32)
+        y = np.ones(2, dtype=np.uint8)
+        old_key = self.cache.create_key({"roi": "a"})
+        new_key = self.cache.create_key({"roi": "b"})
+        self.cache.save(old_key, X, y)
+        self.cache.save(new_key, X, y)
+        self.assertEqual(self.samples_files(), [self.cache.get_file_name(new_key)])
+        self.assertIsNone(self.cache.load(old_key))
+
+    def test_broken_file_discarded(self):
+        """A broken file is removed instead of failing."""
+        key = self.cache.create_key({"roi": "a"})
+        with open(self.cache.get_file_name(key), 'wb') as f:
+            f.write(b"not a npz file")
+        self.assertIsNone(self.cache.load(key))
+        self.assertEqual(self.samples_files(), [])
+
+    def test_roi_hash(self):
+        """Editing any file of the shapefile changes its hash."""
+        shapefile = os.path.join(self.directory, "place_roi.shp")
+        for extension in [".shp", ".shx", ".dbf"]:
+            with open(shapefile[:-4] + extension, 'wb') as f:
+                f.write(extension.encode("utf-8"))
+        self.assertEqual(len(roi_files(shapefile)), 3)
+
+        original = roi_hash(shapefile)
+        self.assertEqual(original, roi_hash(shapefile))
+        with open(shapefile[:-4] + ".dbf", 'ab') as f:
+            f.write(b"class 2")
+        self.assertNotEqual(original, roi_hash(shapefile))
+
+
+if __name__ == "__main__":
+    suite = unittest.makeSuite(SampleCacheTest)
+    runner = unittest.TextTestRunner(verbosity=2)
+    runner.run(suite)
@@ -0,0 +1,154 @@
+# coding=utf-8
+"""Sample store test.
+
+.. note:: This program is free software; you can redistribute it and/or modify
+     it under the terms of the GNU General Public License as published by
+     the Free Software Foundation; either version 2 of the License, or
+     (at your option) any later version.
+
+"""
+
+__author__ = 'bruscantinic@gmail.com'
+__date__ = '2019-07-01'
+__copyright__ = 'Copyright 2019, UNICEN'
+
+import os
+import gc
+import glob
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from scripts.sample_store import SampleStore
+
+
+def samples(start, count, features=3):
+    """Samples whose first feature is their number, labelled 1 or 2."""
+    X = np.zeros((count, features), dtype=np.float32)
+    X[:, 0] = np.arange(start, start + count)
+    y = (np.arange(start, start + count) % 2 + 1).astype(np.uint8)
+    return X, y
+
+
+class SampleStoreTest(unittest.TestCase):
+    """Test the samples are stored, spilled, split and deleted."""
+
+    def setUp(self):
+        """Runs before each test."""
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        """Runs after each test."""
+        shutil.rmtree(self.directory)
+
+    def spilled_files(self):
+        return glob.glob(os.path.join(self.directory, ".lumberjack_samples_*.dat"))
+
+    def test_growth(self):
+        """Capacity doubles when it runs out and the samples are kept in order."""
+        store = SampleStore()
+        for start in range(0, 3000, 500):
+            store.add(*samples(start, 500))
+        self.assertEqual(len(store), 3000)
+        self.assertEqual(store.capacity, 4 * SampleStore.MIN_CAPACITY)
+        X, y = store.get()
+        np.testing.assert_array_equal(X[:, 0], np.arange(3000))
+        np.testing.assert_array_equal(y, np.arange(3000) % 2 + 1)
+
+    def test_reserved(self):
+        """A reserved capacity is allocated once."""
+        store = SampleStore(5000)
+        for start in range(0, 5000, 1000):
+            store.add(*samples(start, 1000))
+        self.assertEqual(store.capacity, 5000)
+        self.assertEqual(len(store), 5000)
+
+    def test_checks(self):
+        """Samples must have a label each and as many features as the first ones."""
+        store = SampleStore()
+        self.assertEqual(store.get(), (None, None))
+        with self.assertRaises(ValueError):
+            store.add(np.zeros((3, 2)), np.zeros(2, dtype=np.uint8))
+        store.add(*samples(0, 4))
+        with self.assertRaises(ValueError):
+            store.add(*samples(4, 4, features=2))
+
+    def test_spill(self):
+        """Spilled samples are kept in a file of the spill directory while the store is open."""
+        store = SampleStore(100, self.directory)
+        store.add(*samples(0, 100))
+        X, y = store.get()
+        self.assertIsInstance(X, np.memmap)
+        self.assertEqual(self.spilled_files(), [store.get_file_name()])
+        store.add(*samples(100, 50))
+        self.assertEqual(self.spilled_files(), [store.get_file_name()])
+        np.testing.assert_array_equal(store.get()[0][:, 0], np.arange(150))
+
+    def test_spill_deleted_on_close(self):
+        """Closing the store deletes its file."""
+        store = SampleStore(100, self.directory)
+        store.add(*samples(0, 100))
+        store.close()
+        self.assertEqual(self.spilled_files(), [])
+        self.assertEqual(len(store), 0)
+
+    def test_spill_deleted_when_collected(self):
+        """The file of a store nobody refers to is deleted."""
+        store = SampleStore(100, self.directory)
+        store.add(*samples(0, 100))
+        store = None
+        gc.collect()
+        self.assertEqual(self.spilled_files(), [])
+
+    def test_split(self):
+        """Splitting keeps every sample once, with the asked amount for testing."""
+        store = SampleStore()
+        store.add(*samples(0, 1000))
+        X_train, y_train, X_test, y_test = store.split(0.25, random_state=1)
+        self.assertEqual((len(X_train), len(X_test)), (750, 250))
+        numbers = np.concatenate([X_train[:, 0], X_test[:, 0]])
+        np.testing.assert_array_equal(np.sort(numbers), np.arange(1000))
+        np.testing.assert_array_equal(y_train, X_train[:, 0].astype(int) % 2 + 1)
+        np.testing.assert_array_equal(y_test, X_test[:, 0].astype(int) % 2 + 1)
+
+        other = SampleStore()
+        other.add(*samples(0, 1000))
+        np.testing.assert_array_equal(other.split(250, random_state=1)[2], X_test)
+
+    def test_split_in_blocks(self):
+        """Swapping in blocks gives the same split as all at once."""
+        store = SampleStore()
+        store.add(*samples(0, 1000))
+        expected = store.split(300, random_state=2)[2].copy()
+        block = SampleStore.SWAP_BLOCK
+        SampleStore.SWAP_BLOCK = 7
+        try:
+            store = SampleStore()
+            store.add(*samples(0, 1000))
+            np.testing.assert_array_equal(store.split(300, random_state=2)[2], expected)
+        finally:
+            SampleStore.SWAP_BLOCK = block
+
+    def test_split_spilled_in_place(self):
+        """Spilled samples are split inside their file."""
+        store = SampleStore(200, self.directory)
+        store.add(*samples(0, 200))
+        X_train, y_train, X_test, y_test = store.split(0.5, random_state=3)
+        self.assertIsInstance(X_train, np.memmap)
+        self.assertEqual(self.spilled_files(), [store.get_file_name()])
+
+    def test_split_checks(self):
+        """Both sets must have samples."""
+        store = SampleStore()
+        store.add(*samples(0, 10))
+        for test_size in [0, 10, 0.0, 1.0]:
+            with self.assertRaises(ValueError):
+                store.split(test_size)
+
+
+if __name__ == "__main__":
+    suite = unittest.makeSuite(SampleStoreTest)
+    runner = unittest.TextTestRunner(verbosity=2)
+    runner.run(suite)
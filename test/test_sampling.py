@@ -0,0 +1,207 @@
+# coding=utf-8
+"""Sampling test.
+
+.. note:: This program is free software; you can redistribute it and/or modify
+     it under the terms of the GNU General Public License as published by
+     the Free Software Foundation; either version 2 of the License, or
+     (at your option) any later version.
+
+"""
+
+__author__ = 'bruscantinic@gmail.com'
+__date__ = '2019-07-01'
+__copyright__ = 'Copyright 2019, UNICEN'
+
+import collections
+import unittest
+
+import numpy as np
+
+from scripts.sampling import Reservoir, StratifiedReservoir, CappedSampler
+
+
+def scene_samples(rng, counts):
+    """Samples of a scene with counts[c] pixels of each class c."""
+    y = np.concatenate([np.full(n, c, dtype=np.uint8) for c, n in counts.items()])
+    rng.shuffle(y)
+    X = rng.random((len(y), 3)).astype(np.float32)
+    return X, y
+
+
+class Collector:
+    """Keeps what a sampler emits."""
+
+    def __init__(self):
+        self.X = []
+        self.y = []
+
+    def __call__(self, X, y):
+        self.X.append(X)
+        self.y.append(y)
+
+    def classes(self):
+        if not self.y:
+            return collections.Counter()
+        return collections.Counter(np.concatenate(self.y).tolist())
+
+
+class ReservoirTest(unittest.TestCase):
+    """Test the bottom-k reservoirs."""
+
+    def test_keeps_smallest_keys(self):
+        """The reservoir keeps the samples of the smallest keys."""
+        rng = np.random.default_rng(1)
+        X = rng.random((100, 2))
+        y = np.ones(100, dtype=np.uint8)
+        keys = rng.random(100)
+        reservoir = Reservoir(10)
+        reservoir.add(X, y, keys)
+        self.assertEqual(len(reservoir), 10)
+        np.testing.assert_array_equal(np.sort(reservoir.keys), np.sort(keys)[:10])
+
+    def test_in_parts_same_as_at_once(self):
+        """Adding the samples in parts keeps the same samples."""
+        rng = np.random.default_rng(2)
+        X = rng.random((1000, 2))
+        y = np.ones(1000, dtype=np.uint8)
+        keys = rng.random(1000)
+        at_once = Reservoir(50)
+        at_once.add(X, y, keys)
+        in_parts = Reservoir(50)
+        for start in range(0, 1000, 137):
+            in_parts.add(X[start:start+137], y[start:start+137], keys[start:start+137])
+        self.assertEqual(set(in_parts.keys.tolist()), set(at_once.keys.tolist()))
+        self.assertEqual(
+            set(map(tuple, in_parts.X.tolist())), set(map(tuple, at_once.X.tolist())))
+
+    def test_under_capacity(self):
+        """Fewer samples than the capacity are all kept."""
+        reservoir = Reservoir(10)
+        reservoir.add(np.zeros((4, 2)), np.ones(4, dtype=np.uint8), np.arange(4.0))
+        self.assertEqual(len(reservoir), 4)
+
+    def test_stratified(self):
+        """Each class is capped on its own."""
+        rng = np.random.default_rng(3)
+        X, y = scene_samples(rng, {1: 100, 2: 5})
+        reservoir = StratifiedReservoir(20)
+        reservoir.add(X, y, rng.random(len(y)))
+        taken = reservoir.take()
+        self.assertEqual([(int(c[0]), len(c)) for _, c, _ in taken], [(1, 20), (2, 5)])
+        self.assertEqual(reservoir.take(), [])
+
+
+class CappedSamplerTest(unittest.TestCase):
+    """Test the caps of the sampler per scene, place and class."""
+
+    PLACES = [
+        [{1: 500, 2: 40}, {1: 300, 2: 80}],
+        [{1: 50, 2: 700}, {1: 900, 2: 10}, {1: 20, 2: 20}]]
+
+    def run_sampler(self, seed=0, **caps):
+        collector = Collector()
+        sampler = CappedSampler(collector, seed=seed, **caps)
+        rng = np.random.default_rng(10)
+        for scenes in self.PLACES:
+            for counts in scenes:
+                sampler.add(*scene_samples(rng, counts))
+                sampler.finish_scene()
+            sampler.finish_place()
+        sampler.finish()
+        return sampler, collector
+
+    def test_uncapped(self):
+        """Without caps every sample passes."""
+        sampler, collector = self.run_sampler()
+        self.assertFalse(sampler.is_enabled())
+        self.assertEqual(collector.classes(), collections.Counter({1: 1770, 2: 850}))
+
+    def test_cap_per_scene(self):
+        """No scene gives more than the cap of a class."""
+        collector = Collector()
+        sampler = CappedSampler(collector, max_per_scene=100)
+        rng = np.random.default_rng(4)
+        for counts in self.PLACES[0]:
+            sampler.add(*scene_samples(rng, counts))
+            sampler.finish_scene()
+            self.assertEqual(
+                collector.classes(), collections.Counter(
+                    {c: min(n, 100) for c, n in counts.items()}))
+            collector.X, collector.y = [], []
+
+    def test_cap_per_place(self):
+        """No place gives more than the cap of a class."""
+        sampler, collector = self.run_sampler(max_per_place=100)
+        self.assertEqual(collector.classes(), collections.Counter({1: 200, 2: 200}))
+
+    def test_cap_per_class(self):
+        """The training set has at most the cap of each class."""
+        sampler, collector = self.run_sampler(max_per_class=300)
+        self.assertEqual(collector.classes(), collections.Counter({1: 300, 2: 300}))
+
+    def test_all_caps(self):
+        """Caps are applied one level after the other."""
+        sampler, collector = self.run_sampler(max_per_scene=200, max_per_place=250, max_per_class=400)
+        # Place 1: class 1 min(200+200, 250), class 2 40+80
+        # Place 2: class 1 50+200+20, class 2 min(200+10+20, 250)
+        self.assertEqual(collector.classes(), collections.Counter({1: 400, 2: 350}))
+
+    def test_same_seed_same_samples(self):
+        """The same seed chooses the same samples."""
+        first = self.run_sampler(seed=5, max_per_scene=100, max_per_class=150)[1]
+        second = self.run_sampler(seed=5, max_per_scene=100, max_per_class=150)[1]
+        other = self.run_sampler(seed=6, max_per_scene=100, max_per_class=150)[1]
+        np.testing.assert_array_equal(np.concatenate(first.X), np.concatenate(second.X))
+        self.assertFalse(np.array_equal(np.concatenate(first.X), np.concatenate(other.X)))
+
+    def test_same_as_sampling_at_once(self):
+        """Capping the classes scene by scene gives the same samples as capping all of them at once."""
+        sampler, collector = self.run_sampler(seed=7, max_per_class=250)
+
+        rng = np.random.default_rng(10)
+        keys_rng = np.random.default_rng(7)
+        X, y, keys = [], [], []
+        for scenes in self.PLACES:
+            for counts in scenes:
+                scene_X, scene_y = scene_samples(rng, counts)
+                X.append(scene_X)
+                y.append(scene_y)
+                keys.append(keys_rng.random(len(scene_y)))
+        reservoir = StratifiedReservoir(250)
+        reservoir.add(np.concatenate(X), np.concatenate(y), np.concatenate(keys))
+        expected = np.concatenate([X for X, _, _ in reservoir.take()])
+
+        self.assertEqual(
+            set(map(tuple, np.concatenate(collector.X).tolist())), set(map(tuple, expected.tolist())))
+
+    def test_expected_samples(self):
+        """The expected amount of samples is exact."""
+        for caps in [{}, {"max_per_scene": 100}, {"max_per_place": 300},
+                     {"max_per_scene": 60, "max_per_place": 100, "max_per_class": 150}]:
+            collector = Collector()
+            sampler = CappedSampler(collector, **caps)
+            rng = np.random.default_rng(8)
+            counts = [{1: 120, 2: 35}, {1: 400, 2: 90}]
+            for place_counts in counts:
+                for scene in range(3):
+                    sampler.add(*scene_samples(rng, place_counts))
+                    sampler.finish_scene()
+                sampler.finish_place()
+            sampler.finish()
+            emitted = sum(collector.classes().values())
+            self.assertEqual(sampler.expected_samples([(c, 3) for c in counts]), emitted)
+
+    def test_distribution(self):
+        """The distribution tells the samples before and after sampling."""
+        sampler, collector = self.run_sampler(max_per_class=300)
+        self.assertEqual(sampler.distribution(), [
+            "Class 1: 1770 samples, 300 after sampling",
+            "Class 2: 850 samples, 300 after sampling"])
+
+
+if __name__ == "__main__":
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(ReservoirTest))
+    suite.addTest(unittest.makeSuite(CappedSamplerTest))
+    runner = unittest.TextTestRunner(verbosity=2)
+    runner.run(suite)
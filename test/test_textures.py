@@ -0,0 +1,158 @@
+# coding=utf-8
+"""Textures test.
+
+.. note:: This program is free software; you can redistribute it and/or modify
+     it under the terms of the GNU General Public License as published by
+     the Free Software Foundation; either version 2 of the License, or
+     (at your option) any later version.
+
+"""
+
+__author__ = 'bruscantinic@gmail.com'
+__date__ = '2019-07-01'
+__copyright__ = 'Copyright 2019, UNICEN'
+
+import os
+import sys
+import shutil
+import tempfile
+import subprocess
+import unittest
+
+import numpy as np
+from osgeo import gdal
+
+from scripts import textures
+
+
+TEXTURES_SCRIPT = os.path.join(os.path.dirname(__file__), os.pardir, "scripts", "textures.py")
+
+
+def brute_force_measures(quantized, size, distance):
+    """Measures of every pixel from its co-occurrence matrix, built pair by pair."""
+    half = size // 2
+    padded = np.pad(quantized, half, mode='symmetric').astype(np.int64)
+    lines, columns = quantized.shape
+    measures = np.zeros((len(textures.MEASURES), lines, columns))
+    levels = np.arange(256)
+    for y in range(lines):
+        for x in range(columns):
+            window = padded[y:y+size, x:x+size]
+            for dy, dx in textures.DIRECTIONS:
+                dy, dx = dy * distance, dx * distance
+                matrix = np.zeros((256, 256))
+                for i in range(size):
+                    for j in range(size):
+                        if 0 <= i + dy < size and 0 <= j + dx < size:
+                            a, b = window[i, j], window[i+dy, j+dx]
+                            matrix[a, b] += 1
+                            matrix[b, a] += 1
+                p = matrix / matrix.sum()
+                difference = (levels[:, np.newaxis] - levels[np.newaxis, :]) ** 2
+                mean = (p.sum(axis=1) * levels).sum()
+                nonzero = p[p > 0]
+                measures[0, y, x] += (p ** 2).sum()
+                measures[1, y, x] += (difference * p).sum()
+                measures[2, y, x] += (p.sum(axis=1) * (levels - mean) ** 2).sum()
+                measures[3, y, x] += (p / (1 + difference)).sum()
+                measures[4, y, x] += -(nonzero * np.log10(nonzero)).sum()
+    return measures / len(textures.DIRECTIONS)
+
+
+class TexturesTest(unittest.TestCase):
+    """Test the Haralick measures against a brute force co-occurrence matrix."""
+
+    def quantized_image(self, seed, lines, columns, categories):
+        rng = np.random.default_rng(seed)
+        return rng.integers(1, categories + 1, size=(lines, columns)).astype(np.uint8)
+
+    def test_same_as_brute_force(self):
+        """Every measure matches the one of the co-occurrence matrix of the window."""
+        for size, distance, categories in [(3, 1, 4), (5, 2, 8), (7, 1, 255)]:
+            quantized = self.quantized_image(size, 12, 15, categories)
+            measures = textures.texture_tile(quantized, size, distance, 0, quantized.shape[0])
+            np.testing.assert_allclose(
+                measures, brute_force_measures(quantized, size, distance), rtol=1e-4, atol=1e-5)
+
+    def test_tiles_same_as_whole(self):
+        """Tiles of lines give the same measures as the whole band."""
+        quantized = self.quantized_image(1, 20, 9, 6)
+        whole = textures.texture_tile(quantized, 5, 1, 0, 20)
+        tiles = np.concatenate(
+            [textures.texture_tile(quantized, 5, 1, yoff, min(7, 20 - yoff)) for yoff in range(0, 20, 7)],
+            axis=1)
+        np.testing.assert_array_equal(tiles, whole)
+
+    def test_segments_same_as_one_slide(self):
+        """Sliding several segments of the columns at once gives the same measures."""
+        quantized = self.quantized_image(2, 8, 30, 10)
+        whole = textures.texture_tile(quantized, 3, 1, 0, 8)
+        counts = textures.COOCCURRENCE_COUNTS
+        textures.COOCCURRENCE_COUNTS = 500
+        try:
+            segmented = textures.texture_tile(quantized, 3, 1, 0, 8)
+        finally:
+            textures.COOCCURRENCE_COUNTS = counts
+        np.testing.assert_allclose(segmented, whole, rtol=1e-5)
+
+    def test_quantize(self):
+        """Categories go from 1 to their amount, with about the same pixels each when recoding."""
+        data = np.arange(1000, dtype=np.float32).reshape(40, 25)
+        quantized = textures.quantize(data, textures.quantization_edges(data, 10, False))
+        self.assertEqual((quantized.min(), quantized.max()), (1, 10))
+        np.testing.assert_array_equal(np.bincount(quantized.ravel())[1:], np.full(10, 100))
+        rescaled = textures.quantize(data, textures.quantization_edges(data, 4, True))
+        self.assertEqual((rescaled.min(), rescaled.max()), (1, 4))
+
+    def test_check_parameters(self):
+        """Even windows, long distances and too many categories are rejected."""
+        for size, distance, categories in [(4, 1, 255), (3, 3, 255), (3, 1, 256), (3, 1, 1)]:
+            with self.assertRaises(ValueError):
+                textures.check_parameters(size, distance, categories)
+
+
+class TexturesScriptTest(unittest.TestCase):
+    """Test the textures are calculated from the command line."""
+
+    def setUp(self):
+        """Runs before each test."""
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        """Runs after each test."""
+        shutil.rmtree(self.directory)
+
+    def run_script(self, *arguments):
+        return subprocess.run(
+            [sys.executable, TEXTURES_SCRIPT] + list(arguments), stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE, universal_newlines=True)
+
+    def test_help(self):
+        """The script starts."""
+        result = self.run_script("--help")
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertIn("--input_file", result.stdout)
+
+    def test_textures_file(self):
+        """The script writes the measures of every band."""
+        file_input = os.path.join(self.directory, "dem.tif")
+        file_output = os.path.join(self.directory, "dem_textures.tif")
+        dataset = gdal.GetDriverByName("GTiff").Create(file_input, 20, 10, 1, gdal.GDT_Float32)
+        dataset.GetRasterBand(1).WriteArray(np.random.default_rng(3).random((10, 20)).astype(np.float32))
+        dataset = None
+
+        result = self.run_script("-i", file_input, "-o", file_output, "-s", "5", "-c", "16")
+        self.assertEqual(result.returncode, 0, result.stderr)
+        dataset = gdal.Open(file_output, gdal.GA_ReadOnly)
+        self.assertEqual(dataset.RasterCount, len(textures.MEASURES))
+        self.assertEqual(
+            [dataset.GetRasterBand(i + 1).GetDescription() for i in range(dataset.RasterCount)],
+            ["band.1_{}".format(measure) for measure in textures.MEASURES])
+
+
+if __name__ == "__main__":
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(TexturesTest))
+    suite.addTest(unittest.makeSuite(TexturesScriptTest))
+    runner = unittest.TextTestRunner(verbosity=2)
+    runner.run(suite)